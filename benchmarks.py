@@ -0,0 +1,467 @@
+"""Reproducible benchmarks of the registry API
+
+The benchmarks run against an in-process HTTP server that emulates the
+consul /v1/kv and /v1/txn endpoints, adding a configurable latency and
+jitter to each request, so they do not need a real consul cluster.
+
+Usage examples:
+
+    # Default run: json and yaml templates with 2, 20, 200 and 2000 slaves
+    python benchmarks.py --output results.json
+    # Emulate a remote endpoint and compare with a previous run
+    python benchmarks.py --latency 0.005 --jitter 0.002 --compare results.json
+    # Micro-benchmark of the flattening of a document with 100k keys
+    python benchmarks.py --flatten 100000
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import bisect
+import io
+import json
+import platform
+import random
+import subprocess
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+import registry
+
+USER = 'benchmark'
+PRODUCT = 'benchmark'
+VERSION = '1.0.0'
+SIZES = (2, 20, 200, 2000)
+TEMPLATES = {
+    'json': ('service-template.json', 'json+jinja2'),
+    'yaml': ('service-template.yaml', 'yaml+jinja2'),
+}
+# Seconds to wait in a blocking query when no wait is given
+DEFAULT_WAIT = 300
+
+
+class ConsulKV(object):
+    """In-memory k/v store with the consul index semantics"""
+
+    def __init__(self):
+        self.data = {}
+        self.indexes = {}
+        self.keys = []
+        # Index of the deleted keys, as consul keeps tombstones
+        self.tombstones = {}
+        self.deleted = []
+        self.last_index = 1
+        self.requests = 0
+        self.changed = threading.Condition()
+
+    def _set(self, key, value):
+        if key not in self.data:
+            bisect.insort(self.keys, key)
+        if key in self.tombstones:
+            del self.tombstones[key]
+            self.deleted.remove(key)
+        self.last_index += 1
+        self.data[key] = value
+        self.indexes[key] = self.last_index
+
+    def _delete(self, key, recursive=False):
+        self.last_index += 1
+        for k in self.subtree(key) if recursive else [key]:
+            if k in self.data:
+                del self.data[k]
+                del self.indexes[k]
+                self.keys.remove(k)
+                if k not in self.tombstones:
+                    bisect.insort(self.deleted, k)
+                self.tombstones[k] = self.last_index
+
+    def subtree(self, prefix, keys=None):
+        """Keys starting with prefix (consul uses plain prefix matching)"""
+        keys = self.keys if keys is None else keys
+        start = bisect.bisect_left(keys, prefix)
+        result = []
+        for k in keys[start:]:
+            if not k.startswith(prefix):
+                break
+            result.append(k)
+        return result
+
+    def index_of(self, key, recursive=False):
+        """Highest modify index of the key or of the keys below the prefix"""
+        if recursive:
+            keys, deleted = self.subtree(key), self.subtree(key, self.deleted)
+        else:
+            keys = [key] if key in self.data else []
+            deleted = [key] if key in self.tombstones else []
+        indexes = [self.indexes[k] for k in keys] + [self.tombstones[k] for k in deleted]
+        return max(indexes or [self.last_index])
+
+    def entry(self, key):
+        value = self.data[key]
+        return {'Key': key, 'Flags': 0, 'LockIndex': 0,
+                'CreateIndex': self.indexes[key], 'ModifyIndex': self.indexes[key],
+                'Value': base64.b64encode(value).decode('ascii') if value else None}
+
+    def wait(self, key, recursive, index, timeout):
+        """Block until the key or the keys below the prefix change after index
+
+        As in consul, changes to other keys do not release the query.
+        """
+        deadline = time.time() + timeout
+        with self.changed:
+            while self.index_of(key, recursive) <= index and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+
+
+class ConsulHandler(BaseHTTPRequestHandler):
+    """Emulate the consul /v1/kv and /v1/txn endpoints"""
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one segment, avoiding delayed ACK stalls
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        return url.path, params
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, payload=None, index=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if index is not None:
+            self.send_header('X-Consul-Index', str(index))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        server = self.server
+        server.store.requests += 1
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def do_GET(self):
+        self._delay()
+        path, params = self._params()
+        key = path[len('/v1/kv/'):]
+        store = self.server.store
+        if 'index' in params and params['index']:
+            store.wait(key, 'keys' in params or 'recurse' in params, int(params['index']),
+                       registry._parse_wait(params.get('wait') or DEFAULT_WAIT))
+        with store.changed:
+            if 'keys' in params:
+                keys = store.subtree(key)
+                separator = params.get('separator')
+                if separator:
+                    listed = []
+                    for k in keys:
+                        position = k.find(separator, len(key))
+                        k = k if position < 0 else k[:position + 1]
+                        if not listed or listed[-1] != k:
+                            listed.append(k)
+                    result = listed
+                else:
+                    result = keys
+            elif 'recurse' in params:
+                keys = store.subtree(key)
+                result = [store.entry(k) for k in keys]
+            else:
+                keys = [key] if key in store.data else []
+                result = [store.entry(k) for k in keys]
+            index = store.index_of(key, 'keys' in params or 'recurse' in params)
+        if not keys:
+            return self._reply(404, index=index)
+        self._reply(200, result, index)
+
+    def do_PUT(self):
+        self._delay()
+        path, params = self._params()
+        body = self._body()
+        store = self.server.store
+        if path == '/v1/txn':
+            return self._txn(json.loads(body.decode('utf-8')))
+        key = path[len('/v1/kv/'):]
+        with store.changed:
+            if 'cas' in params and int(params['cas']) != store.indexes.get(key, 0):
+                result = False
+            else:
+                store._set(key, body)
+                result = True
+            index = store.last_index
+            store.changed.notify_all()
+        self._reply(200, result, index)
+
+    def do_DELETE(self):
+        self._delay()
+        path, params = self._params()
+        store = self.server.store
+        with store.changed:
+            store._delete(path[len('/v1/kv/'):], recursive='recurse' in params)
+            store.changed.notify_all()
+        self._reply(200, True, store.last_index)
+
+    def _txn(self, payload):
+        store = self.server.store
+        with store.changed:
+            errors = []
+            for i, op in enumerate(payload):
+                kv = op['KV']
+                if kv['Verb'] == 'cas' and kv.get('Index', 0) != store.indexes.get(kv['Key'], 0):
+                    errors.append({'OpIndex': i, 'What': 'failed to set key "{}", index is stale'
+                                   .format(kv['Key'])})
+                elif kv['Verb'] == 'get' and kv['Key'] not in store.data:
+                    errors.append({'OpIndex': i, 'What': 'key "{}" does not exist'
+                                   .format(kv['Key'])})
+                elif kv['Verb'] not in ('set', 'cas', 'delete', 'delete-tree', 'get'):
+                    errors.append({'OpIndex': i, 'What': 'unknown KV verb "{}"'.format(kv['Verb'])})
+            if errors:
+                return self._reply(409, {'Errors': errors, 'Results': None})
+            results = []
+            for op in payload:
+                kv = op['KV']
+                if kv['Verb'] in ('set', 'cas'):
+                    store._set(kv['Key'], base64.b64decode(kv.get('Value') or ''))
+                    results.append({'KV': dict(store.entry(kv['Key']), Value=None)})
+                elif kv['Verb'] == 'get':
+                    results.append({'KV': store.entry(kv['Key'])})
+                else:
+                    store._delete(kv['Key'], recursive=(kv['Verb'] == 'delete-tree'))
+            store.changed.notify_all()
+        self._reply(200, {'Results': results, 'Errors': None}, store.last_index)
+
+
+class ConsulServer(ThreadingMixIn, HTTPServer):
+    """Local consul k/v stand-in adding latency and jitter to the requests
+
+        server = ConsulServer(latency=0.002, jitter=0.001).start()
+        registry.connect(server.endpoint)
+        ...
+        server.stop()
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, jitter=0.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), ConsulHandler)
+        self.latency = latency
+        self.jitter = min(jitter, latency)
+        self.store = ConsulKV()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}/v1/kv'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _timed(server, results, template, slaves, operation, func):
+    """Run func recording the time it took and the requests it issued"""
+    requests = server.store.requests
+    start = time.time()
+    value = func()
+    results.append({'template': template, 'slaves': slaves, 'operation': operation,
+                    'seconds': round(time.time() - start, 4),
+                    'requests': server.store.requests - requests})
+    return value
+
+
+def run(sizes=SIZES, templates=('json', 'yaml'), latency=0.001, jitter=0.0005,
+        pool_size=None):
+    """Run the benchmarks and return the list of results"""
+    with open('options.json') as f:
+        options = f.read()
+    results = []
+    for template in templates:
+        filename, templatetype = TEMPLATES[template]
+        with open(filename) as f:
+            source = f.read()
+        for slaves in sizes:
+            server = ConsulServer(latency, jitter).start()
+            try:
+                registry.connect(server.endpoint, pool_size=pool_size)
+                registry.register(PRODUCT, VERSION, 'Benchmark product', source, options,
+                                  templatetype=templatetype)
+                cluster = _timed(server, results, template, slaves, 'instantiate',
+                                 lambda: registry.instantiate(USER, PRODUCT, VERSION,
+                                                              {'slaves.number': slaves}))
+                _timed(server, results, template, slaves, 'query_clusters',
+                       lambda: registry.query_clusters(USER))
+                _timed(server, results, template, slaves, 'query_clusters_fields',
+                       lambda: registry.query_clusters(USER, fields=True))
+                _timed(server, results, template, slaves, 'nodes',
+                       lambda: [n.status for n in cluster.nodes])
+                _timed(server, results, template, slaves, 'nodes_snapshot',
+                       lambda: [n.status for n in
+                                registry.get_cluster(dn=cluster.dn, snapshot=True).nodes])
+                _timed(server, results, template, slaves, 'to_dict',
+                       lambda: cluster.to_dict(depth=2))
+                _timed(server, results, template, slaves, 'instantiate_stream',
+                       lambda: registry.instantiate(USER, PRODUCT, VERSION,
+                                                    {'slaves.number': slaves}, stream=True))
+                snapshot = io.BytesIO()
+                _timed(server, results, template, slaves, 'export',
+                       lambda: registry.export(registry.PREFIX, snapshot))
+                _timed(server, results, template, slaves, 'import',
+                       lambda: registry.import_(io.BytesIO(snapshot.getvalue())))
+            finally:
+                registry.close()
+                server.stop()
+    return results
+
+
+def populate_reference(result, using, prefix=''):
+    """Recursive flattening used by registry._populate up to 0.5.0
+
+    Kept as the reference of the flattening micro-benchmark.
+    """
+    data = using
+
+    if registry.isvalue(data):
+        result[prefix] = data
+    elif registry.islist(data):
+        for e in data:
+            if registry.isvalue(e):
+                result['{}/{}'.format(prefix, e)] = ''
+            else:
+                raise registry.NestedListsNotSupportedError(
+                    'prefix: {}, element: {}'.format(prefix, e))
+    elif registry.isdict(data):
+        for k in data:
+            path = '{}/{}'.format(prefix, k)
+            v = data[k]
+            if registry.isvalue(v):
+                result[path] = v
+            elif registry.isdumpable(v):
+                populate_reference(result, v, path)
+            else:
+                raise registry.UnsupportedTypeError(
+                    'path: {}, key: {}, value: {}, type: {}'
+                    .format(path, k, v, type(v)))
+    else:
+        raise registry.UnsupportedTypeError('data: {}, type: {}'.format(data, type(data)))
+
+
+def cluster_document(keys):
+    """Build a cluster document similar to a rendered template with about
+    the given number of keys (50 per node)"""
+    nodes = {}
+    for n in range(max(1, keys // 50)):
+        nodes['slave{}'.format(n)] = {
+            'status': 'pending', 'cpu': 2, 'mem': 2048, 'host': '', 'id': '',
+            'services': ['datanode', 'nodemanager'], 'tags': ['slave', 'yarn'],
+            'disks': {'disk{}'.format(d): {'origin': '/data/{}'.format(d),
+                                           'destination': '/data/{}'.format(d),
+                                           'mode': 'rw', 'type': 'sata'}
+                      for d in range(8)},
+            'networks': {'eth0': {'networkname': 'admin', 'device': 'eth0',
+                                  'address': '', 'gateway': '', 'netmask': ''}},
+            'check_ports': [22, 80, 443], 'docker_image': 'registry:5000/slave:1.0'}
+    return {'status': 'pending', 'nodes': nodes, 'services': {
+        'datanode': {'status': 'pending', 'nodes': sorted(nodes)},
+        'nodemanager': {'status': 'pending', 'nodes': sorted(nodes)}}}
+
+
+def flatten(keys, repeat=5):
+    """Compare the flattening engine with the recursive reference"""
+    data = cluster_document(keys)
+    prefix = 'clusters/user/product/1.0.0/1'
+    timings = {}
+    for name, func in (('reference', populate_reference), ('registry', registry._populate)):
+        best = None
+        for _ in range(repeat):
+            result = {}
+            start = time.time()
+            func(result, using=data, prefix=prefix)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = {'seconds': round(best, 4), 'keys': len(result)}
+    timings['speedup'] = round(timings['reference']['seconds'] / timings['registry']['seconds'], 2)
+    return timings
+
+
+def compare(results, baseline):
+    """Print the results side by side with the ones of a previous run"""
+    previous = {(r['template'], r['slaves'], r['operation']): r for r in baseline['results']}
+    print('{:<6} {:>6} {:<22} {:>10} {:>10} {:>8} {:>9} {:>9}'.format(
+        'tmpl', 'slaves', 'operation', 'before(s)', 'after(s)', 'ratio', 'req.bef', 'req.aft'))
+    for r in results:
+        p = previous.get((r['template'], r['slaves'], r['operation']))
+        if p is None:
+            continue
+        ratio = r['seconds'] / p['seconds'] if p['seconds'] else float('nan')
+        print('{:<6} {:>6} {:<22} {:>10.4f} {:>10.4f} {:>8.2f} {:>9} {:>9}'.format(
+            r['template'], r['slaves'], r['operation'], p['seconds'], r['seconds'],
+            ratio, p['requests'], r['requests']))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help='comma separated numbers of slaves')
+    parser.add_argument('--templates', default='json,yaml',
+                        help='comma separated template types: json, yaml')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='latency added to each request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0005,
+                        help='maximum random variation of the latency in seconds')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='connections and writers, see registry.connect()')
+    parser.add_argument('--output', help='file where the JSON results are written')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--flatten', type=int, metavar='KEYS',
+                        help='only run the flattening micro-benchmark with KEYS keys')
+    args = parser.parse_args()
+
+    if args.flatten:
+        print(json.dumps(flatten(args.flatten), indent=2, sort_keys=True))
+        return
+
+    results = run([int(s) for s in args.sizes.split(',')], args.templates.split(','),
+                  args.latency, args.jitter, args.pool_size)
+    report = {'commit': _commit(), 'python': platform.python_version(),
+              'latency': args.latency, 'jitter': args.jitter,
+              'pool_size': args.pool_size or registry.WRITERS, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
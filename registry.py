@@ -1,32 +1,1090 @@
 """Configuration Registry API"""
 import re
+import time
+import base64
+import binascii
+import bisect
+import gzip
+import hashlib
+import itertools
+import sqlite3
+import threading
+import zlib
 import jinja2
 import json
 import yaml
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import kvstore
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+try:
+    unicode
+except NameError:
+    # Python 3, used by the asynchronous API in registry_aio
+    unicode = str
+    long = int
 
 PREFIX = 'clusters'
 TMPLPREFIX = 'products'
+# Levels below PREFIX of the cluster DNs: user, product, version and ID
+CLUSTER_DEPTH = 4
+# Storage layouts of the clusters, chosen per product (see register): one
+# key per attribute or one JSON document per node, service and cluster
+LAYOUT_KEYS = 'keys'
+LAYOUT_DOCUMENT = 'document'
+LAYOUTS = (LAYOUT_KEYS, LAYOUT_DOCUMENT)
+# Attempts to update a document modified concurrently by other clients
+DOCUMENT_RETRIES = 5
+# Prefix of the counters used to allocate instance IDs
+COUNTERPREFIX = 'counters'
+# Prefix of the secondary indexes of nodes
+INDEXPREFIX = 'index'
+# Key of the summary of the registered products, see query_products
+CATALOGKEY = 'catalog'
+# Node attributes with a secondary index
+INDEXED_ATTRIBUTES = ('host', 'status', 'tags', 'services')
 # Characters used to replace slash in IDs
 SLASH = '--'
 DOT = '__'
+# Maximum number of operations that consul accepts in a single transaction
+TXN_MAX_OPS = 64
+# Maximum number of concurrent writers used by save() and of pooled connections
+WRITERS = 8
+# Connect and read timeouts of the requests to the k/v store in seconds
+TIMEOUT = (3.05, 60)
+# Product fields stored compressed (and split in chunks) when they are large
+BLOB_FIELDS = ('template', 'orchestrator', 'options')
+# Minimum size in bytes of the product fields that are compressed
+BLOB_THRESHOLD = 4096
+# Maximum size of each chunk of a compressed field (consul limit is 512KB)
+BLOB_CHUNK_SIZE = 256 * 1024
+# Seconds before checking if the cached product metadata is still valid
+PRODUCT_CHECK_INTERVAL = 30
+# Maximum time that a blocking query of a watch waits for changes
+WATCH_WAIT = '5m'
+# Minimum and maximum seconds between the retries of a failed watch and
+# between the reads of stores without blocking queries
+WATCH_BACKOFF = (0.1, 30)
+# Upper bounds in seconds of the buckets of the latency histograms
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Client(kvstore.Client):
+    """K/V store client with a pool of keep-alive connections
+
+    Extends kvstore.Client sending all the requests through a requests
+    session, so the connections to the store are reused, and adds support
+    for the consul /v1/txn endpoint, so that several keys can be written
+    atomically in one request, keys-only listings and check-and-set.
+
+    Blocking queries (e.g. the ones of watch) are sent through a separate
+    session, so they do not hold the pooled connections while they wait.
+    """
+
+    def __init__(self, endpoint='http://127.0.0.1:8500/v1/kv',
+                 pool_size=WRITERS, timeout=TIMEOUT):
+        super(Client, self).__init__(endpoint)
+        self.txn_endpoint = re.sub(r'/kv$', '/txn', endpoint.rstrip('/'))
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Block instead of opening connections that can not be kept alive
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                    pool_block=True)
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        # One connection per blocking query, without blocking on a limit
+        self.watch_session = requests.Session()
+        # Cleared when the store answers 404 to a transaction (consul < 0.7)
+        self.txn_supported = True
+
+    def _request(self, method, k, params=None, data=None, wait=False):
+        """Send a request for the given key through the session"""
+        url = '{}/{}'.format(self.endpoint, k.lstrip('/'))
+        return self._send(method, url, params, data, wait)
+
+    def _send(self, method, url, params=None, data=None, wait=False):
+        # Blocking queries can take as long as the wait time
+        timeout = (self.timeout[0], None) if wait else self.timeout
+        session = self.watch_session if wait else self.session
+        metrics = _metrics
+        if metrics is None:
+            return session.request(method, url, params=params, data=data,
+                                   timeout=timeout)
+        operation = 'kv_txn' if url == self.txn_endpoint else 'kv_' + method.lower()
+        start = time.time()
+        try:
+            r = session.request(method, url, params=params, data=data,
+                                timeout=timeout)
+        except Exception:
+            metrics.observe(operation, time.time() - start, error=True,
+                            sent=len(data or ''))
+            raise
+        metrics.observe(operation, time.time() - start,
+                        error=(r.status_code >= 400 and r.status_code != 404),
+                        sent=len(data or ''), received=len(r.content))
+        return r
+
+    def set(self, k, v):
+        """Add or update a key, value pair to the database"""
+        r = self._request('PUT', k, data=_encode(v))
+        if r.status_code != 200 or r.json() is not True:
+            raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+
+    def get(self, k, wait=False, wait_index=False, timeout='5m'):
+        """Get the value of a given key"""
+        return self.get_indexed(k, wait, wait_index, timeout)[0]
+
+    def get_indexed(self, k, wait=False, wait_index=False, timeout='5m'):
+        """Get the value of a given key together with its X-Consul-Index"""
+        params = {}
+        if wait:
+            params['index'] = wait_index
+            params['wait'] = timeout
+        r = self._request('GET', k, params=params, wait=wait)
+        _check_response(r, k)
+        return _decode(r.json()[0]['Value']), r.headers.get('X-Consul-Index')
+
+    def recurse(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key"""
+        return self.recurse_indexed(k, wait, wait_index, timeout)[0]
+
+    def recurse_indexed(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key and its X-Consul-Index"""
+        params = {'recurse': 'true'}
+        if wait:
+            params['wait'] = timeout
+            if not wait_index:
+                params['index'] = self.index(k, recursive=True)
+            else:
+                params['index'] = wait_index
+        r = self._request('GET', k, params=params, wait=wait)
+        _check_response(r, k)
+        entries = {}
+        for e in r.json():
+            entries[e['Key']] = _decode(e['Value'])
+        return entries, r.headers.get('X-Consul-Index')
+
+    def keys(self, k, separator=None):
+        """List the keys below the given key without retrieving the values
+
+        With a separator only the keys up to the first separator found
+        after the given prefix are listed, e.g. the immediate children.
+        """
+        params = {'keys': 'true'}
+        if separator:
+            params['separator'] = separator
+        r = self._request('GET', k, params=params)
+        _check_response(r, k)
+        return r.json()
+
+    def index(self, k, recursive=False):
+        """Get the current index of the key or the subtree
+
+        Only the keys are listed to avoid transferring the values. As the
+        listing matches by prefix, the index of a key also covers the keys
+        starting with it (e.g. a/status0 for a/status).
+        """
+        params = {'keys': 'true'}
+        if recursive:
+            params['recurse'] = 'true'
+        r = self._request('GET', k, params=params)
+        if r.status_code not in (200, 404) or 'X-Consul-Index' not in r.headers:
+            raise kvstore.KVStoreError('GET returned {}'.format(r.status_code))
+        return r.headers['X-Consul-Index']
+
+    def delete(self, k, recursive=False):
+        """Delete a given key or recursively delete the tree below it"""
+        params = {'recurse': ''} if recursive else {}
+        r = self._request('DELETE', k, params=params)
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('DELETE returned {}'.format(r.status_code))
+
+    def cas(self, k, v, index):
+        """Set the value of a key only if its modify index did not change
+
+        With index 0 the key is only set if it does not exist yet.
+        Returns True if the value was set.
+        """
+        r = self._request('PUT', k, params={'cas': index}, data=_encode(v))
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+        return r.json() is True
+
+    def txn(self, operations):
+        """Apply a list of operations atomically
+
+        Each operation is a tuple (verb, key[, value[, index]]) using the
+        consul KV verbs, e.g. ('set', key, value) or ('delete-tree', key).
+        The operations are all applied or, in case of error, none of them.
+        """
+        payload = []
+        for op in operations:
+            verb, key = op[0], op[1].lstrip('/')
+            kv = {'Verb': verb, 'Key': key}
+            if len(op) > 2 and op[2] is not None:
+                kv['Value'] = base64.b64encode(_encode(op[2])).decode('ascii')
+            if len(op) > 3:
+                # Consul needs a number, the indexes come from the headers
+                kv['Index'] = int(op[3])
+            payload.append({'KV': kv})
+        r = self._send('PUT', self.txn_endpoint, data=json.dumps(payload))
+        if r.status_code == 404:
+            self.txn_supported = False
+            raise TransactionsNotSupportedError('TXN returned 404')
+        if r.status_code == 409:
+            errors = r.json().get('Errors') or []
+            raise TransactionError(
+                '; '.join(e.get('What', '') for e in errors))
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('TXN returned {}'.format(r.status_code))
+        return r.json().get('Results') or []
+
+    def pool_stats(self):
+        """Return statistics of the pool of HTTP connections
+
+        - pool_size: maximum number of keep-alive connections
+        - connections: connections opened since the client was created
+        - requests: requests sent since the client was created
+        - idle: connections currently available in the pool
+        """
+        stats = {'pool_size': self.pool_size, 'connections': 0,
+                 'requests': 0, 'idle': 0}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['connections'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+            if pool.pool is not None:
+                stats['idle'] += sum(1 for c in list(pool.pool.queue) if c is not None)
+        return stats
+
+    def close(self):
+        """Close all the connections of the pool and of the blocking queries"""
+        self.session.close()
+        self.watch_session.close()
+
+
+class LocalClient(object):
+    """Embedded k/v store with the same interface as Client
+
+    The keys are kept in a sorted in-memory map, so the operations do not
+    leave the process. With a path the data is also persisted in a SQLite
+    database and loaded again when the client is created. It follows the
+    consul semantics: recursive operations match the keys by prefix and
+    every write increases the index, which can be used for check-and-set
+    and blocking queries.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = {}
+        self._indexes = {}
+        self._keys = []
+        self._last_index = 0
+        self._last_delete = 0
+        self._changed = threading.Condition(threading.RLock())
+        self._closed = False
+        self._db = None
+        if path:
+            self._open(path)
+
+    def _open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS kv '
+                         '(key TEXT PRIMARY KEY, value TEXT, modify_index INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.commit()
+        for key, value, index in self._db.execute('SELECT key, value, modify_index FROM kv'):
+            self._data[key] = value
+            self._indexes[key] = index
+        self._keys = sorted(self._data)
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'last_index'").fetchone()
+        self._last_index = max([row[0] if row else 0] + list(self._indexes.values()))
+        self._last_delete = self._last_index
+
+    def _subtree(self, prefix):
+        """Keys starting with prefix"""
+        start = bisect.bisect_left(self._keys, prefix)
+        end = start
+        while end < len(self._keys) and self._keys[end].startswith(prefix):
+            end += 1
+        return self._keys[start:end]
+
+    def _index_of(self, keys):
+        # Deleted keys leave no trace, so any deletion changes the index
+        if not keys:
+            return self._last_index
+        return max([self._indexes[k] for k in keys] + [self._last_delete])
+
+    def _wait(self, current, index, timeout):
+        """Block until current() returns an index after the given one"""
+        deadline = time.time() + _parse_wait(timeout)
+        while current() <= int(index or 0) and time.time() < deadline and not self._closed:
+            self._changed.wait(deadline - time.time())
+
+    def _put(self, key, value):
+        key = _to_str(key).lstrip('/')
+        if key not in self._data:
+            bisect.insort(self._keys, key)
+        self._last_index += 1
+        self._data[key] = _to_str(_encode(value))
+        self._indexes[key] = self._last_index
+        if self._db is not None:
+            self._db.execute('INSERT OR REPLACE INTO kv VALUES (?, ?, ?)',
+                             (key, self._data[key], self._last_index))
+        return key
+
+    def _remove(self, key, recursive=False):
+        key = _to_str(key).lstrip('/')
+        keys = self._subtree(key) if recursive else [k for k in [key] if k in self._data]
+        for k in keys:
+            del self._data[k]
+            del self._indexes[k]
+        if recursive:
+            start = bisect.bisect_left(self._keys, key)
+            del self._keys[start:start + len(keys)]
+        elif keys:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        self._last_index += 1
+        self._last_delete = self._last_index
+        if self._db is not None:
+            self._db.executemany('DELETE FROM kv WHERE key = ?', [(k,) for k in keys])
+
+    def _commit(self):
+        """Persist the pending writes and wake up the blocking queries"""
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('last_index', ?)",
+                             (self._last_index,))
+            self._db.commit()
+        self._changed.notify_all()
+
+    def set(self, k, v):
+        """Add or update a key, value pair to the database"""
+        with self._changed:
+            self._put(k, v)
+            self._commit()
+
+    def get(self, k, wait=False, wait_index=False, timeout='5m'):
+        """Get the value of a given key"""
+        return self.get_indexed(k, wait, wait_index, timeout)[0]
+
+    def get_indexed(self, k, wait=False, wait_index=False, timeout='5m'):
+        """Get the value of a given key together with its index"""
+        key = _to_str(k).lstrip('/')
+        with self._changed:
+            if wait:
+                self._wait(lambda: self._index_of([key] if key in self._data else []),
+                           wait_index, timeout)
+            if key not in self._data:
+                raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+            return self._data[key], self._indexes[key]
+
+    def recurse(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key"""
+        return self.recurse_indexed(k, wait, wait_index, timeout)[0]
+
+    def recurse_indexed(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key and its index"""
+        key = _to_str(k).lstrip('/')
+        with self._changed:
+            if wait:
+                current = lambda: self._index_of(self._subtree(key))
+                self._wait(current, wait_index or current(), timeout)
+            keys = self._subtree(key)
+            if not keys:
+                raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+            return {e: self._data[e] for e in keys}, self._index_of(keys)
+
+    def keys(self, k, separator=None):
+        """List the keys below the given key, see Client.keys"""
+        key = _to_str(k).lstrip('/')
+        with self._changed:
+            keys = self._subtree(key)
+        if not keys:
+            raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+        return _split_keys(keys, key, separator)
+
+    def index(self, k, recursive=False):
+        """Get the current index of the key or the subtree"""
+        key = _to_str(k).lstrip('/')
+        with self._changed:
+            if recursive:
+                return self._index_of(self._subtree(key))
+            return self._index_of([key] if key in self._data else [])
+
+    def delete(self, k, recursive=False):
+        """Delete a given key or recursively delete the tree below it"""
+        with self._changed:
+            self._remove(k, recursive)
+            self._commit()
+
+    def cas(self, k, v, index):
+        """Set the value of a key only if its index did not change"""
+        key = _to_str(k).lstrip('/')
+        with self._changed:
+            if self._indexes.get(key, 0) != int(index or 0):
+                return False
+            self._put(key, v)
+            self._commit()
+            return True
+
+    def txn(self, operations):
+        """Apply a list of operations atomically, see Client.txn"""
+        with self._changed:
+            errors = []
+            for op in operations:
+                key = _to_str(op[1]).lstrip('/')
+                if op[0] == 'cas' and self._indexes.get(key, 0) != int(op[3] or 0):
+                    errors.append('failed to set key "{}", index is stale'.format(key))
+                elif op[0] == 'get' and key not in self._data:
+                    errors.append('key "{}" does not exist'.format(key))
+                elif op[0] not in ('set', 'cas', 'delete', 'delete-tree', 'get'):
+                    errors.append('unknown KV verb "{}"'.format(op[0]))
+            if errors:
+                raise TransactionError('; '.join(errors))
+            results = []
+            for op in operations:
+                if op[0] in ('set', 'cas'):
+                    key = self._put(op[1], op[2])
+                    results.append({'KV': {'Key': key, 'ModifyIndex': self._indexes[key]}})
+                elif op[0] == 'get':
+                    key = _to_str(op[1]).lstrip('/')
+                    value = base64.b64encode(_encode(self._data[key])).decode('ascii')
+                    results.append({'KV': {'Key': key, 'Value': value,
+                                           'ModifyIndex': self._indexes[key]}})
+                else:
+                    self._remove(op[1], recursive=(op[0] == 'delete-tree'))
+            self._commit()
+            return results
+
+    def close(self):
+        """Close the SQLite database and wake up the blocking queries"""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return the cache counters"""
+        return {'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class ReadCache(LRUCache):
+    """Client-side cache of k/v store values
+
+    Entries expire after a TTL that can be configured per key prefix, the
+    longest matching prefix in ttls wins over the default ttl. With
+    revalidate=True an expired entry is kept if the X-Consul-Index of a
+    keys-only listing did not change, which avoids transferring the value
+    again.
+    """
+
+    def __init__(self, maxsize=1024, ttl=5, ttls=None, revalidate=False):
+        super(ReadCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.ttls = sorted((ttls or {}).items(), key=lambda e: -len(e[0]))
+        self.revalidate = revalidate
+        self.revalidations = 0
+
+    def ttl_for(self, key):
+        """Return the TTL that applies to the given key"""
+        for prefix, ttl in self.ttls:
+            if key.startswith(prefix):
+                return ttl
+        return self.ttl
+
+    def fetch(self, key):
+        """Return the value of key from the cache or from the k/v store"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, index, expires = entry
+                if time.time() < expires:
+                    self._entries[key] = self._entries.pop(key)
+                    self.hits += 1
+                    return value
+        current = None
+        if entry is not None and self.revalidate and index is not None:
+            current = _kv.index(key)
+            if current == index:
+                with self._lock:
+                    self.revalidations += 1
+                    self.hits += 1
+                self.put(key, (value, index, time.time() + self.ttl_for(key)))
+                return value
+        with self._lock:
+            self.misses += 1
+        value, index = _get_indexed(key)
+        # The index of the keys-only listing can be higher than the one of
+        # the key, keep it so that the next revalidation compares the same
+        self.put(key, (value, current or index, time.time() + self.ttl_for(key)))
+        return value
+
+    def stats(self):
+        stats = super(ReadCache, self).stats()
+        stats['revalidations'] = self.revalidations
+        return stats
+
+
+class WriterPool(object):
+    """Long-lived pool of threads that apply the writes to the k/v store
+
+    The number of writes in flight adapts to the observed throughput and
+    latency: it keeps moving in the same direction while the throughput
+    improves and turns back when it drops or when only the latency grows.
+    """
+
+    def __init__(self, max_workers=WRITERS, min_workers=1, adaptive=True):
+        self.max_workers = max_workers
+        self.min_workers = min(min_workers, max_workers)
+        self.adaptive = adaptive
+        self.concurrency = max_workers
+        self.throughput = None
+        self.latency = None
+        self.tasks = 0
+        self.errors = 0
+        self._direction = -1
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+
+    def run(self, func, items, progress=None, weight=None):
+        """Call func with every item concurrently and return the results
+
+        A failure does not stop the remaining items, all the failures are
+        raised together as a SaveError at the end. If given, progress is
+        called as progress(done, total) each time an item finishes, each
+        item counting as weight(item) (1 by default).
+
+        items can also be an iterator, e.g. a generator that is still
+        producing them: it is consumed as the writers become available
+        and the total passed to progress is None.
+        """
+        total = None
+        if isinstance(items, (list, tuple)):
+            total = sum(weight(item) if weight else 1 for item in items)
+        items = iter(items)
+        done, results, latencies, errors = 0, [], [], []
+        concurrency = self.concurrency
+        pending = {}
+        exhausted = False
+        start = time.time()
+        while not exhausted or pending:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                except Exception:
+                    # Let the writes in flight finish before failing
+                    wait(pending)
+                    raise
+                else:
+                    future = self._executor.submit(_timed, func, item)
+                    pending[future] = (len(results), item)
+                    results.append(None)
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, item = pending.pop(future)
+                try:
+                    results[i], latency = future.result()
+                    latencies.append(latency)
+                except Exception as e:
+                    errors.append((item, e))
+                done += weight(item) if weight else 1
+                if progress is not None:
+                    progress(done, total)
+        with self._lock:
+            self.tasks += len(results)
+            self.errors += len(errors)
+        if latencies:
+            self._tune(len(results), concurrency, time.time() - start,
+                       sum(latencies) / len(latencies))
+        if errors:
+            raise SaveError(errors)
+        return results
+
+    def _tune(self, count, concurrency, elapsed, latency):
+        """Adjust the concurrency after a call that used all of it"""
+        with self._lock:
+            previous = (self.throughput, self.latency)
+            self.throughput = count / max(elapsed, 1e-6)
+            self.latency = latency
+            if not self.adaptive or count < concurrency:
+                return
+            if previous[0] is not None and (
+                    self.throughput < previous[0] * 0.95 or
+                    (self.throughput < previous[0] * 1.05 and latency > previous[1] * 1.5)):
+                self._direction = -self._direction
+            step = max(1, self.concurrency // 4)
+            adjusted = self.concurrency + self._direction * step
+            self.concurrency = min(self.max_workers, max(self.min_workers, adjusted))
+            if self.concurrency != adjusted:
+                # Bounce back from the limits
+                self._direction = -self._direction
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.max_workers, 'concurrency': self.concurrency,
+                    'throughput': self.throughput, 'latency': self.latency,
+                    'tasks': self.tasks, 'errors': self.errors}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class Metrics(object):
+    """Latency histograms, error counts and bytes transferred by operation"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation, seconds, error=False, sent=0, received=0):
+        with self._lock:
+            m = self._operations.get(operation)
+            if m is None:
+                m = self._operations[operation] = {
+                    'count': 0, 'errors': 0, 'seconds': 0.0, 'sent': 0, 'received': 0,
+                    'buckets': [0] * (len(self.buckets) + 1)}
+            m['count'] += 1
+            m['errors'] += 1 if error else 0
+            m['seconds'] += seconds
+            m['sent'] += sent
+            m['received'] += received
+            m['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def stats(self):
+        """Return a snapshot of the metrics of each operation
+
+        The histogram is a list of (upper bound, cumulative count) pairs
+        like the prometheus ones.
+        """
+        with self._lock:
+            stats = {}
+            for operation, m in self._operations.items():
+                stats[operation] = dict(m, buckets=self._cumulative(m['buckets']))
+            return stats
+
+    def _cumulative(self, counts):
+        total, histogram = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            histogram.append((bound, total))
+        return histogram
+
+    def prometheus(self):
+        """Return the metrics in the prometheus text exposition format"""
+        stats = self.stats()
+        lines = ['# HELP registry_operation_seconds Latency of the registry operations',
+                 '# TYPE registry_operation_seconds histogram']
+        for operation in sorted(stats):
+            m = stats[operation]
+            for bound, count in m['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('registry_operation_seconds_bucket{{operation="{}",le="{}"}} {}'
+                             .format(operation, le, count))
+            lines.append('registry_operation_seconds_sum{{operation="{}"}} {}'
+                         .format(operation, repr(m['seconds'])))
+            lines.append('registry_operation_seconds_count{{operation="{}"}} {}'
+                         .format(operation, m['count']))
+        for name, field, description in (
+                ('errors', 'errors', 'Operations that raised an error'),
+                ('sent_bytes', 'sent', 'Bytes sent to the k/v store'),
+                ('received_bytes', 'received', 'Bytes received from the k/v store')):
+            lines.append('# HELP registry_{}_total {}'.format(name, description))
+            lines.append('# TYPE registry_{}_total counter'.format(name))
+            for operation in sorted(stats):
+                lines.append('registry_{}_total{{operation="{}"}} {}'
+                             .format(name, operation, stats[operation][field]))
+        return '\n'.join(lines) + '\n'
+
+
+def _measured(operation=None):
+    """Decorator that records the latency and errors of a function
+
+    It only adds a global lookup when the metrics are disabled.
+    """
+    def decorator(func):
+        name = operation or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = _metrics
+            if metrics is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                metrics.observe(name, time.time() - start, error=True)
+                raise
+            metrics.observe(name, time.time() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+def _timed(func, item):
+    """Call func(item) returning its result and the time it took"""
+    start = time.time()
+    result = func(item)
+    return result, time.time() - start
+
+
+class Watcher(object):
+    """Long-poll of a subtree of the k/v store shared by its subscribers
+
+    A single thread waits for changes in the subtree using blocking
+    queries and compares each response with the previous one, so the
+    changes made while the subscribers were being notified are coalesced
+    in the next event. Failed requests are retried with exponential
+    backoff and the watcher stops when its last subscriber is cancelled.
+    """
+
+    def __init__(self, dn, wait=WATCH_WAIT, backoff=WATCH_BACKOFF):
+        self.dn = dn.strip('/')
+        self.wait = wait
+        self.backoff = backoff
+        self.index = None
+        self.data = None
+        self.events = 0
+        self.errors = 0
+        self.subscribers = []
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='watch ' + self.dn)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def wait_ready(self, timeout=None):
+        """Wait until the first read of the subtree finished"""
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        delay = 0
+        prefix = None
+        while not self._stopped.is_set():
+            try:
+                if prefix is None:
+                    prefix = _subtree_prefix(self.dn)
+                data, index = _recurse_indexed(prefix, self.index, self.wait)
+            except kvstore.KeyDoesNotExist:
+                # Nothing to block on until the subtree exists
+                data, index = {}, None
+            except Exception:
+                self.errors += 1
+                delay = min(max(delay * 2, self.backoff[0]), self.backoff[1])
+                self._stopped.wait(delay)
+                continue
+            data = _expand_documents(_filter_subtree(data, self.dn), self.dn)
+            if self.index is not None and index is not None and int(index) < int(self.index):
+                # The index went backwards (e.g. the store was restored)
+                index = None
+            changes = self._changes(data)
+            self.data, self.index = data, index
+            self._ready.set()
+            if changes:
+                self._notify(changes)
+            if index is None:
+                delay = min(max(delay * 2, self.backoff[0]), self.backoff[1])
+                self._stopped.wait(delay)
+            else:
+                delay = 0
+
+    def _changes(self, data):
+        """Return the keys that changed since the last read (None if deleted)"""
+        if self.data is None:
+            return {}
+        changes = {k: v for k, v in data.items() if self.data.get(k) != v}
+        changes.update((k, None) for k in self.data if k not in data)
+        return changes
+
+    def _notify(self, changes):
+        self.events += 1
+        for key in changes:
+            _invalidate(key)
+        for subscription in list(self.subscribers):
+            selected = {k: v for k, v in changes.items()
+                        if k == subscription.dn or k.startswith(subscription.dn + '/')}
+            if selected:
+                try:
+                    subscription.callback(selected)
+                except Exception:
+                    self.errors += 1
+
+
+class Subscription(object):
+    """Callback registered with watch(), call cancel() to stop receiving events"""
+
+    def __init__(self, watcher, dn, callback):
+        self.watcher = watcher
+        self.dn = dn
+        self.callback = callback
+
+    def cancel(self):
+        with _watchers_lock:
+            if self in self.watcher.subscribers:
+                self.watcher.subscribers.remove(self)
+            if not self.watcher.subscribers:
+                self.watcher.stop()
+                if _watchers.get(self.watcher.dn) is self.watcher:
+                    del _watchers[self.watcher.dn]
+
+
 # By default create a global kvstore client in localhost
 ENDPOINT = 'http://127.0.0.1:8500/v1/kv'
-_kv = kvstore.Client(ENDPOINT)
+_kv = Client(ENDPOINT)
+# Writers used by save() to send the keys concurrently
+_writers = WriterPool(WRITERS)
+# Client-side read cache, disabled by default (see enable_cache)
+_cache = None
+# Metrics of the operations, disabled by default (see enable_metrics)
+_metrics = None
+# Watchers of the subtrees with subscribers by DN (see watch)
+_watchers = {}
+_watchers_lock = threading.Lock()
+# Per-thread state: active write batch
+_local = threading.local()
+# Shared jinja2 environment and compiled templates by (product DN, revision)
+_jinja = jinja2.Environment()
+_templates = LRUCache(maxsize=128)
+# Metadata of the products used by instantiate() by product DN
+_products = LRUCache(maxsize=256)
+# Layout of the clusters and time it was checked by cluster DN
+_layouts = LRUCache(maxsize=4096)
+
+
+def connect(endpoint='http://127.0.0.1:8500/v1/kv', pool_size=None, timeout=TIMEOUT,
+            adaptive=True):
+    """Configure a new connection to the registry
+
+    The endpoint is the URL of the consul k/v API or, to use the embedded
+    store (see LocalClient), local:///path/to/registry.db to persist the
+    data in a SQLite database or local:// to keep it only in memory.
+
+    - pool_size: number of keep-alive connections to the k/v store, it
+        also sets the maximum number of concurrent writers used by save()
+    - timeout: (connect, read) timeouts of the requests in seconds
+    - adaptive: tune the number of concurrent writers to the observed
+        throughput and latency of the endpoint
+
+    The connections of the previous client (or its database) are closed.
+    """
+    global _kv, _writers
+    pool_size = pool_size or WRITERS
+    previous = _kv
+    if endpoint.startswith('local:'):
+        _kv = LocalClient(re.sub(r'^local:(//)?', '', endpoint) or None)
+    else:
+        _kv = Client(endpoint, pool_size, timeout)
+    if hasattr(previous, 'close'):
+        previous.close()
+    _writers.shutdown(wait=False)
+    _writers = WriterPool(pool_size, adaptive=adaptive)
+    _products.clear()
+    _layouts.clear()
+    if _cache is not None:
+        _cache.clear()
+
+
+def close():
+    """Close the connections to the registry (or its SQLite database)"""
+    if hasattr(_kv, 'close'):
+        _kv.close()
+
+
+def pool_stats():
+    """Return the statistics of the connection pool to the k/v store"""
+    if not hasattr(_kv, 'pool_stats'):
+        return None
+    return _kv.pool_stats()
 
 
-def connect(endpoint='http://127.0.0.1:8500/v1/kv'):
-    """Configure a new connection to the registry"""
-    ENDPOINT = endpoint
-    global _kv
-    _kv = kvstore.Client(ENDPOINT)
+def writer_stats():
+    """Return the statistics of the writers used by save()"""
+    return _writers.stats()
 
 
+def configure_templates(maxsize=128, bytecode_cache_dir=None):
+    """Configure the cache of compiled product templates
+
+    - maxsize: maximum number of compiled templates kept in memory
+    - bytecode_cache_dir: directory where the compiled templates are
+        stored so they survive restarts (disabled by default)
+    """
+    global _jinja, _templates
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    _jinja = jinja2.Environment(bytecode_cache=bytecode_cache)
+    _templates = LRUCache(maxsize)
+
+
+def enable_cache(maxsize=1024, ttl=5, ttls=None, revalidate=False):
+    """Enable the client-side read cache used by the proxies
+
+    - maxsize: maximum number of cached keys
+    - ttl: default time to live of the entries in seconds
+    - ttls: a dict with the ttl to use for given key prefixes,
+        e.g. {'products/': 300}
+    - revalidate: check the X-Consul-Index of expired entries to
+        avoid retrieving again values that did not change
+    """
+    global _cache
+    _cache = ReadCache(maxsize, ttl, ttls, revalidate)
+
+
+def disable_cache():
+    """Disable the client-side read cache"""
+    global _cache
+    _cache = None
+
+
+def cache_stats():
+    """Return the read cache counters or None if it is disabled"""
+    if _cache is None:
+        return None
+    return _cache.stats()
+
+
+def enable_metrics(buckets=METRICS_BUCKETS):
+    """Record the latency, errors and bytes transferred of the operations
+
+    The public API functions, proxy reads and writes and collections are
+    recorded by name (e.g. instantiate, proxy_read, Cluster.nodes) and
+    each HTTP request to the k/v store as kv_<method> or kv_txn.
+    """
+    global _metrics
+    _metrics = Metrics(buckets)
+
+
+def disable_metrics():
+    """Stop recording metrics"""
+    global _metrics
+    _metrics = None
+
+
+def stats():
+    """Return a snapshot of the metrics by operation or None if disabled
+
+    Each operation contains count, errors, seconds (total), sent and
+    received (bytes) and buckets, the cumulative latency histogram.
+    """
+    if _metrics is None:
+        return None
+    return _metrics.stats()
+
+
+def prometheus_metrics():
+    """Return the metrics in the prometheus text format ('' if disabled)"""
+    if _metrics is None:
+        return ''
+    return _metrics.prometheus()
+
+
+def watch(dn, callback):
+    """Call callback(changes) each time the subtree of dn changes
+
+    changes is a dict with the new values of the keys that changed, None
+    for the deleted ones. The subtrees are watched using blocking queries
+    and all the subscriptions to a subtree, or to a DN inside an already
+    watched subtree, share a single request. The callbacks are called
+    from the thread of the watcher. Returns a Subscription, call its
+    cancel() method to stop watching.
+    """
+    dn = dn.strip('/')
+    with _watchers_lock:
+        watcher = None
+        for watched in sorted(_watchers, key=len):
+            if dn == watched or dn.startswith(watched + '/'):
+                watcher = _watchers[watched]
+                break
+        if watcher is None:
+            watcher = _watchers[dn] = Watcher(dn).start()
+        subscription = Subscription(watcher, dn, callback)
+        watcher.subscribers.append(subscription)
+    return subscription
+
+
+@_measured()
 def register(name, version, description,
              template='', options='', orchestrator='',
-             templatetype='json+jinja2', logo_url=''):
+             templatetype='json+jinja2', logo_url='', layout=LAYOUT_KEYS):
     """Register a new product
 
        A product includes:
@@ -40,69 +1098,922 @@ def register(name, version, description,
             stop, and restart
          - tempatetype: json+jinja2 or yaml+jinja2
          - logo_url: a url with the product logo
+         - layout: how the instances are stored, keys (one key per
+            attribute) or document (one JSON document per node, service
+            and cluster, fewer keys and round trips)
     """
     dn = '{}/{}/{}'.format(TMPLPREFIX, name, version)
-    _kv.set('{}/name'.format(dn), name)
-    _kv.set('{}/version'.format(dn), version)
-    _kv.set('{}/description'.format(dn), description)
-    _kv.set('{}/template'.format(dn), template)
-    _kv.set('{}/templatetype'.format(dn), templatetype)
-    _kv.set('{}/options'.format(dn), options)
-    _kv.set('{}/orchestrator'.format(dn), orchestrator)
-    _kv.set('{}/logo_url'.format(dn), logo_url)
+    kvinfo = _product_kvinfo(dn, name, version, description, template,
+                             options, orchestrator, templatetype, logo_url, layout)
+    for k, v in kvinfo.items():
+        _kv.set(k, v)
+    # Remove the previous version of the fields stored the other way
+    for k in _stale_blob_keys(dn, kvinfo):
+        _kv.delete(k)
+        _invalidate(k)
+    _products.invalidate(dn)
+    _update_catalog(dn, _catalog_entry(version, description, logo_url))
     return Product(dn)
 
 
+def _product_kvinfo(dn, name, version, description, template, options,
+                    orchestrator, templatetype, logo_url, layout=LAYOUT_KEYS):
+    """Get the keys and values that store a product"""
+    if layout not in LAYOUTS:
+        raise ValueError('Unsupported layout: {}'.format(layout))
+    kvinfo = OrderedDict()
+    kvinfo['{}/name'.format(dn)] = name
+    kvinfo['{}/version'.format(dn)] = version
+    kvinfo['{}/description'.format(dn)] = description
+    kvinfo.update(_blob_kvinfo(dn, 'template', template))
+    kvinfo['{}/templatetype'.format(dn)] = templatetype
+    kvinfo.update(_blob_kvinfo(dn, 'options', options))
+    kvinfo.update(_blob_kvinfo(dn, 'orchestrator', orchestrator))
+    kvinfo['{}/logo_url'.format(dn)] = logo_url
+    kvinfo['{}/layout'.format(dn)] = layout
+    return kvinfo
+
+
+def _blob_kvinfo(dn, name, value):
+    """Get the keys that store a large product field
+
+    Values of BLOB_THRESHOLD bytes or more are compressed with zlib and
+    stored base64 encoded in chunks of BLOB_CHUNK_SIZE below
+    <dn>/<name>.blob, together with the number of chunks and the SHA-256
+    of the value. Smaller values are stored as is in <dn>/<name>.
+    """
+    data = _encode(value)
+    if len(data) < BLOB_THRESHOLD:
+        return [('{}/{}'.format(dn, name), value)]
+    encoded = _to_str(base64.b64encode(zlib.compress(data, 9)))
+    chunks = [encoded[i:i + BLOB_CHUNK_SIZE]
+              for i in range(0, len(encoded), BLOB_CHUNK_SIZE)]
+    prefix = '{}/{}.blob'.format(dn, name)
+    kvinfo = [('{}/{:05d}'.format(prefix, i), c) for i, c in enumerate(chunks)]
+    kvinfo.append(('{}/chunks'.format(prefix), str(len(chunks))))
+    kvinfo.append(('{}/sha256'.format(prefix), hashlib.sha256(data).hexdigest()))
+    return kvinfo
+
+
+def _stale_blob_keys(dn, kvinfo):
+    """Keys of the large product fields not written with kvinfo
+
+    They are the plain keys of the fields now compressed, and the chunks
+    of the fields now stored as is or with fewer chunks.
+    """
+    stale = []
+    for name in BLOB_FIELDS:
+        key = '{}/{}'.format(dn, name)
+        try:
+            stale.extend(k for k in _keys(key + '.blob/') if k not in kvinfo)
+        except kvstore.KeyDoesNotExist:
+            pass
+        if key not in kvinfo:
+            stale.append(key)
+    return stale
+
+
+def _decode_blob(name, parts):
+    """Get the value of a compressed field from its keys below <name>.blob
+
+    parts maps the keys relative to <name>.blob to their values.
+    """
+    try:
+        count, digest = int(parts['chunks']), _to_str(parts['sha256'])
+        encoded = ''.join(_to_str(parts['{:05d}'.format(i)]) for i in range(count))
+        data = zlib.decompress(base64.b64decode(encoded))
+    except (KeyError, ValueError, TypeError, binascii.Error, zlib.error) as e:
+        raise CorruptedBlobError('{}: {}'.format(name, e))
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise CorruptedBlobError('{}: checksum mismatch'.format(name))
+    return _to_str(data)
+
+
+def _read_blob(key, recurse):
+    """Read a product field stored with _blob_kvinfo
+
+    recurse is the function used to read the subtree of the chunks.
+    """
+    prefix = key + '.blob/'
+    subtree = recurse(prefix)
+    parts = {k[len(prefix):]: v for k, v in subtree.items() if k.startswith(prefix)}
+    return _decode_blob(key, parts)
+
+
+@_measured()
 def deregister(name, version):
     """Deregister a given service template"""
     dn = '{}/{}/{}'.format(TMPLPREFIX, name, version)
-    _kv.delete(dn, recursive=True)
+    # With a trailing slash the prefix does not match version 1.0 for 1
+    _kv.delete(dn + '/', recursive=True)
+    _invalidate(dn + '/', prefix=True)
+    _products.invalidate(dn)
+    _update_catalog(dn, None)
+
+
+@_measured()
+def instantiate(user=None, product=None, version=None, options=None,
+                stream=False, progress=None, id=None):
+    """Register a new instance using information from the service template
+
+    By default the instance gets a new ID, id allows to use one reserved
+    before with generate_ids(). ClusterAlreadyExistsError is raised if
+    there is already an instance with that ID.
+
+    With stream=True the template is rendered, parsed and flattened
+    incrementally and the keys are written as they are produced, which
+    reduces the memory used by very large clusters and overlaps the
+    rendering with the writes. The JSON templates are only parsed
+    incrementally if ijson is installed. progress is passed to save().
+    """
+    info = _product_info(get_product(product, version).dn)
+    mergedopts = _instance_options(info, options)
+
+    prefix = '{}/{}/{}/{}'.format(PREFIX, user, product, version)
+    if id is None:
+        id = generate_id(prefix)
+    else:
+        _claim_id(prefix, id)
+    dn = '{}/{}'.format(prefix, id)
+
+    _layouts.put(dn, (info.layout, time.time()))
+    if stream:
+        kvinfo = _iter_instance_kvinfo(info, mergedopts, user, product, version, dn)
+        if info.layout == LAYOUT_DOCUMENT:
+            kvinfo = _pack_documents(kvinfo, dn)
+        # The keys are written as they are generated, so a template error
+        # found later on leaves a partial cluster that has to be removed
+        entries = []
+        try:
+            save(_recording_index_entries(kvinfo, entries), progress=progress)
+        except Exception:
+            _apply([('delete', k) for k in entries] + [('delete-tree', dn + '/')])
+            _layouts.invalidate(dn)
+            raise
+    else:
+        kvinfo = _instance_kvinfo(info, mergedopts, user, product, version, dn)
+        if info.layout == LAYOUT_DOCUMENT:
+            kvinfo = dict(_pack_documents(sorted(kvinfo.items()), dn))
+        save(kvinfo, progress=progress)
+    return Cluster(dn)
 
 
-def instantiate(user=None, product=None, version=None, options=None):
-    """Register a new instance using information from the service template"""
-    product_proxy = get_product(product, version)
-    templateopts = json.loads(product_proxy.options)
-    if not valid(options, templateopts):
+def _recording_index_entries(pairs, entries):
+    """Pass the (key, value) pairs through appending the index keys to entries"""
+    for k, v in pairs:
+        if k.startswith(INDEXPREFIX + '/'):
+            entries.append(k)
+        yield k, v
+
+
+def _instance_options(info, options):
+    """Validate the options of a new instance and merge the defaults"""
+    if not valid(options, info.options):
         raise InvalidOptionsError()
 
-    mergedopts = _merge(templateopts)
+    mergedopts = dict(info.defaults)
     mergedopts.update(options)
+    return mergedopts
 
-    prefix = '{}/{}/{}/{}'.format(PREFIX, user, product, version)
-    id = generate_id(prefix)
-    dn = '{}/{}'.format(prefix, id)
 
-    t = jinja2.Template(product_proxy.template)
+def _instance_kvinfo(info, mergedopts, user, product, version, dn):
+    """Render the product template and get the keys of the new instance
+
+    The result includes the secondary index entries of the nodes.
+    """
+    t = _compile_template(info.dn, info.template, info.revision)
     rendered = t.render(opts=mergedopts, user=user, product=product, version=version,
                         clusterdn=dn, clusterid=id_from(dn))
-    if product_proxy.templatetype == 'json+jinja2':
+    if info.templatetype == 'json+jinja2':
         data = json.loads(rendered)
-    elif product_proxy.templatetype == 'yaml+jinja2':
-        data = yaml.load(rendered)
+    elif info.templatetype == 'yaml+jinja2':
+        data = yaml.safe_load(rendered)
     else:
-        raise UnsupportedTemplateFormatError('type: {}'.format(product_proxy.templatetype))
+        raise UnsupportedTemplateFormatError('type: {}'.format(info.templatetype))
 
     kvinfo = {}
     _populate(kvinfo, using=data, prefix=dn)
-    save(kvinfo)
-    return Cluster(dn)
+    kvinfo.update((k, '') for k in _index_entries(kvinfo))
+    return kvinfo
+
 
+def _iter_instance_kvinfo(info, mergedopts, user, product, version, dn):
+    """Generator version of _instance_kvinfo
 
+    The template is rendered in chunks that are parsed and flattened
+    as they are generated (YAML documents and JSON documents without
+    ijson are parsed at once).
+    """
+    t = _compile_template(info.dn, info.template, info.revision)
+    chunks = t.generate(opts=mergedopts, user=user, product=product, version=version,
+                        clusterdn=dn, clusterid=id_from(dn))
+    if info.templatetype == 'json+jinja2':
+        if ijson is not None:
+            pairs = _iter_populate_events(ijson.parse(_ChunkReader(chunks)), prefix=dn)
+        else:
+            pairs = _iter_populate(json.loads(''.join(chunks)), prefix=dn)
+    elif info.templatetype == 'yaml+jinja2':
+        pairs = _iter_populate(yaml.safe_load(_ChunkReader(chunks)), prefix=dn)
+    else:
+        raise UnsupportedTemplateFormatError('type: {}'.format(info.templatetype))
+
+    for k, v in pairs:
+        yield k, v
+        for entry in _key_index_entries(k, v):
+            yield entry, ''
+
+
+class _ChunkReader(object):
+    """File-like object that reads the chunks generated by a template"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += _encode(next(self._chunks))
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _product_info(dn):
+    """Get the metadata of a product reusing the cached one
+
+    The cached metadata is used without any request during
+    PRODUCT_CHECK_INTERVAL seconds, after that it is used only if the
+    index of the product subtree in the k/v store did not change.
+    """
+    info = _products.get(dn)
+    now = time.time()
+    if info is not None:
+        if now - info.checked < PRODUCT_CHECK_INTERVAL:
+            return info
+        if info.index is not None and _kv.index(dn + '/', recursive=True) == info.index:
+            info.checked = now
+            return info
+    try:
+        # Other versions sharing the prefix (e.g. 1.0 for 1) are not read
+        subtree, index = _recurse_indexed(dn + '/')
+    except kvstore.KeyDoesNotExist as e:
+        raise KeyDoesNotExist(str(e))
+    info = ProductInfo.from_subtree(dn, subtree, index)
+    _products.put(dn, info)
+    return info
+
+
+def _compile_template(dn, source, revision=None):
+    """Get the compiled template of a product reusing the cached ones
+
+    Templates are identified by the product DN and the revision of
+    the template, the hash of its source by default, so a new
+    registration of the product invalidates them.
+    """
+    if revision is None:
+        revision = _template_revision(source)
+    key = (dn, revision)
+    template = _templates.get(key)
+    if template is None:
+        template = _load_template(dn, source)
+        _templates.put(key, template)
+    return template
+
+
+def _template_revision(source):
+    """Return the revision that identifies a template source"""
+    return hashlib.sha1(_encode(source)).hexdigest()
+
+
+def _load_template(name, source):
+    """Compile a template using the bytecode cache if configured"""
+    bytecode_cache = _jinja.bytecode_cache
+    if bytecode_cache is None:
+        return _jinja.from_string(source)
+    bucket = bytecode_cache.get_bucket(_jinja, name, None, source)
+    if bucket.code is None:
+        bucket.code = _jinja.compile(source, name)
+        bytecode_cache.set_bucket(bucket)
+    return _jinja.template_class.from_code(
+        _jinja, bucket.code, _jinja.make_globals(None))
+
+
+@_measured()
 def deinstantiate(user, framework, flavour, instanceid):
     """Deinstantiate (remove) a given cluster instance"""
     dn = '{}/{}/{}/{}/{}'.format(PREFIX, user, framework, flavour, instanceid)
-    _kv.delete(dn, recursive=True)
+    # With a trailing slash the prefix does not match cluster 10 for cluster 1
+    try:
+        entries = _index_entries(_expand_documents(_kv.recurse(dn + '/'), dn))
+    except kvstore.KeyDoesNotExist:
+        entries = []
+    _apply([('delete', k) for k in entries])
+    _apply([('delete-tree', dn + '/')])
+    _layouts.invalidate(dn)
 
 
-def save(kvinfo):
-    """Save kvinfo in the k/v store"""
-    # Parallel version
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        [executor.submit(_kv.set, k, v) for k, v in kvinfo.items()]
-    # Sequential version
-    #for k, v in kvinfo.items():
-        #_kv.set(k, v)
+@_measured()
+def clone_cluster(src_dn, user=None, id=None, progress=None):
+    """Copy a cluster instance into a new one and return it
+
+    The source cluster is read with a single recursive fetch and written
+    with bulk transactions (see save()). The DN of the source and its ID
+    as generated by id_from (e.g. the clusterdn and clusterid of the
+    templates) are replaced in the values too. By default the copy
+    belongs to the same user and gets the next free ID of its prefix.
+    """
+    src_dn = src_dn.strip('/')
+    if not src_dn.startswith(PREFIX + '/'):
+        src_dn = '{}/{}'.format(PREFIX, src_dn)
+    src_user, product, version = src_dn.split('/')[1:4]
+    prefix = '{}/{}/{}/{}'.format(PREFIX, user or src_user, product, version)
+    try:
+        subtree = _kv.recurse(src_dn + '/')
+    except kvstore.KeyDoesNotExist as e:
+        raise KeyDoesNotExist(str(e))
+    if id is None:
+        id = generate_id(prefix)
+    else:
+        _claim_id(prefix, id)
+    dn = '{}/{}'.format(prefix, id)
+    kvinfo = _clone_kvinfo(subtree, src_dn, dn)
+    kvinfo.update((k, '') for k in _index_entries(_expand_documents(kvinfo, dn)))
+    save(kvinfo, progress=progress)
+    return Cluster(dn)
+
+
+@_measured()
+def export(prefix, fileobj, compress=True):
+    """Write the keys below prefix (e.g. clusters or products) to fileobj
+
+    Each line of the output is a JSON [key, value] record, compressed with
+    gzip by default. The tree is read a cluster, a product version or, for
+    other prefixes, a child of the prefix at a time, so it is never held
+    in memory as a whole. fileobj must be opened in binary mode. Returns
+    the number of keys written, see import_() to load them back.
+    """
+    output = fileobj
+    if compress:
+        output = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+    prefix = prefix.strip('/')
+    fields = prefix.split('/')
+    if fields[0] == PREFIX:
+        depth = CLUSTER_DEPTH + 1 - len(fields)
+    elif fields[0] == TMPLPREFIX:
+        depth = 3 - len(fields)
+    else:
+        depth = 2 - len(fields)
+    count = 0
+    try:
+        for lines in _ibatches(_iter_export(prefix, depth), 1024):
+            output.write(_encode(''.join(json.dumps([k, v]) + '\n' for k, v in lines)))
+            count += len(lines)
+    finally:
+        if compress:
+            output.close()
+    return count
+
+
+def _iter_export(dn, depth):
+    """Generate the (key, value) pairs below dn reading a subtree at a time
+
+    The subtrees depth levels below dn are read with a recursive read and
+    the levels above them with keys-only listings.
+    """
+    if depth <= 0:
+        try:
+            # Siblings like dn0 would also match a prefix without separator
+            subtree = _kv.recurse(dn + '/')
+        except kvstore.KeyDoesNotExist:
+            return
+        for k in sorted(subtree):
+            yield k, _value_str(subtree[k])
+        return
+    try:
+        keys = _keys(dn + '/', separator='/')
+    except kvstore.KeyDoesNotExist:
+        return
+    for k in keys:
+        if k.endswith('/') and k != dn + '/':
+            for pair in _iter_export(k.rstrip('/'), depth - 1):
+                yield pair
+        else:
+            try:
+                yield k, _value_str(_kv.get(k))
+            except kvstore.KeyDoesNotExist:
+                pass
+
+
+def _value_str(value):
+    """Convert a value read from the k/v store to a string (keeping None)"""
+    return value if value is None else _to_str(value)
+
+
+@_measured()
+def import_(fileobj, compressed=True, writers=None, progress=None):
+    """Load the keys written by export() from fileobj
+
+    The records are read and written as a stream of bulk transactions
+    (see save()) adding the secondary indexes of the nodes. writers sets
+    the number of concurrent writers to use instead of the shared pool.
+    The ID counters are moved past the IDs of the imported clusters and
+    the catalog is rebuilt if products are imported.
+    Returns the number of keys read.
+    """
+    if compressed:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    records = [0]
+    last_ids = {}
+    products = [False]
+
+    def operations():
+        for line in fileobj:
+            if not line.strip():
+                continue
+            k, v = json.loads(_to_str(line))
+            k, v = _to_str(k), '' if v is None else _to_str(v)
+            records[0] += 1
+            parts = k.split('/')
+            if parts[0] == TMPLPREFIX:
+                products[0] = True
+            if parts[0] == PREFIX and len(parts) > CLUSTER_DEPTH:
+                prefix, id = '/'.join(parts[:CLUSTER_DEPTH]), parts[CLUSTER_DEPTH]
+                if id.isdigit():
+                    last_ids[prefix] = max(last_ids.get(prefix, 0), int(id))
+            yield ('set', k, v)
+            for entry in _record_index_entries(k, v):
+                yield ('set', entry, '')
+    pool = WriterPool(writers, adaptive=False) if writers else None
+    try:
+        _apply_stream(operations(), progress=progress, writers=pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    # Without counter the next ID is taken from a scan of the prefix
+    for prefix, last in last_ids.items():
+        if hasattr(_kv, 'cas') and _exists(_counter_key(prefix)):
+            _seed_counter(prefix, last)
+    if products[0]:
+        rebuild_catalog()
+    _products.clear()
+    return records[0]
+
+
+def _record_index_entries(k, v):
+    """Get the index keys of an exported key, which can be a node document"""
+    if _NODE_DOCUMENT.match(k) and v.startswith('{'):
+        entries = []
+        for field, value in _load_document(v).items():
+            entries.extend(_key_index_entries('{}/{}'.format(k, field), value))
+        return entries
+    return _key_index_entries(k, v)
+
+
+def _clone_kvinfo(subtree, src_dn, dn):
+    """Move the keys of subtree from src_dn to dn replacing also the values"""
+    # The DN or ID must not be followed by more characters of a name,
+    # e.g. the DN of cluster 1 must not match the one of cluster 10
+    replacements = [(re.compile(re.escape(old) + r'(?!\w)'), new)
+                    for old, new in ((src_dn, dn), (id_from(src_dn), id_from(dn)))]
+    kvinfo = {}
+    for k, v in subtree.items():
+        if k != src_dn and not k.startswith(src_dn + '/'):
+            continue
+        if isinstance(v, (str, unicode)):
+            for pattern, new in replacements:
+                v = pattern.sub(new, v)
+        kvinfo[dn + k[len(src_dn):]] = v
+    return kvinfo
+
+
+@_measured()
+def save(kvinfo, transactional=True, progress=None):
+    """Save kvinfo in the k/v store
+
+    When the store supports transactions the keys are grouped in batches
+    of TXN_MAX_OPS operations that are sent concurrently, each batch being
+    applied atomically. Otherwise one request per key is issued.
+
+    kvinfo can also be an iterable of (key, value) pairs, e.g. a
+    generator: the batches are written while the next ones are produced.
+
+    The writes that fail are raised together as a SaveError once all the
+    others were sent. progress(saved, total) is called as the keys are
+    saved, useful to report the progress of very large clusters.
+    """
+    if isinstance(kvinfo, dict):
+        _apply([('set', k, v) for k, v in kvinfo.items()], transactional, progress)
+    else:
+        _apply_stream((('set', k, v) for k, v in kvinfo), transactional, progress)
+
+
+def _apply(operations, transactional=True, progress=None):
+    """Apply a list of (verb, key[, value]) operations, see save()"""
+    try:
+        if transactional and _supports_txn():
+            _apply_txn(operations, progress)
+        else:
+            _apply_keys(operations, progress)
+    finally:
+        for op in operations:
+            _invalidate(op[1], prefix=(op[0] == 'delete-tree'))
+
+
+def _apply_txn(operations, progress=None):
+    """Apply operations using concurrent transactions of TXN_MAX_OPS"""
+    _writers.run(_txn, _batches(operations, TXN_MAX_OPS), progress, weight=len)
+
+
+def _apply_keys(operations, progress=None):
+    """Apply operations issuing one request per key"""
+    _writers.run(_apply_one, operations, progress)
+
+
+def _apply_stream(operations, transactional=True, progress=None, writers=None):
+    """Apply the operations of an iterable while it is being consumed"""
+    size = TXN_MAX_OPS if transactional and _supports_txn() else 1
+    writers = writers or _writers
+    writers.run(_apply_batch, _stream_batches(operations, size), progress, weight=len)
+
+
+def _stream_batches(operations, size):
+    """Group operations in batches of size, each blob chunk in its own
+
+    A few chunks of BLOB_CHUNK_SIZE would already exceed the size limit of
+    a consul transaction, so they are written one key at a time.
+    """
+    batch = []
+    for op in operations:
+        if _BLOB_CHUNK.search(op[1]):
+            yield [op]
+            continue
+        batch.append(op)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _apply_batch(operations):
+    """Apply a batch of operations in one transaction (or a single one)"""
+    if len(operations) == 1 and (not _supports_txn() or _BLOB_CHUNK.search(operations[0][1])):
+        _apply_one(operations[0])
+    else:
+        _txn(operations)
+    for op in operations:
+        _invalidate(op[1], prefix=(op[0] == 'delete-tree'))
+
+
+def _apply_one(operation):
+    """Apply a single operation using the basic k/v store interface"""
+    verb, key = operation[0], operation[1]
+    if verb == 'set':
+        _kv.set(key, operation[2])
+    elif verb == 'delete':
+        _kv.delete(key)
+    elif verb == 'delete-tree':
+        _kv.delete(key, recursive=True)
+    elif verb == 'cas':
+        if not _kv.cas(key, operation[2], operation[3]):
+            raise TransactionError('Index of {} is stale'.format(key))
+    else:
+        raise TransactionError('Unsupported operation: {}'.format(verb))
+
+
+def _txn(operations):
+    """Apply operations in one transaction
+
+    If the store turns out not to support transactions they are applied
+    one by one, as the next writes will be (see _supports_txn()).
+    """
+    try:
+        _kv.txn(operations)
+    except TransactionsNotSupportedError:
+        for op in operations:
+            _apply_one(op)
+
+
+@_measured('proxy_write')
+def _write(operations):
+    """Apply a few operations atomically if the store supports it
+
+    The operations are buffered if there is an active batch.
+    """
+    current = _current_batch()
+    if current is not None:
+        for op in operations:
+            if op[0] == 'set':
+                current.set(op[1], op[2])
+            else:
+                current.delete(op[1])
+        return
+    _apply_layout(operations, _apply_atomic)
+
+
+def _apply_atomic(operations):
+    """Apply a few operations in one transaction if supported"""
+    if _supports_txn():
+        _txn(operations)
+    else:
+        for op in operations:
+            _apply_one(op)
+    for op in operations:
+        _invalidate(op[1])
+
+
+def _apply_layout(operations, apply):
+    """Apply operations on the keys of the proxies for any cluster layout
+
+    The operations on the clusters with the document layout are replaced
+    by check-and-set updates of their documents, which are retried if the
+    documents were modified concurrently.
+    """
+    for attempt in range(DOCUMENT_RETRIES):
+        physical, updated = _document_operations(operations)
+        try:
+            apply(physical)
+            return
+        except (TransactionError, SaveError):
+            if not updated or attempt == DOCUMENT_RETRIES - 1:
+                raise
+
+
+def _document_operations(operations):
+    """Convert the operations on clusters with the document layout
+
+    Returns the operations to apply and whether any document is updated.
+    """
+    physical, changes = _split_document_operations(operations, _key_layout)
+    for dockey, fields in changes.items():
+        try:
+            value, index = _get_indexed(dockey)
+        except kvstore.KeyDoesNotExist:
+            value, index = None, 0
+        physical.append(_document_update(dockey, value, index, fields, _supports_txn()))
+    return physical, bool(changes)
+
+
+def _split_document_operations(operations, layout):
+    """Separate the operations on keys stored in documents
+
+    layout is a function that returns the layout of the cluster of a key.
+    Returns the rest of the operations and the (field, value) changes of
+    each document, with _DELETED as value of the deleted fields.
+    """
+    physical, changes = [], OrderedDict()
+    for op in operations:
+        if op[0] in ('set', 'delete') and layout(op[1]) == LAYOUT_DOCUMENT:
+            dockey, field = _document_key(op[1])
+            value = op[2] if op[0] == 'set' else _DELETED
+            changes.setdefault(dockey, []).append((field, value))
+        else:
+            physical.append(op)
+    return physical, changes
+
+
+def _document_update(dockey, value, index, fields, cas=True):
+    """Operation that applies the changes of fields to a document
+
+    value and index are the ones read of the document (None and 0 if it
+    does not exist), with cas the document is only written if its index
+    did not change.
+    """
+    document = {} if value is None else _load_document(value)
+    for field, value in fields:
+        if value is _DELETED:
+            document.pop(field, None)
+        else:
+            document[field] = _to_str(value)
+    if cas and index is not None:
+        return ('cas', dockey, _dump_document(document), index)
+    return ('set', dockey, _dump_document(document))
+
+
+def _get(key):
+    """Get the value of a key going through the read cache if enabled
+
+    The keys of the clusters with the document layout are read from the
+    document that contains them.
+    """
+    current = _current_batch()
+    if current is not None and key in current.pending:
+        value = current.pending[key]
+        if value is _DELETED:
+            raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+        return value
+    layout = _key_layout(key, fetch=False)
+    if layout == LAYOUT_DOCUMENT:
+        return _get_field(key)
+    try:
+        return _get_key(key)
+    except kvstore.KeyDoesNotExist:
+        # The layout is only looked up when the key is not found
+        if layout is None and _key_layout(key) == LAYOUT_DOCUMENT:
+            return _get_field(key)
+        raise
+
+
+def _get_key(key):
+    """Get the value of a key as stored, see _get"""
+    if _cache is None:
+        return _kv.get(key)
+    return _cache.fetch(key)
+
+
+def _get_field(key):
+    """Get the value of a key of a cluster with the document layout"""
+    dockey, field = _document_key(key)
+    try:
+        document = _load_document(_get_key(dockey))
+    except kvstore.KeyDoesNotExist:
+        document = {}
+    if field not in document:
+        raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+    return document[field]
+
+
+def _list_children(prefix):
+    """List the keys below prefix like _keys(prefix, '/') for any layout"""
+    layout = _key_layout(prefix, fetch=False)
+    if layout != LAYOUT_DOCUMENT:
+        try:
+            return _keys(prefix, separator='/')
+        except kvstore.KeyDoesNotExist:
+            if layout is not None or _key_layout(prefix) != LAYOUT_DOCUMENT:
+                raise
+    if _is_document_collection(prefix):
+        # The nodes and services are documents, i.e. leaves of the listing
+        return [k.rstrip('/') + '/' for k in _keys(prefix, separator='/')]
+    dockey = _document_key(prefix)[0]
+    try:
+        value = _get_key(dockey)
+    except kvstore.KeyDoesNotExist:
+        value = None
+    return _document_children(prefix, value)
+
+
+def _is_document_collection(prefix):
+    """Check if prefix is a collection whose elements are documents"""
+    parts = _CLUSTER_KEY.match(prefix).group(2).split('/')
+    return len(parts) == 2 and parts[0] in _DOCUMENT_COLLECTIONS
+
+
+def _document_children(prefix, value):
+    """List the keys below prefix stored in a document, see _list_children"""
+    dockey, field = _document_key(prefix)
+    base = _CLUSTER_KEY.match(prefix).group(1) if dockey.endswith('/document') else dockey
+    document = {} if value is None else _load_document(value)
+    keys = ['{}/{}'.format(base, f) for f in document if f.startswith(field)]
+    if not keys:
+        raise kvstore.KeyDoesNotExist("Key " + prefix + " does not exist")
+    return _split_keys(keys, prefix, '/')
+
+
+def _set(key, value):
+    """Set the value of a key, buffering it if there is an active batch"""
+    _write([('set', key, value)])
+
+
+def _keys(prefix, separator=None):
+    """List the keys below prefix without retrieving their values if possible"""
+    if hasattr(_kv, 'keys'):
+        return _kv.keys(prefix, separator)
+    return _split_keys(_kv.recurse(prefix).keys(), prefix, separator)
+
+
+def _split_keys(keys, prefix, separator=None):
+    """Emulate a keys-only listing with separator from a list of keys"""
+    if separator:
+        listed = set()
+        for k in keys:
+            position = k.find(separator, len(prefix))
+            listed.add(k if position < 0 else k[:position + 1])
+        keys = listed
+    return sorted(keys)
+
+
+def _get_indexed(key):
+    """Get the value of a key and its index (None if not supported)"""
+    if hasattr(_kv, 'get_indexed'):
+        return _kv.get_indexed(key)
+    return _kv.get(key), None
+
+
+def _recurse_indexed(key, wait_index=None, timeout=WATCH_WAIT):
+    """Get the subtree of a key and its index (None if not supported)
+
+    With wait_index it blocks until the index of the subtree changes or
+    the timeout expires.
+    """
+    if hasattr(_kv, 'recurse_indexed'):
+        if wait_index is not None:
+            return _kv.recurse_indexed(key, wait=True, wait_index=wait_index,
+                                       timeout=timeout)
+        return _kv.recurse_indexed(key)
+    return _kv.recurse(key), None
+
+
+def _invalidate(key, prefix=False):
+    """Remove a key (or all the keys with a given prefix) from the cache"""
+    if _cache is None:
+        return
+    if prefix:
+        _cache.invalidate_prefix(key)
+    else:
+        _cache.invalidate(key)
+
+
+def _supports_txn():
+    """Check if the current k/v store supports transactions
+
+    Consul versions older than 0.7 lack the /v1/txn endpoint, which is
+    detected by the client with the first transaction sent.
+    """
+    return hasattr(_kv, 'txn') and getattr(_kv, 'txn_supported', True)
+
+
+def _batches(items, size):
+    """Split a list of items in consecutive batches of the given size"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _ibatches(items, size):
+    """Group the items of an iterable in lists of the given size"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Marker of the keys deleted in a batch
+_DELETED = object()
+
+
+class Batch(object):
+    """Unit of work that buffers writes until it is flushed
+
+    Repeated writes to the same key are coalesced and the pending values
+    are visible to the reads made from the same thread.
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()
+
+    def set(self, key, value):
+        self.pending[key] = value
+
+    def delete(self, key):
+        self.pending[key] = _DELETED
+
+    def flush(self):
+        """Write the pending values using bulk transactions"""
+        pending, self.pending = self.pending, OrderedDict()
+        if pending:
+            _apply_layout([('delete', k) if v is _DELETED else ('set', k, v)
+                           for k, v in pending.items()], _apply)
+
+    def discard(self):
+        """Forget the pending values"""
+        self.pending = OrderedDict()
+
+
+@contextmanager
+def batch():
+    """Buffer all the writes made in the block and save them on exit
+
+    Writes done through proxies inside the block are not sent to the k/v
+    store until the block finishes, then they are saved using save().
+    If the block raises an exception the pending writes are discarded.
+    Nested blocks join the outermost one.
+
+        with registry.batch():
+            for node in cluster.nodes:
+                node.status = 'running'
+    """
+    current = _current_batch()
+    if current is not None:
+        yield current
+        return
+    current = _local.batch = Batch()
+    try:
+        yield current
+    finally:
+        _local.batch = None
+    current.flush()
+
+
+def _current_batch():
+    """Return the batch active in the current thread (if any)"""
+    return getattr(_local, 'batch', None)
 
 
 def get_product(name=None, version=None, dn=None):
@@ -112,14 +2023,24 @@ def get_product(name=None, version=None, dn=None):
     return Product(dn)
 
 
-def get_cluster(user=None, product=None, version=None, id=None, dn=None):
-    """Get the a cluster instance proxy object"""
+@_measured()
+def get_cluster(user=None, product=None, version=None, id=None, dn=None,
+                snapshot=False):
+    """Get the a cluster instance proxy object
+
+    With snapshot=True the whole cluster is fetched in one request and the
+    returned proxies serve their reads from this in-memory copy.
+    """
     if not dn:
         dn = '{}/{}/{}/{}/{}'.format(PREFIX, user, product, version, id)
+    if snapshot:
+        return Cluster.load(dn)
     return Cluster(dn)
 
 
-def query_clusters(user=None, service=None, version=None):
+@_measured()
+def query_clusters(user=None, service=None, version=None, fields=None, depth=0,
+                   limit=None, start_after=None, reverse=False):
     """Get a list of clusters filtered by user, product and version
 
     The query parameters should be provided hierarquically, for example:
@@ -127,49 +2048,401 @@ def query_clusters(user=None, service=None, version=None):
         query_clusters(user): returns all clusters of the given user
         query_clusters(user, product): given user and product
         query_clusters(user, product, version): given user, product, version
+
+    When fields is given the clusters are returned already serialized as
+    dicts (see Proxy.to_dict), using a single read of the whole subtree.
+    Use fields=True to include the default serializable fields.
+
+    The clusters are sorted by DN (IDs in numeric order) and can be paginated
+    with limit and start_after (the DN of the last cluster of the previous
+    page), see iter_clusters. Paginated queries with fields read each
+    cluster separately instead of the whole subtree.
     """
     try:
-        clusters = _filter_cluster_endpoints(user, service, version)
+        if fields is not None and limit is None and start_after is None:
+            basedn = _cluster_basedn(user, service, version)
+            snapshot = Snapshot(basedn)
+            clusters = _parse_cluster_dns(snapshot.keys())
+            return [Cluster(dn, snapshot=snapshot).to_dict(depth, fields)
+                    for dn in sorted(clusters, key=_dn_sort_key, reverse=reverse)]
+        clusters = _list_cluster_dns(user, service, version, limit,
+                                     start_after, reverse)
+        if fields is not None:
+            return [Cluster(dn).to_dict(depth, fields) for dn in clusters]
         return [get_cluster(dn=dn) for dn in clusters]
     except kvstore.KeyDoesNotExist:
         return None
 
 
-def query_products(product=None, version=None):
-    """Get a list of products that can be filtered by product and version"""
+def iter_clusters(user=None, service=None, version=None, limit=None,
+                  start_after=None, reverse=False):
+    """Iterate lazily over the clusters filtered by user, product and version
+
+    The clusters are listed level by level using keys-only listings with
+    separator, so the requests and the memory used grow with the number of
+    users, products, versions and clusters instead of the number of keys.
+    They are yielded sorted by DN (IDs in numeric order, reversed if
+    reverse is True); pass the DN of the last cluster received as
+    start_after to resume the listing, for example:
+        page = list(iter_clusters(user, limit=100))
+        next_page = list(iter_clusters(user, limit=100, start_after=page[-1].dn))
+    """
+    try:
+        for dn in _list_cluster_dns(user, service, version, limit,
+                                    start_after, reverse):
+            yield Cluster(dn)
+    except kvstore.KeyDoesNotExist:
+        return
+
+
+@_measured()
+def query_products(product=None, version=None, fields=None, catalog=False):
+    """Get a list of products that can be filtered by product and version
+
+    When fields is given the products are returned already serialized as
+    dicts, see query_clusters. With catalog=True they are returned as the
+    dicts of to_dict() read from the summary kept by register() and
+    deregister(), a single small request that does not transfer the
+    templates (see rebuild_catalog).
+    """
+    if catalog:
+        return _filter_catalog(_read_catalog(), product, version)
     try:
+        if fields is not None:
+            basedn = _product_basedn(product, version)
+            snapshot = Snapshot(basedn)
+            products = _parse_product_dns(snapshot.keys())
+            return [Product(dn, snapshot=snapshot).to_dict(fields=fields)
+                    for dn in sorted(products)]
         products = _filter_product_endpoints(product, version)
         return [get_product(dn=dn) for dn in products]
     except kvstore.KeyDoesNotExist:
         return None
 
 
+@_measured()
+def query_nodes(host=None, status=None, tag=None, service=None):
+    """Get the list of nodes with the given host, status, tag and service
+
+    The lookup uses the secondary indexes of the nodes, so each filter
+    costs one keys-only listing. When several filters are given only the
+    nodes matching all of them are returned. For example, the clusters
+    with a failed node are:
+        {node.cluster for node in query_nodes(status='failed')}
+    """
+    filters = [(attr, value) for attr, value in (('host', host),
+                                                 ('status', status),
+                                                 ('tags', tag),
+                                                 ('services', service))
+               if value is not None]
+    if not filters:
+        raise ValueError('At least one filter is required')
+    nodes = None
+    for attr, value in filters:
+        prefix = '{}/{}/{}/'.format(INDEXPREFIX, attr, _index_value(value))
+        try:
+            found = {dn_from(parse_last_field(k)) for k in _keys(prefix)}
+        except kvstore.KeyDoesNotExist:
+            found = set()
+        nodes = found if nodes is None else nodes & found
+    return [Node(dn) for dn in sorted(nodes)]
+
+
+@_measured()
+def verify_indexes():
+    """Compare the secondary indexes with the contents of the registry
+
+    Returns a tuple (missing, stale) with the index keys that should exist
+    but do not and the ones that exist but should not.
+    """
+    try:
+        expected = set(_index_entries(_expand_documents(_kv.recurse(PREFIX), PREFIX)))
+    except kvstore.KeyDoesNotExist:
+        expected = set()
+    try:
+        existing = {k for k in _keys(INDEXPREFIX + '/') if not k.endswith('/')}
+    except kvstore.KeyDoesNotExist:
+        existing = set()
+    return sorted(expected - existing), sorted(existing - expected)
+
+
+@_measured()
+def rebuild_catalog():
+    """Write again the summary of the products used by query_products
+
+    It has to be run once when upgrading a registry registered without
+    catalog. import_() runs it when products are imported.
+    """
+    catalog = _build_catalog()
+    _kv.set(CATALOGKEY, _dump_document(catalog))
+    _invalidate(CATALOGKEY)
+    return len(catalog)
+
+
+def _read_catalog():
+    """Get the summary of the products, built from the products if missing"""
+    try:
+        return json.loads(_to_str(_get(CATALOGKEY)))
+    except kvstore.KeyDoesNotExist:
+        return _build_catalog()
+
+
+def _build_catalog():
+    """Read the summary of the products from the products themselves"""
+    catalog = {}
+    try:
+        products = _filter_product_endpoints()
+    except kvstore.KeyDoesNotExist:
+        return catalog
+    for dn in products:
+        product = Product(dn)
+        catalog[dn] = _catalog_entry(*[product.get(f) for f in Product.__serializable__])
+    return catalog
+
+
+def _catalog_entry(version, description, logo_url):
+    """Summary of a product stored in the catalog"""
+    return {'version': version, 'description': description, 'logo_url': logo_url}
+
+
+def _filter_catalog(catalog, product=None, version=None):
+    """Serialize the products of the catalog matching the filters"""
+    basedn = _product_basedn(product, version)
+    return [dict(catalog[dn], dn=dn, name=parse_next_to_last_field(dn))
+            for dn in sorted(catalog, key=_dn_sort_key)
+            if dn == basedn or dn.startswith(basedn + '/')]
+
+
+def _update_catalog(dn, entry):
+    """Add (or remove if entry is None) a product to the catalog"""
+    while True:
+        try:
+            value, index = _get_indexed(CATALOGKEY)
+            catalog = json.loads(_to_str(value))
+        except kvstore.KeyDoesNotExist:
+            catalog, index = {}, 0
+        value = _catalog_update(catalog, dn, entry)
+        if value is None:
+            return
+        if index is None or not hasattr(_kv, 'cas'):
+            _kv.set(CATALOGKEY, value)
+            break
+        if _kv.cas(CATALOGKEY, value, index):
+            break
+    _invalidate(CATALOGKEY)
+
+
+def _catalog_update(catalog, dn, entry):
+    """Apply a change to the catalog and serialize it (None if unchanged)"""
+    if entry is None:
+        if dn not in catalog:
+            return None
+        del catalog[dn]
+    else:
+        catalog[dn] = entry
+    return _dump_document(catalog)
+
+
+def rebuild_indexes():
+    """Fix the secondary indexes that drifted from the registry contents
+
+    Returns the (missing, stale) index keys that were fixed.
+    """
+    missing, stale = verify_indexes()
+    _apply([('delete', k) for k in stale] + [('set', k, '') for k in missing])
+    return missing, stale
+
+
+class Snapshot(object):
+    """In-memory copy of a subtree of the k/v store
+
+    The subtree is retrieved with a single recursive read and it offers
+    the same read interface as the k/v store client (get and recurse),
+    so proxies can serve their reads from it.
+    """
+
+    def __init__(self, dn, data=None):
+        self.dn = dn.strip('/')
+        if data is None:
+            self.refresh()
+        else:
+            self._load(data)
+
+    def refresh(self):
+        """Retrieve again the subtree from the k/v store"""
+        data = _filter_subtree(_kv.recurse(_subtree_prefix(self.dn)), self.dn)
+        if not data:
+            raise kvstore.KeyDoesNotExist("Key " + self.dn + " does not exist")
+        self._load(_expand_documents(data, self.dn))
+
+    def _load(self, data):
+        self._data = data
+        self._keys = sorted(data)
+
+    def keys(self, prefix=None, separator=None):
+        """List the keys, optionally only the ones below prefix as _keys()"""
+        if prefix is None:
+            return list(self._keys)
+        found = []
+        start = bisect.bisect_left(self._keys, prefix)
+        for k in self._keys[start:]:
+            if not k.startswith(prefix):
+                break
+            found.append(k)
+        if not found:
+            raise kvstore.KeyDoesNotExist("Key " + prefix + " does not exist")
+        return _split_keys(found, prefix, separator)
+
+    def get(self, key):
+        key = key.strip('/')
+        try:
+            return self._data[key]
+        except KeyError:
+            raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+
+    def recurse(self, key):
+        key = key.strip('/')
+        subtree = {}
+        start = bisect.bisect_left(self._keys, key)
+        for k in self._keys[start:]:
+            if not k.startswith(key):
+                break
+            if k == key or k[len(key)] == '/':
+                subtree[k] = self._data[k]
+        if not subtree:
+            raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+        return subtree
+
+    def set(self, key, value):
+        """Update the local copy of the given key"""
+        key = key.strip('/')
+        if key not in self._data:
+            bisect.insort(self._keys, key)
+        self._data[key] = value
+
+
 class Proxy(object):
     """Base class for Proxy objects
 
     Acts as a proxy for the k/v store backend.
 
+    When created with a snapshot all the reads are served from it while
+    writes still go through to the k/v store.
+
     __serializable__ defines the fields to return by to_dict()
     __readonly__ defines read only fields for __setattr__
+    __children__ defines the child collections included by to_dict(depth)
+
+    The child collections (e.g. Cluster.nodes) are listed once per proxy
+    and cached until invalidate() or refresh() are called.
     """
 
     __serializable__ = ()
     __readonly__ = ('dn', 'name')
+    __children__ = ()
 
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, snapshot=None):
         # Avoid infinite recursion reading self._endpoint
         super(Proxy, self).__setattr__('_endpoint', endpoint.rstrip('/'))
+        super(Proxy, self).__setattr__('_snapshot', snapshot)
+        super(Proxy, self).__setattr__('_listings', {})
 
     def __getattr__(self, name):
         try:
-            return _kv.get('{0}/{1}'.format(self._endpoint, name))
+            return self._read('{0}/{1}'.format(self._endpoint, name))
         except kvstore.KeyDoesNotExist as e:
-            raise KeyDoesNotExist(e.message)
+            raise KeyDoesNotExist(str(e))
 
     def __setattr__(self, name, value):
         if name in self.__class__.__readonly__:
             raise ReadOnlyAttributeError(name)
-        _kv.set('{0}/{1}'.format(self._endpoint, name), value)
+        self.set(name, value)
+
+    @_measured('proxy_read')
+    def _read(self, key):
+        """Read a key from the snapshot or through the read cache"""
+        if self._snapshot is not None:
+            return self._snapshot.get(key)
+        return _get(key)
+
+    def _child(self, cls, endpoint):
+        """Create a proxy of the given class sharing this proxy's snapshot"""
+        return cls(endpoint, snapshot=self._snapshot)
+
+    def _children(self, collection):
+        """List the DNs of the immediate children in a collection
+
+        Uses a keys-only listing with '/' as separator, so the attributes
+        of the children are not transferred. Empty collections (or scalar
+        attributes with the same name) have no children.
+        """
+        if collection not in self._listings:
+            prefix = '{}/{}/'.format(self._endpoint, collection)
+            try:
+                if self._snapshot is not None:
+                    keys = self._snapshot.keys(prefix, separator='/')
+                else:
+                    keys = _list_children(prefix)
+            except kvstore.KeyDoesNotExist:
+                keys = []
+            self._listings[collection] = sorted(set(k.rstrip('/') for k in keys if k != prefix))
+        return list(self._listings[collection])
+
+    def invalidate(self):
+        """Forget the cached listings of the child collections"""
+        self._listings.clear()
+
+    def wait_for(self, name, value, timeout=None):
+        """Wait until an attribute has the given value
+
+        value can also be a function that receives the value of the
+        attribute (None if it does not exist) and returns True when the
+        wait is over. Instead of polling it watches the cluster of the
+        proxy (or its own subtree), see watch(). Returns False if the
+        timeout in seconds expires first.
+        """
+        key = '{0}/{1}'.format(self._endpoint, name)
+        matches = value
+        if not callable(value):
+            expected = _encode(value)
+            matches = lambda current: current is not None and _encode(current) == expected
+        reached = threading.Event()
+
+        def changed(changes):
+            if key in changes and matches(changes[key]):
+                reached.set()
+        deadline = None if timeout is None else time.time() + timeout
+        dn = self._endpoint
+        if dn.startswith(PREFIX + '/'):
+            dn = _parse_cluster_dn(dn)
+        subscription = watch(dn, changed)
+        try:
+            # The changes after the first read of the watcher are notified
+            subscription.watcher.wait_ready(timeout)
+            try:
+                if _key_layout(key) == LAYOUT_DOCUMENT:
+                    dockey, field = _document_key(key)
+                    current = _load_document(_kv.get(dockey)).get(field)
+                else:
+                    current = _kv.get(key)
+            except kvstore.KeyDoesNotExist:
+                current = None
+            if matches(current):
+                return True
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            return reached.wait(remaining)
+        finally:
+            subscription.cancel()
+
+    def batch(self):
+        """Buffer the writes made in a with block, see registry.batch()"""
+        return batch()
+
+    def refresh(self):
+        """Retrieve again the snapshot used by this proxy (if any)"""
+        self.invalidate()
+        if self._snapshot is not None:
+            self._snapshot.refresh()
 
     @property
     def dn(self):
@@ -181,12 +2454,15 @@ class Proxy(object):
 
     def get(self, name, default=None):
         try:
-            return _kv.get('{0}/{1}'.format(self._endpoint, name))
+            return self._read('{0}/{1}'.format(self._endpoint, name))
         except kvstore.KeyDoesNotExist:
             return default
 
     def set(self, name, value):
-        _kv.set('{0}/{1}'.format(self._endpoint, name), value)
+        key = '{0}/{1}'.format(self._endpoint, name)
+        _set(key, value)
+        if self._snapshot is not None:
+            self._snapshot.set(key, value)
 
     def __str__(self):
         return str(self._endpoint)
@@ -197,14 +2473,55 @@ class Proxy(object):
     def __eq__(self, other):
         return self._endpoint == other._endpoint
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._endpoint)
+
     def __lt__(self, other):
         return self._endpoint < other._endpoint
 
-    def to_dict(self):
+    @_measured()
+    def to_dict(self, depth=0, fields=True):
+        """Serialize the object as a dict
+
+        With depth > 0 the child collections listed in __children__ are
+        also serialized, up to the given depth, and the whole subtree is
+        read at once with a single recursive read (or from the snapshot of
+        the proxy). With depth 0 only the fields are read, see
+        _read_fields(). fields allows to select the fields to include, by
+        default the ones in __serializable__.
+        """
+        proxy = self
+        if self._snapshot is None and depth > 0:
+            try:
+                snapshot = Snapshot(self._endpoint)
+            except kvstore.KeyDoesNotExist:
+                snapshot = Snapshot(self._endpoint, data={})
+            proxy = self.__class__(self._endpoint, snapshot=snapshot)
+        elif self._snapshot is None:
+            names = self.__class__.__serializable__ if fields is True else fields
+            data = _document_data(self._endpoint)
+            if data is None:
+                data = _read_fields(self._endpoint, names)
+            proxy = self.__class__(self._endpoint, snapshot=Snapshot(self._endpoint, data))
+        return proxy._serialize(depth, fields)
+
+    def _serialize(self, depth, fields=True):
+        if fields is True:
+            fields = self.__class__.__serializable__
         basic_fields = dict(dn=self.dn, name=self.name)
-        serializable_fields = {k: self.get(k) for k in self.__class__.__serializable__}
+        serializable_fields = {k: self.get(k) for k in fields}
         data = dict(basic_fields)
         data.update(serializable_fields)
+        if depth > 0:
+            for collection in self.__class__.__children__:
+                try:
+                    children = sorted(getattr(self, collection))
+                except kvstore.KeyDoesNotExist:
+                    children = []
+                data[collection] = [c._serialize(depth - 1) for c in children]
         return data
 
 
@@ -215,36 +2532,60 @@ class Service(Proxy):
     __readonly__ = ('dn', 'name', 'nodes')
 
     @property
+    @_measured('Service.nodes')
     def nodes(self):
-        subtree = _kv.recurse(self._endpoint + '/nodes')
-        nodes = [parse_last_field(e) for e in subtree.keys()]
         clusterdn = _parse_cluster_dn(self._endpoint)
-        return [Node('{}/nodes/{}'.format(clusterdn, n)) for n in nodes]
+        return [self._child(Node, '{}/nodes/{}'.format(clusterdn, parse_last_field(n)))
+                for n in self._children('nodes')]
 
 
 class Cluster(Proxy):
     """Represents a cluster instance"""
     __serializable__ = ('status',)
     __readonly__ = ('dn', 'name', 'nodes', 'services')
+    __children__ = ('nodes', 'services')
+
+    @classmethod
+    def load(cls, dn):
+        """Get a cluster proxy that serves its reads from a snapshot
+
+        The whole cluster subtree is retrieved in one request, use
+        refresh() to retrieve it again.
+        """
+        try:
+            return cls(dn, snapshot=Snapshot(dn))
+        except kvstore.KeyDoesNotExist as e:
+            raise KeyDoesNotExist(str(e))
 
     @property
+    @_measured('Cluster.nodes')
     def nodes(self):
-        subtree = _kv.recurse(self._endpoint + '/nodes')
-        nodes = {_parse_node(e) for e in subtree.keys() if not e.endswith("/nodes/")}
-        return [Node(e) for e in nodes]
+        return [self._child(Node, e) for e in self._children('nodes')]
 
     @property
+    @_measured('Cluster.services')
     def services(self):
-        subtree = _kv.recurse(self._endpoint + '/services')
-        services = {_parse_service(e) for e in subtree.keys() if not e.endswith("/services/")}
-        return [Service(e) for e in services]
+        return [self._child(Service, e) for e in self._children('services')]
 
 
 class Product(Proxy):
-    """Represents a Product"""
+    """Represents a Product
+
+    The large fields (see BLOB_FIELDS) are decompressed when they are read.
+    """
     __serializable__ = ('version', 'description', 'logo_url')
     __readonly__ = ('dn', 'name')
 
+    def _read(self, key):
+        try:
+            return super(Product, self)._read(key)
+        except kvstore.KeyDoesNotExist:
+            if parse_last_field(key) not in BLOB_FIELDS:
+                raise
+            if self._snapshot is not None:
+                return _read_blob(key, self._snapshot.recurse)
+            return _read_blob(key, _kv.recurse)
+
     @property
     def name(self):
         """Returns the name of the product
@@ -254,6 +2595,63 @@ class Product(Proxy):
         return parse_next_to_last_field(self._endpoint)
 
 
+class ProductInfo(object):
+    """Metadata of a product as used by instantiate()
+
+    Holds all the fields of the product, read at once, together with the
+    parsed options, the merged default values of the options and the
+    revision of the template.
+    """
+
+    def __init__(self, dn, fields, index=None, blobs=None):
+        self.dn = dn
+        self.fields = fields
+        self.blobs = blobs or {}
+        self.index = index
+        self.checked = time.time()
+        if 'options' not in fields and 'options' not in self.blobs:
+            raise KeyDoesNotExist('Key {}/options does not exist'.format(dn))
+        self.options = json.loads(self.field('options'))
+        self.defaults = _merge(self.options)
+        if 'template' in self.blobs and 'sha256' in self.blobs['template']:
+            # The template is only decompressed when it has to be compiled
+            self.revision = _to_str(self.blobs['template']['sha256'])
+        else:
+            self.revision = _template_revision(self.template)
+
+    @classmethod
+    def from_subtree(cls, dn, subtree, index=None):
+        """Build the metadata from the subtree of the product"""
+        fields, blobs = {}, {}
+        for k, v in subtree.items():
+            name = k[len(dn):].strip('/')
+            if name and '/' not in name:
+                fields[name] = v
+            elif name.split('/')[0].endswith('.blob'):
+                field, part = name.split('/', 1)
+                blobs.setdefault(field[:-len('.blob')], {})[part] = v
+        return cls(dn, fields, index, blobs)
+
+    def field(self, name, default=''):
+        """Get a field decompressing it (only once) if it is compressed"""
+        if name not in self.fields and name in self.blobs:
+            self.fields[name] = _decode_blob('{}/{}'.format(self.dn, name),
+                                             self.blobs.pop(name))
+        return self.fields.get(name, default)
+
+    @property
+    def template(self):
+        return self.field('template')
+
+    @property
+    def templatetype(self):
+        return self.fields.get('templatetype')
+
+    @property
+    def layout(self):
+        return self.fields.get('layout') or LAYOUT_KEYS
+
+
 class Disk(Proxy):
     """Represents a disk"""
     __serializable__ = ('type', 'mode', 'origin', 'destination')
@@ -270,36 +2668,46 @@ class Node(Proxy):
     """Represents a node"""
     __serializable__ = ('cpu', 'mem', 'host', 'status')
     __readonly__ = ('dn', 'name', 'services', 'disks', 'networks', 'cluster', 'tags')
+    __children__ = ('disks', 'networks')
 
     @property
+    @_measured('Node.services')
     def services(self):
-        subtree = _kv.recurse(self._endpoint + '/services')
-        services = [parse_last_field(e) for e in subtree.keys()]
         clusterdn = _parse_cluster_dn(self._endpoint)
-        return [Service('{}/services/{}'.format(clusterdn, s)) for s in services]
+        return [self._child(Service, '{}/services/{}'.format(clusterdn, parse_last_field(s)))
+                for s in self._children('services')]
 
     @property
+    @_measured('Node.disks')
     def disks(self):
-        subtree = _kv.recurse(self._endpoint + '/disks')
-        disks = set([_parse_disk(e) for e in subtree.keys()])
-        return [Disk(d) for d in disks]
+        # Some templates use a scalar disks attribute, e.g. the number of
+        # disks, that is not listed below the disks/ prefix
+        return [self._child(Disk, d) for d in self._children('disks')]
 
     @property
+    @_measured('Node.networks')
     def networks(self):
-        subtree = _kv.recurse(self._endpoint + '/networks')
-        networks = set([_parse_network(e) for e in subtree.keys()])
-        return [Network(n) for n in sorted(networks)]
+        return [self._child(Network, n) for n in self._children('networks')]
 
     @property
     def tags(self):
         dn = '{0}/tags'.format(self._endpoint)
-        return [x.strip() for x in _kv.get(dn).split(',')]
+        return [x.strip() for x in self._read(dn).split(',')]
+
+    def set(self, name, value):
+        if name not in ('host', 'status'):
+            return super(Node, self).set(name, value)
+        # Keep the secondary index updated in the same transaction
+        old = self.get(name)
+        _write(_indexed_set_operations(self._endpoint, name, old, value))
+        if self._snapshot is not None:
+            self._snapshot.set('{0}/{1}'.format(self._endpoint, name), value)
 
     @property
     def cluster(self):
         """Contains the cluster instance to which this node belgons to"""
         clusterdn = extract_clusterdn_from_nodedn(self._endpoint)
-        return Cluster(clusterdn)
+        return self._child(Cluster, clusterdn)
 
 
 class InvalidOptionsError(Exception):
@@ -326,6 +2734,331 @@ class ReadOnlyAttributeError(Exception):
     pass
 
 
+class ClusterAlreadyExistsError(Exception):
+    pass
+
+
+class CorruptedBlobError(Exception):
+    pass
+
+
+class TransactionError(Exception):
+    pass
+
+
+class TransactionsNotSupportedError(kvstore.KVStoreError):
+    pass
+
+
+class SaveError(Exception):
+    """Some writes failed, errors contains (operations, exception) pairs"""
+    def __init__(self, errors):
+        self.errors = errors
+        super(SaveError, self).__init__(
+            '{} writes failed, first error: {!r}'.format(len(errors), errors[0][1]))
+
+
+def _decode(value):
+    """Convert a base64 value returned by consul in the stored string"""
+    # Empty values are returned as None
+    if not value:
+        return ''
+    return _to_str(base64.b64decode(value))
+
+
+def _check_response(r, key):
+    """Raise the kvstore exception that corresponds to a read response"""
+    if r.status_code == 404:
+        raise kvstore.KeyDoesNotExist("Key " + key.lstrip('/') + " does not exist")
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('GET returned {}'.format(r.status_code))
+
+
+def _parse_wait(wait):
+    """Convert a consul wait time (e.g. 10s, 5m) in seconds"""
+    match = re.match(r'^(\d+)(ms|s|m)?$', str(wait))
+    value, unit = int(match.group(1)), match.group(2) or 's'
+    return value * {'ms': 0.001, 's': 1, 'm': 60}[unit]
+
+
+def _to_str(value):
+    """Convert a value to the native string type used in keys"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _encode(value):
+    """Convert a value to the byte string stored in the k/v store"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+# Collections of a cluster whose elements are documents in the document layout
+_DOCUMENT_COLLECTIONS = ('nodes', 'services')
+_CLUSTER_KEY = re.compile(r'^({}/[^/]+/[^/]+/[^/]+/[^/]+)/(.*)$'.format(PREFIX))
+_NODE_DOCUMENT = re.compile(r'^{}/[^/]+/[^/]+/[^/]+/[^/]+/nodes/[^/]+$'.format(PREFIX))
+_BLOB_CHUNK = re.compile(r'\.blob/\d+$')
+
+
+def _cluster_layout(clusterdn, fetch=True):
+    """Get the layout of a cluster (None if unknown and fetch is False)
+
+    The document layout never changes except with migrate_layout, the
+    keys layout is checked again every PRODUCT_CHECK_INTERVAL seconds.
+    """
+    entry = _layouts.get(clusterdn)
+    if entry is not None:
+        layout, checked = entry
+        if layout == LAYOUT_DOCUMENT or time.time() - checked < PRODUCT_CHECK_INTERVAL:
+            return layout
+    if not fetch:
+        return None
+    try:
+        layout = _to_str(_kv.get('{}/layout'.format(clusterdn)))
+    except kvstore.KeyDoesNotExist:
+        layout = LAYOUT_KEYS
+    _layouts.put(clusterdn, (layout, time.time()))
+    return layout
+
+
+def _key_layout(key, fetch=True):
+    """Get the layout of the cluster of a key, see _cluster_layout"""
+    m = _CLUSTER_KEY.match(key)
+    if not m:
+        return LAYOUT_KEYS
+    return _cluster_layout(m.group(1), fetch)
+
+
+def _subtree_prefix(dn):
+    """Prefix of the recursive reads of the subtree of dn
+
+    It is dn with a trailing slash, so that the prefix does not match the
+    siblings (e.g. cluster 10 for cluster 1), or dn itself if it is a
+    node or service stored as a document (see _filter_subtree).
+    """
+    m = _CLUSTER_KEY.match(dn)
+    if m:
+        parts = m.group(2).split('/')
+        if (len(parts) == 2 and parts[0] in _DOCUMENT_COLLECTIONS and
+                _cluster_layout(m.group(1)) == LAYOUT_DOCUMENT):
+            return dn
+    return dn + '/'
+
+
+def _filter_subtree(data, dn):
+    """Keep the keys of data that are dn or below dn"""
+    prefix = dn + '/'
+    return {k: v for k, v in data.items() if k == dn or k.startswith(prefix)}
+
+
+def _document_key(key):
+    """Get the document that stores a key of a cluster and its field
+
+    The keys of the nodes and services are stored in their documents and
+    the rest of the keys in the document of the cluster.
+    """
+    clusterdn, rest = _CLUSTER_KEY.match(key).groups()
+    parts = rest.split('/', 2)
+    if len(parts) == 3 and parts[0] in _DOCUMENT_COLLECTIONS:
+        return '{}/{}/{}'.format(clusterdn, parts[0], parts[1]), parts[2]
+    return '{}/document'.format(clusterdn), rest
+
+
+def _read_fields(dn, names):
+    """Read the given fields of dn without reading the rest of its subtree
+
+    The fields that exist are found with a keys-only listing of the level
+    and read together in a transaction of get operations (one request per
+    field without transactions). Returns the keys read and their values.
+    """
+    try:
+        listed = set(_keys(dn + '/', separator='/'))
+    except kvstore.KeyDoesNotExist:
+        return {}
+    keys = ['{}/{}'.format(dn, name) for name in names]
+    data = _get_many([k for k in keys if k in listed])
+    for k in keys:
+        # Large product fields are stored in chunks, see _blob_kvinfo
+        if k + '.blob/' in listed:
+            data.update(_kv.recurse(k + '.blob/'))
+    return data
+
+
+def _get_many(keys):
+    """Read several keys in one transaction of get operations if supported
+
+    The keys deleted since they were listed are left out.
+    """
+    if len(keys) > 1 and _supports_txn():
+        try:
+            results = _kv.txn([('get', k) for k in keys])
+            return {_to_str(r['KV']['Key']): _decode(r['KV']['Value']) for r in results}
+        except (TransactionError, TransactionsNotSupportedError):
+            # A missing key fails the whole transaction
+            pass
+    data = {}
+    for k in keys:
+        try:
+            data[k] = _get_key(k)
+        except kvstore.KeyDoesNotExist:
+            pass
+    return data
+
+
+def _document_data(dn):
+    """Read the keys of dn stored in its document with a single request
+
+    Returns None if dn is not in a cluster with the document layout.
+    """
+    key = dn + '/'
+    if _key_layout(key) != LAYOUT_DOCUMENT:
+        return None
+    dockey = _document_key(key)[0]
+    clusterdn = _parse_cluster_dn(dn)
+    base = clusterdn if dockey == clusterdn + '/document' else dockey
+    try:
+        document = _load_document(_get_key(dockey))
+    except kvstore.KeyDoesNotExist:
+        document = {}
+    return {'{}/{}'.format(base, field): value for field, value in document.items()}
+
+
+def _load_document(value):
+    """Parse a document into a dict of field paths and string values"""
+    return {_to_str(k): _to_str(v) for k, v in json.loads(_to_str(value)).items()}
+
+
+def _dump_document(document):
+    """Serialize a document, see _load_document"""
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+
+def _pack_documents(pairs, clusterdn):
+    """Generator of the documents of a cluster from its (key, value) pairs
+
+    The keys of each node and service must be contiguous, as generated
+    by _iter_populate, and the keys outside the cluster are kept.
+    """
+    yield '{}/layout'.format(clusterdn), LAYOUT_DOCUMENT
+    header = {}
+    dockey, document = None, None
+    for k, v in pairs:
+        m = _CLUSTER_KEY.match(k)
+        if not m or m.group(1) != clusterdn:
+            yield k, v
+            continue
+        key, field = _document_key(k)
+        value = '' if v is None else _to_str(v)
+        if key.endswith('/document'):
+            header[field] = value
+            continue
+        if key != dockey:
+            if dockey is not None:
+                yield dockey, _dump_document(document)
+            dockey, document = key, {}
+        document[field] = value
+    if dockey is not None:
+        yield dockey, _dump_document(document)
+    yield '{}/document'.format(clusterdn), _dump_document(header)
+
+
+def _expand_documents(data, prefix):
+    """Replace the documents of the subtree of prefix by their keys
+
+    It is the inverse of _pack_documents for the data read with a
+    recursive get, so the subtree looks the same for any layout.
+    """
+    if not prefix.startswith(PREFIX + '/') and prefix.strip('/') != PREFIX:
+        return data
+    if prefix.strip('/').count('/') <= CLUSTER_DEPTH:
+        documents = set()
+        for k, v in data.items():
+            m = _CLUSTER_KEY.match(k)
+            if m and m.group(2) == 'layout' and _value_str(v) == LAYOUT_DOCUMENT:
+                documents.add(m.group(1))
+    else:
+        clusterdn = _parse_cluster_dn(prefix)
+        documents = {clusterdn} if _cluster_layout(clusterdn) == LAYOUT_DOCUMENT else set()
+    if not documents:
+        return data
+    expanded = {}
+    for k, v in data.items():
+        m = _CLUSTER_KEY.match(k)
+        if not m or m.group(1) not in documents:
+            expanded[k] = v
+            continue
+        clusterdn, rest = m.groups()
+        parts = rest.split('/')
+        if rest == 'layout':
+            continue
+        if rest == 'document':
+            base = clusterdn
+        elif len(parts) == 2 and parts[0] in _DOCUMENT_COLLECTIONS:
+            base = k
+        else:
+            expanded[k] = v
+            continue
+        for field, value in _load_document(v).items():
+            expanded['{}/{}'.format(base, field)] = value
+    return expanded
+
+
+_INDEXED_KEY = re.compile(
+    r'^({}/[^/]+/[^/]+/[^/]+/[^/]+/nodes/[^/]+)/({})(?:/([^/]+))?$'.format(
+        PREFIX, '|'.join(INDEXED_ATTRIBUTES)))
+
+
+def _index_entries(kvinfo):
+    """Get the secondary index keys of the node attributes in kvinfo"""
+    entries = []
+    for k, v in kvinfo.items():
+        entries.extend(_key_index_entries(k, v))
+    return entries
+
+
+def _key_index_entries(k, v):
+    """Get the secondary index keys of a single key of a node"""
+    m = _INDEXED_KEY.match(k)
+    if not m:
+        return []
+    nodedn, attr, item = m.groups()
+    if item is not None:
+        values = [item]
+    elif attr in ('host', 'status'):
+        values = [v]
+    else:
+        values = [x.strip() for x in _to_str(v).split(',')]
+    return [_index_key(attr, x, nodedn) for x in values if x != '']
+
+
+def _indexed_set_operations(nodedn, name, old, value):
+    """Operations to set an indexed node attribute updating its index"""
+    operations = [('set', '{0}/{1}'.format(nodedn, name), value)]
+    if old:
+        operations.append(('delete', _index_key(name, old, nodedn)))
+    if value:
+        operations.append(('set', _index_key(name, value, nodedn), ''))
+    return operations
+
+
+def _index_key(attr, value, nodedn):
+    """Key of the secondary index entry of a node attribute value"""
+    return '{}/{}/{}/{}'.format(INDEXPREFIX, attr, _index_value(value), id_from(nodedn))
+
+
+def _index_value(value):
+    """Convert an attribute value in a valid key field"""
+    return _to_str(value).replace('/', SLASH)
+
+
 def extract_clusterdn_from_nodedn(nodedn):
     """Extract the cluster DN from the given node DN"""
     m = re.search(r'^(.*)/nodes/[^/]+$', nodedn)
@@ -340,31 +3073,130 @@ def _populate(result, using, prefix=''):
        has the weird behaviour of returning the result inside one
        of the arguments
     """
-    data = using
+    result.update(_iter_populate(using, prefix))
 
-    if isvalue(data):
-        result[prefix] = data
-    elif islist(data):
-        for e in data:
-            if isvalue(e):
-                result['{}/{}'.format(prefix, e)] = ''
-            else:
-                raise NestedListsNotSupportedError(
-                    'prefix: {}, element: {}'.format(prefix, e))
-    elif isdict(data):
-        for k in data:
-            path = '{}/{}'.format(prefix, k)
+
+def _iter_populate(data, prefix=''):
+    """Generator of the flat (key, value) pairs of _populate
+
+    It walks the data depth first with an explicit stack of iterators,
+    so it yields the pairs and raises the errors in the same order as a
+    recursive traversal. The kind of each value is looked up by type and
+    the paths are built concatenating the parent path, which for the
+    native strings used as prefix is the same as '{}/{}'.format().
+    """
+    prefix = '{}'.format(prefix)
+    kind = _kind(data)
+    if kind is _VALUE:
+        yield prefix, data
+        return
+    if kind is _OTHER:
+        raise UnsupportedTypeError('data: {}, type: {}'.format(data, type(data)))
+    # Local names are faster in the inner loops
+    kinds, to_str, VALUE, OTHER, LIST = _KINDS, str, _VALUE, _OTHER, _LIST
+    stack = [(prefix, data, kind, iter(data))]
+    while stack:
+        prefix, data, kind, it = stack[-1]
+        base = prefix + '/'
+        if kind is LIST:
+            for e in it:
+                if (kinds.get(type(e)) or _kind(e)) is not VALUE:
+                    raise NestedListsNotSupportedError(
+                        'prefix: {}, element: {}'.format(prefix, e))
+                yield base + to_str(e), ''
+            stack.pop()
+            continue
+        for k in it:
+            path = base + to_str(k)
             v = data[k]
-            if isvalue(v):
-                result[path] = v
-            elif isdumpable(v):
-                _populate(result, v, path)
-            else:
+            vkind = kinds.get(type(v)) or _kind(v)
+            if vkind is VALUE:
+                yield path, v
+            elif vkind is OTHER:
                 raise UnsupportedTypeError(
                     'path: {}, key: {}, value: {}, type: {}'
                     .format(path, k, v, type(v)))
-    else:
-        raise UnsupportedTypeError('data: {}, type: {}'.format(data, type(data)))
+            else:
+                stack.append((path, v, vkind, iter(v)))
+                break
+        else:
+            stack.pop()
+
+
+# Kinds of data handled by _iter_populate
+_VALUE, _LIST, _DICT, _OTHER = range(1, 5)
+_KINDS = {}
+
+
+def _kind(data):
+    """Classify data like isvalue/islist/isdict, caching it by type"""
+    kind = _KINDS.get(type(data))
+    if kind is None:
+        if isvalue(data):
+            kind = _VALUE
+        elif islist(data):
+            kind = _LIST
+        elif isdict(data):
+            kind = _DICT
+        else:
+            kind = _OTHER
+        _KINDS[type(data)] = kind
+    return kind
+
+
+def _iter_populate_events(events, prefix=''):
+    """Generator of the pairs of _populate from ijson parsing events
+
+    It yields the same pairs and raises the same errors as _populate
+    applied to the parsed document, without building the document.
+    """
+    # Frames of the open containers: [is_list, path, current key]
+    stack = []
+    events = iter(events)
+    for _, event, value in events:
+        if event in ('end_map', 'end_array'):
+            stack.pop()
+            continue
+        if event == 'map_key':
+            stack[-1][2] = value
+            continue
+        if event == 'number' and not isinstance(value, (int, long)):
+            value = float(value)
+        parent = stack[-1] if stack else None
+        if parent is not None and parent[0]:
+            # Element of a list: only values are supported
+            if event in ('start_map', 'start_array'):
+                value = _build_object(event, events)
+            if isvalue(value):
+                yield '{}/{}'.format(parent[1], value), ''
+                continue
+            raise NestedListsNotSupportedError(
+                'prefix: {}, element: {}'.format(parent[1], value))
+        path = prefix if parent is None else '{}/{}'.format(parent[1], parent[2])
+        if event in ('start_map', 'start_array'):
+            stack.append([event == 'start_array', path, None])
+        elif isvalue(value):
+            yield path, value
+        elif parent is None:
+            raise UnsupportedTypeError('data: {}, type: {}'.format(value, type(value)))
+        else:
+            raise UnsupportedTypeError(
+                'path: {}, key: {}, value: {}, type: {}'
+                .format(path, parent[2], value, type(value)))
+
+
+def _build_object(event, events):
+    """Build the container that starts with event from the next events"""
+    builder = ObjectBuilder()
+    builder.event(event, None)
+    depth = 1
+    for _, event, value in events:
+        if event == 'number' and not isinstance(value, (int, long)):
+            value = float(value)
+        builder.event(event, value)
+        depth += {'start_map': 1, 'start_array': 1, 'end_map': -1, 'end_array': -1}.get(event, 0)
+        if depth == 0:
+            return builder.value
 
 
 def isvalue(var):
@@ -401,6 +3233,139 @@ def isdict(data):
 
 def generate_id(prefix):
     """Generate a new unique ID for the new instance"""
+    return generate_ids(prefix)[0]
+
+
+@_measured()
+def generate_ids(prefix, count=1):
+    """Reserve a block of consecutive unique IDs for new instances
+
+    The IDs are allocated atomically incrementing with check-and-set the
+    counter of the given prefix, stored under COUNTERPREFIX. The first
+    time, the counter is seeded from the existing instances.
+
+    Stores without check-and-set support scan the existing instances.
+    """
+    if not hasattr(_kv, 'cas'):
+        first = _scan_next_id(prefix)
+        return list(range(first, first + count))
+    key = _counter_key(prefix)
+    while True:
+        try:
+            value, index = _kv.get_indexed(key)
+            last = int(value)
+        except kvstore.KeyDoesNotExist:
+            last, index = _scan_next_id(prefix) - 1, 0
+        if _kv.cas(key, last + count, index):
+            return list(range(last + 1, last + count + 1))
+
+
+def migrate_counters():
+    """Seed the ID counters of all the prefixes from the existing instances
+
+    It has to be run once when upgrading a registry that was using the
+    instance scan to generate IDs. Counters are never decreased.
+    Returns a dict with the last ID found for each prefix.
+    """
+    try:
+        clusters = list(_list_cluster_dns())
+    except kvstore.KeyDoesNotExist:
+        return {}
+    last_ids = {}
+    for dn in clusters:
+        prefix = dn.rsplit('/', 1)[0]
+        last_ids[prefix] = max(last_ids.get(prefix, 0), _parse_id(dn, prefix))
+    for prefix, last in last_ids.items():
+        _seed_counter(prefix, last)
+    return last_ids
+
+
+def migrate_layout(layout=LAYOUT_DOCUMENT, user=None, product=None, version=None):
+    """Convert the existing instances to the given layout
+
+    The instances can be filtered by user, product and version as in
+    iter_clusters. The new keys are written before the marker of the
+    layout is changed and the old keys are deleted, so the clusters can
+    be read during the migration, but they should not be modified.
+    Returns the DNs of the converted clusters.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('Unsupported layout: {}'.format(layout))
+    migrated = []
+    for cluster in iter_clusters(user, product, version):
+        dn = cluster.dn
+        try:
+            subtree = _kv.recurse(dn + '/')
+        except kvstore.KeyDoesNotExist:
+            continue
+        marker = '{}/layout'.format(dn)
+        if _value_str(subtree.get(marker)) == LAYOUT_DOCUMENT:
+            current = LAYOUT_DOCUMENT
+        else:
+            current = LAYOUT_KEYS
+        if current == layout:
+            continue
+        flat = _expand_documents(subtree, dn)
+        if layout == LAYOUT_DOCUMENT:
+            kvinfo = OrderedDict(_pack_documents(sorted(flat.items()), dn))
+            switch = ('set', marker, LAYOUT_DOCUMENT)
+        else:
+            kvinfo = flat
+            switch = ('delete', marker)
+        _apply([('set', k, v) for k, v in kvinfo.items() if k != marker])
+        _apply([switch] + [('delete', k) for k in subtree
+                          if k not in kvinfo and k != marker])
+        _layouts.invalidate(dn)
+        migrated.append(dn)
+    return migrated
+
+
+def _claim_id(prefix, id):
+    """Check that a given ID of prefix is free before creating an instance
+
+    The counter is moved past it, so it is not generated again later.
+    """
+    dn = '{}/{}'.format(prefix, id)
+    try:
+        _keys(dn + '/')
+        raise ClusterAlreadyExistsError(dn)
+    except kvstore.KeyDoesNotExist:
+        pass
+    # Without counter the next ID is taken from a scan of the prefix
+    if str(id).isdigit() and hasattr(_kv, 'cas') and _exists(_counter_key(prefix)):
+        _seed_counter(prefix, int(id))
+
+
+def _seed_counter(prefix, last):
+    """Set the counter of prefix to last unless it is already higher"""
+    key = _counter_key(prefix)
+    while True:
+        try:
+            value, index = _kv.get_indexed(key)
+            if int(value) >= last:
+                return
+        except kvstore.KeyDoesNotExist:
+            index = 0
+        if _kv.cas(key, last, index):
+            return
+
+
+def _exists(key):
+    """Check if a key exists in the k/v store"""
+    try:
+        _kv.get(key)
+        return True
+    except kvstore.KeyDoesNotExist:
+        return False
+
+
+def _counter_key(prefix):
+    """Key of the counter used to allocate the IDs of the given prefix"""
+    return '{}/{}'.format(COUNTERPREFIX, prefix)
+
+
+def _scan_next_id(prefix):
+    """Find the next ID scanning the existing instances"""
     try:
         subtree = _kv.recurse(prefix)
     except kvstore.KeyDoesNotExist:
@@ -501,8 +3466,88 @@ def dn_from(id):
     return id.replace(DOT, '.').replace(SLASH, '/')
 
 
-def _filter_cluster_endpoints(user=None, product=None, version=None):
-    """ Get a list of filtered cluster endpoints using parameters as filters"""
+def _list_cluster_dns(user=None, product=None, version=None, limit=None,
+                      start_after=None, reverse=False):
+    """Generate the sorted DNs of the clusters matching the given filters
+
+    Raises KeyDoesNotExist (when iterated) if there is nothing below the
+    base DN of the filters.
+    """
+    basedn = _cluster_basedn(user, product, version)
+    depth = CLUSTER_DEPTH - basedn.count('/')
+    after = None
+    if start_after:
+        start_after = start_after.strip('/')
+        if not start_after.startswith(PREFIX + '/'):
+            start_after = '{}/{}'.format(PREFIX, start_after)
+        after = start_after.split('/')[basedn.count('/') + 1:] or None
+    clusters = _walk_dns(basedn, depth, after, reverse, missing_ok=False)
+    if limit is not None:
+        clusters = itertools.islice(clusters, limit)
+    return clusters
+
+
+def _walk_dns(basedn, depth, after=None, reverse=False, missing_ok=True):
+    """Generate the sorted DNs found depth levels below basedn
+
+    Each level is read with a keys-only listing using '/' as separator and
+    the subtrees sorted before the path given in after are not listed.
+    """
+    try:
+        keys = _keys(basedn + '/', separator='/')
+    except kvstore.KeyDoesNotExist:
+        if missing_ok:
+            return
+        raise
+    children = sorted([parse_last_field(k) for k in keys if k.endswith('/')],
+                      key=_natural_key, reverse=reverse)
+    for child in children:
+        remaining = None
+        if after:
+            position, start = _natural_key(child), _natural_key(after[0])
+            if position == start and len(after) > 1:
+                remaining = after[1:]
+            elif position == start or (position > start) == reverse:
+                continue
+            else:
+                after = None
+        dn = '{}/{}'.format(basedn, child)
+        if depth <= 1:
+            yield dn
+        else:
+            for found in _walk_dns(dn, depth - 1, remaining, reverse):
+                yield found
+
+
+def _natural_key(field):
+    """Sort key of a DN field: numbers in numeric order before any other"""
+    if field.isdigit():
+        return (0, int(field), '')
+    return (1, 0, field)
+
+
+def _dn_sort_key(dn):
+    """Sort key of a DN comparing each field with _natural_key"""
+    return [_natural_key(field) for field in dn.split('/')]
+
+
+def _filter_product_endpoints(product=None, version=None):
+    """Get the sorted DNs of the products matching the given filters
+
+    The products and their versions are listed level by level with
+    keys-only listings, so the fields of the products are not read.
+    """
+    basedn = _product_basedn(product, version)
+    depth = 2 - basedn.count('/')
+    if depth == 0:
+        # Raises KeyDoesNotExist if the version is not registered
+        _keys(basedn + '/', separator='/')
+        return [basedn]
+    return list(_walk_dns(basedn, depth, missing_ok=False))
+
+
+def _cluster_basedn(user=None, product=None, version=None):
+    """Build the base DN of the clusters matching the given filters"""
     basedn = PREFIX
     if user:
         basedn = '{}/{}'.format(basedn, user)
@@ -510,24 +3555,28 @@ def _filter_cluster_endpoints(user=None, product=None, version=None):
             basedn = '{}/{}'.format(basedn, product)
             if version:
                 basedn = '{}/{}'.format(basedn, version)
+    return basedn
 
-    subtree = _kv.recurse(basedn)
-    clusters = set([_parse_cluster_dn(e) for e in subtree.keys()])
 
-    return [dn for dn in clusters]
-
-
-def _filter_product_endpoints(product=None, version=None):
-    """ Get a list of filtered product endpoints using parameters as filters"""
+def _product_basedn(product=None, version=None):
+    """Build the base DN of the products matching the given filters"""
     basedn = TMPLPREFIX
     if product:
         basedn = '{}/{}'.format(basedn, product)
         if version:
             basedn = '{}/{}'.format(basedn, version)
+    return basedn
+
+
+def _parse_cluster_dns(keys):
+    """Get the list of distinct cluster DNs of the given keys"""
+    clusters = set([_parse_cluster_dn(e) for e in keys])
+    return [dn for dn in clusters]
 
-    subtree = _kv.recurse(basedn)
-    products = set([_parse_product_dn(e) for e in subtree.keys()])
 
+def _parse_product_dns(keys):
+    """Get the list of distinct product DNs of the given keys"""
+    products = set([_parse_product_dn(e) for e in keys])
     return [dn for dn in products]
 
 
@@ -547,7 +3596,8 @@ def parse_next_to_last_field(endpoint):
 
 
 def _parse_id(route, prefix):
-    pattern = prefix + r'/([^/]+)'
+    # Instances with non numeric IDs do not count
+    pattern = prefix + r'/(\d+)(/|$)'
     m = re.match(pattern, route)
     if m:
         return int(m.group(1))
@@ -0,0 +1,842 @@
+"""Asynchronous Configuration Registry API
+
+asyncio counterpart of the registry module, it requires python 3.5+
+and aiohttp. All the requests to the k/v store go through a shared
+aiohttp session that limits the number of concurrent requests, so a
+single process can drive thousands of cluster operations at once.
+
+Usage examples:
+
+    import registry_aio
+    registry_aio.connect('http://127.0.0.1:8500/v1/kv', concurrency=64)
+
+    cluster = await registry_aio.instantiate(user, product, version, options)
+    for node in await cluster.nodes():
+        status = await node.status
+        host = await node.get('host', default='')
+    await cluster.update({'status': 'running'})
+
+    await registry_aio.close()
+"""
+import asyncio
+import base64
+import json
+import re
+import time
+
+import aiohttp
+import kvstore
+
+import registry
+from registry import (PREFIX, TMPLPREFIX, TXN_MAX_OPS, CLUSTER_DEPTH,
+                      DOCUMENT_RETRIES, LAYOUT_DOCUMENT, LAYOUT_KEYS,
+                      ClusterAlreadyExistsError, KeyDoesNotExist,
+                      ReadOnlyAttributeError, SaveError, TransactionError,
+                      TransactionsNotSupportedError)
+
+# Maximum number of concurrent requests to the k/v store
+CONCURRENCY = 64
+ENDPOINT = registry.ENDPOINT
+
+
+class Client(object):
+    """Asynchronous k/v store client
+
+    Offers the same operations as registry.Client as coroutines.
+    """
+
+    def __init__(self, endpoint='http://127.0.0.1:8500/v1/kv',
+                 concurrency=CONCURRENCY, timeout=registry.TIMEOUT):
+        self.endpoint = endpoint.rstrip('/')
+        self.txn_endpoint = re.sub(r'/kv$', '/txn', self.endpoint)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+        # Cleared when the store answers 404 to a transaction (consul < 0.7)
+        self.txn_supported = True
+
+    def _get_session(self):
+        # The session must be created inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0])
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def _request(self, method, k, params=None, data=None, url=None,
+                       wait=False):
+        """Send a request and return its status, headers and JSON body
+
+        Only the bodies of successful and conflicting (409) responses are
+        parsed, the rest of errors may not be JSON (e.g. 413 or 500).
+        """
+        if url is None:
+            url = '{}/{}'.format(self.endpoint, k.lstrip('/'))
+        session = self._get_session()
+        # Blocking queries can take as long as the wait time
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.timeout[0],
+            sock_read=None if wait else self.timeout[1])
+        metrics = registry._metrics
+        start = time.time()
+        try:
+            async with self._semaphore:
+                async with session.request(method, url, params=params, data=data,
+                                           timeout=timeout) as r:
+                    body = await r.read()
+        except Exception:
+            if metrics is not None:
+                metrics.observe(_operation(method, url), time.time() - start,
+                                error=True, sent=len(data or ''))
+            raise
+        if metrics is not None:
+            metrics.observe(_operation(method, url), time.time() - start,
+                            error=(r.status >= 400 and r.status != 404),
+                            sent=len(data or ''), received=len(body))
+        if body and (200 <= r.status < 300 or r.status == 409):
+            return r.status, r.headers, json.loads(body)
+        return r.status, r.headers, None
+
+    async def set(self, k, v):
+        """Add or update a key, value pair to the database"""
+        status, _, body = await self._request('PUT', k, data=_encode(v))
+        if status != 200 or body is not True:
+            raise kvstore.KVStoreError('PUT returned {}'.format(status))
+
+    async def get(self, k):
+        """Get the value of a given key"""
+        return (await self.get_indexed(k))[0]
+
+    async def get_indexed(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Get the value of a given key together with its X-Consul-Index"""
+        params = {}
+        if wait:
+            params = {'index': wait_index, 'wait': timeout}
+        status, headers, body = await self._request('GET', k, params, wait=wait)
+        _check_status(status, k)
+        return _decode(body[0]['Value']), headers.get('X-Consul-Index')
+
+    async def recurse(self, k):
+        """Recursively get the tree below the given key"""
+        return (await self.recurse_indexed(k))[0]
+
+    async def recurse_indexed(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key and its X-Consul-Index"""
+        params = {'recurse': 'true'}
+        if wait:
+            params.update({'index': wait_index, 'wait': timeout})
+        status, headers, body = await self._request('GET', k, params, wait=wait)
+        _check_status(status, k)
+        entries = {e['Key']: _decode(e['Value']) for e in body}
+        return entries, headers.get('X-Consul-Index')
+
+    async def keys(self, k, separator=None):
+        """List the keys below the given key without retrieving the values"""
+        params = {'keys': 'true'}
+        if separator:
+            params['separator'] = separator
+        status, _, body = await self._request('GET', k, params)
+        _check_status(status, k)
+        return body
+
+    async def index(self, k, recursive=False):
+        """Get the current index of the key or the subtree listing only the keys"""
+        params = {'keys': 'true'}
+        if recursive:
+            params['recurse'] = 'true'
+        status, headers, _ = await self._request('GET', k, params)
+        if status not in (200, 404) or 'X-Consul-Index' not in headers:
+            raise kvstore.KVStoreError('GET returned {}'.format(status))
+        return headers['X-Consul-Index']
+
+    async def delete(self, k, recursive=False):
+        """Delete a given key or recursively delete the tree below it"""
+        params = {'recurse': 'true'} if recursive else {}
+        status, _, _ = await self._request('DELETE', k, params)
+        if status != 200:
+            raise kvstore.KVStoreError('DELETE returned {}'.format(status))
+
+    async def cas(self, k, v, index):
+        """Set the value of a key only if its modify index did not change"""
+        status, _, body = await self._request('PUT', k, {'cas': str(index)},
+                                              data=_encode(v))
+        if status != 200:
+            raise kvstore.KVStoreError('PUT returned {}'.format(status))
+        return body is True
+
+    async def txn(self, operations):
+        """Apply a list of operations atomically, see registry.Client.txn"""
+        payload = []
+        for op in operations:
+            kv = {'Verb': op[0], 'Key': op[1].lstrip('/')}
+            if len(op) > 2 and op[2] is not None:
+                kv['Value'] = base64.b64encode(_encode(op[2])).decode('ascii')
+            if len(op) > 3:
+                # Consul needs a number, the indexes come from the headers
+                kv['Index'] = int(op[3])
+            payload.append({'KV': kv})
+        status, _, body = await self._request('PUT', None, data=json.dumps(payload),
+                                              url=self.txn_endpoint)
+        if status == 404:
+            self.txn_supported = False
+            raise TransactionsNotSupportedError('TXN returned 404')
+        if status == 409:
+            errors = body.get('Errors') or []
+            raise TransactionError('; '.join(e.get('What', '') for e in errors))
+        if status != 200:
+            raise kvstore.KVStoreError('TXN returned {}'.format(status))
+        return body.get('Results') or []
+
+    async def close(self):
+        """Close all the connections of the session"""
+        if self._session is not None:
+            await self._session.close()
+
+
+_kv = Client(ENDPOINT)
+# Metadata of the products used by instantiate() by product DN
+_products = registry.LRUCache(maxsize=256)
+
+
+def connect(endpoint='http://127.0.0.1:8500/v1/kv', concurrency=CONCURRENCY,
+            timeout=registry.TIMEOUT):
+    """Configure a new connection to the registry
+
+    - concurrency: maximum number of concurrent requests to the k/v store
+    - timeout: (connect, read) timeouts of the requests in seconds
+    """
+    global _kv
+    _kv = Client(endpoint, concurrency, timeout)
+    _products.clear()
+
+
+async def close():
+    """Close the connections to the registry"""
+    await _kv.close()
+
+
+async def register(name, version, description,
+                   template='', options='', orchestrator='',
+                   templatetype='json+jinja2', logo_url='', layout=LAYOUT_KEYS):
+    """Register a new product, see registry.register"""
+    dn = '{}/{}/{}'.format(TMPLPREFIX, name, version)
+    kvinfo = registry._product_kvinfo(dn, name, version, description, template,
+                                      options, orchestrator, templatetype, logo_url,
+                                      layout)
+    # The chunks of the large fields are too big to share a transaction
+    chunks = [k for k in kvinfo if '.blob/' in k]
+    await asyncio.gather(*[_kv.set(k, kvinfo[k]) for k in chunks])
+    await save({k: v for k, v in kvinfo.items() if k not in chunks})
+    stale = []
+    for field in registry.BLOB_FIELDS:
+        key = '{}/{}'.format(dn, field)
+        try:
+            stale.extend(k for k in await _kv.keys(key + '.blob/') if k not in kvinfo)
+        except kvstore.KeyDoesNotExist:
+            pass
+        if key not in kvinfo:
+            stale.append(key)
+    await _apply([('delete', k) for k in stale])
+    _products.invalidate(dn)
+    await _update_catalog(dn, registry._catalog_entry(version, description, logo_url))
+    return Product(dn)
+
+
+async def deregister(name, version):
+    """Deregister a given product"""
+    dn = '{}/{}/{}'.format(TMPLPREFIX, name, version)
+    await _kv.delete(dn + '/', recursive=True)
+    _products.invalidate(dn)
+    await _update_catalog(dn, None)
+
+
+async def _update_catalog(dn, entry):
+    """Add (or remove if entry is None) a product, see registry._update_catalog"""
+    while True:
+        try:
+            value, index = await _kv.get_indexed(registry.CATALOGKEY)
+            catalog = json.loads(registry._to_str(value))
+        except kvstore.KeyDoesNotExist:
+            catalog, index = {}, 0
+        value = registry._catalog_update(catalog, dn, entry)
+        if value is None or await _kv.cas(registry.CATALOGKEY, value, index):
+            return
+
+
+async def instantiate(user=None, product=None, version=None, options=None, id=None):
+    """Register a new instance using information from the product template
+
+    id allows to use an ID reserved before with generate_ids(), see
+    registry.instantiate.
+    """
+    info = await _product_info('{}/{}/{}'.format(TMPLPREFIX, product, version))
+    mergedopts = registry._instance_options(info, options)
+
+    prefix = '{}/{}/{}/{}'.format(PREFIX, user, product, version)
+    if id is None:
+        id = await generate_id(prefix)
+    else:
+        await _claim_id(prefix, id)
+    dn = '{}/{}'.format(prefix, id)
+
+    kvinfo = registry._instance_kvinfo(info, mergedopts, user, product, version, dn)
+    if info.layout == LAYOUT_DOCUMENT:
+        kvinfo = dict(registry._pack_documents(sorted(kvinfo.items()), dn))
+    registry._layouts.put(dn, (info.layout, time.time()))
+    await save(kvinfo)
+    return Cluster(dn)
+
+
+async def deinstantiate(user, product, version, instanceid):
+    """Deinstantiate (remove) a given cluster instance"""
+    dn = '{}/{}/{}/{}/{}'.format(PREFIX, user, product, version, instanceid)
+    try:
+        entries = registry._index_entries(await _expand(await _kv.recurse(dn + '/'), dn))
+    except kvstore.KeyDoesNotExist:
+        entries = []
+    await _apply([('delete', k) for k in entries])
+    await _kv.delete(dn + '/', recursive=True)
+    registry._layouts.invalidate(dn)
+
+
+async def save(kvinfo):
+    """Save kvinfo in the k/v store using concurrent transactions"""
+    await _apply([('set', k, v) for k, v in kvinfo.items()])
+
+
+async def _apply(operations):
+    """Apply operations in concurrent transactions of TXN_MAX_OPS
+
+    The failed transactions are raised together as a SaveError.
+    """
+    batches = registry._batches(operations, TXN_MAX_OPS)
+    results = await asyncio.gather(*[_txn(batch) for batch in batches],
+                                   return_exceptions=True)
+    errors = [(batch, result) for batch, result in zip(batches, results)
+              if isinstance(result, Exception)]
+    if errors:
+        raise SaveError(errors)
+
+
+async def _txn(operations):
+    """Apply operations in one transaction, see registry._txn
+
+    If the store does not support transactions they are applied one by one.
+    """
+    if getattr(_kv, 'txn_supported', True):
+        try:
+            return await _kv.txn(operations)
+        except TransactionsNotSupportedError:
+            pass
+    for op in operations:
+        await _apply_one(op)
+
+
+async def _apply_one(operation):
+    """Apply a single operation using the basic k/v store interface"""
+    verb, key = operation[0], operation[1]
+    if verb == 'set':
+        await _kv.set(key, operation[2])
+    elif verb == 'delete':
+        await _kv.delete(key)
+    elif verb == 'delete-tree':
+        await _kv.delete(key, recursive=True)
+    elif verb == 'cas':
+        if not await _kv.cas(key, operation[2], operation[3]):
+            raise TransactionError('Index of {} is stale'.format(key))
+    else:
+        raise TransactionError('Unsupported operation: {}'.format(verb))
+
+
+async def _apply_layout(operations):
+    """Apply operations for any cluster layout, see registry._apply_layout"""
+    for attempt in range(DOCUMENT_RETRIES):
+        layouts = {}
+        for op in operations:
+            layouts[op[1]] = await _key_layout(op[1])
+        physical, changes = registry._split_document_operations(operations, layouts.get)
+        for dockey, fields in changes.items():
+            try:
+                value, index = await _kv.get_indexed(dockey)
+            except kvstore.KeyDoesNotExist:
+                value, index = None, 0
+            physical.append(registry._document_update(dockey, value, index, fields))
+        try:
+            await _apply(physical)
+            return
+        except (TransactionError, SaveError):
+            if not changes or attempt == DOCUMENT_RETRIES - 1:
+                raise
+
+
+async def _cluster_layout(clusterdn):
+    """Get the layout of a cluster, see registry._cluster_layout"""
+    layout = registry._cluster_layout(clusterdn, fetch=False)
+    if layout is None:
+        try:
+            layout = registry._to_str(await _kv.get('{}/layout'.format(clusterdn)))
+        except kvstore.KeyDoesNotExist:
+            layout = LAYOUT_KEYS
+        registry._layouts.put(clusterdn, (layout, time.time()))
+    return layout
+
+
+async def _key_layout(key):
+    """Get the layout of the cluster of a key"""
+    m = registry._CLUSTER_KEY.match(key)
+    if not m:
+        return LAYOUT_KEYS
+    return await _cluster_layout(m.group(1))
+
+
+async def _expand(data, prefix):
+    """Replace the documents of a subtree, see registry._expand_documents"""
+    if prefix.startswith(PREFIX + '/') and prefix.strip('/').count('/') > CLUSTER_DEPTH:
+        # Look up the layout asynchronously before it is used
+        await _cluster_layout(registry._parse_cluster_dn(prefix))
+    return registry._expand_documents(data, prefix)
+
+
+async def _recurse_subtree(dn):
+    """Read the subtree of dn without its siblings, see registry.Snapshot"""
+    m = registry._CLUSTER_KEY.match(dn)
+    if m:
+        # Look up the layout asynchronously before it is used
+        await _cluster_layout(m.group(1))
+    data = registry._filter_subtree(await _kv.recurse(registry._subtree_prefix(dn)), dn)
+    if not data:
+        raise kvstore.KeyDoesNotExist("Key " + dn + " does not exist")
+    return await _expand(data, dn)
+
+
+async def generate_id(prefix):
+    """Generate a new unique ID for the new instance"""
+    return (await generate_ids(prefix))[0]
+
+
+async def generate_ids(prefix, count=1):
+    """Reserve a block of consecutive unique IDs, see registry.generate_ids"""
+    key = registry._counter_key(prefix)
+    while True:
+        try:
+            value, index = await _kv.get_indexed(key)
+            last = int(value)
+        except kvstore.KeyDoesNotExist:
+            last, index = await _scan_next_id(prefix) - 1, 0
+        if await _kv.cas(key, last + count, index):
+            return list(range(last + 1, last + count + 1))
+
+
+async def _claim_id(prefix, id):
+    """Check that a given ID is free moving the counter past it, see registry._claim_id"""
+    dn = '{}/{}'.format(prefix, id)
+    try:
+        await _kv.keys(dn + '/')
+        raise ClusterAlreadyExistsError(dn)
+    except kvstore.KeyDoesNotExist:
+        pass
+    if not str(id).isdigit():
+        return
+    key = registry._counter_key(prefix)
+    while True:
+        try:
+            value, index = await _kv.get_indexed(key)
+        except kvstore.KeyDoesNotExist:
+            # Without counter the next ID is taken from a scan of the prefix
+            return
+        if int(value) >= int(id) or await _kv.cas(key, int(id), index):
+            return
+
+
+async def _scan_next_id(prefix):
+    """Find the next ID scanning the existing instances"""
+    try:
+        instances = await _kv.keys(prefix + '/', separator='/')
+    except kvstore.KeyDoesNotExist:
+        return 1
+    return max(registry._parse_id(e, prefix) for e in instances) + 1
+
+
+async def _product_info(dn):
+    """Get the metadata of a product reusing the cached one"""
+    info = _products.get(dn)
+    if info is not None and await _kv.index(dn + '/', recursive=True) == info.index:
+        return info
+    try:
+        subtree, index = await _kv.recurse_indexed(dn + '/')
+    except kvstore.KeyDoesNotExist as e:
+        raise KeyDoesNotExist(str(e))
+    info = registry.ProductInfo.from_subtree(dn, subtree, index)
+    _products.put(dn, info)
+    return info
+
+
+def get_product(name=None, version=None, dn=None):
+    """Get a product proxy object"""
+    if not dn:
+        dn = '{}/{}/{}'.format(TMPLPREFIX, name, version)
+    return Product(dn)
+
+
+async def get_cluster(user=None, product=None, version=None, id=None, dn=None,
+                      snapshot=False):
+    """Get a cluster instance proxy object
+
+    With snapshot=True the whole cluster is fetched in one request and the
+    returned proxies serve their reads from this in-memory copy.
+    """
+    if not dn:
+        dn = '{}/{}/{}/{}/{}'.format(PREFIX, user, product, version, id)
+    cluster = Cluster(dn)
+    if snapshot:
+        await cluster.load()
+    return cluster
+
+
+async def query_clusters(user=None, product=None, version=None):
+    """Get a list of clusters filtered by user, product and version
+
+    The clusters are listed level by level with keys-only listings, see
+    registry.query_clusters.
+    """
+    basedn = registry._cluster_basedn(user, product, version)
+    try:
+        clusters = await _walk_dns(basedn, CLUSTER_DEPTH - basedn.count('/'))
+    except kvstore.KeyDoesNotExist:
+        return None
+    return [Cluster(dn) for dn in clusters]
+
+
+async def query_products(product=None, version=None, catalog=False):
+    """Get a list of products that can be filtered by product and version
+
+    With catalog=True they are returned serialized from the summary of
+    the products, see registry.query_products.
+    """
+    if catalog:
+        try:
+            data = json.loads(registry._to_str(await _kv.get(registry.CATALOGKEY)))
+        except kvstore.KeyDoesNotExist:
+            data = await _build_catalog()
+        return registry._filter_catalog(data, product, version)
+    basedn = registry._product_basedn(product, version)
+    try:
+        products = await _walk_dns(basedn, 2 - basedn.count('/'))
+    except kvstore.KeyDoesNotExist:
+        return None
+    return [Product(dn) for dn in products]
+
+
+async def _build_catalog():
+    """Read the summary of the products from the products themselves"""
+    try:
+        products = await _walk_dns(TMPLPREFIX, 2)
+    except kvstore.KeyDoesNotExist:
+        return {}
+    catalog = {}
+    for dn in products:
+        product = Product(dn)
+        fields = [await product.get(f) for f in Product.__serializable__]
+        catalog[dn] = registry._catalog_entry(*fields)
+    return catalog
+
+
+async def _walk_dns(basedn, depth):
+    """Get the sorted DNs found depth levels below basedn
+
+    Each level is read with a keys-only listing using '/' as separator, the
+    subtrees of a level concurrently, see registry._walk_dns. Raises
+    KeyDoesNotExist if there is nothing below basedn.
+    """
+    keys = await _kv.keys(basedn + '/', separator='/')
+    if depth <= 0:
+        return [basedn]
+    children = sorted([registry.parse_last_field(k) for k in keys if k.endswith('/')],
+                      key=registry._natural_key)
+    dns = ['{}/{}'.format(basedn, child) for child in children]
+    if depth == 1:
+        return dns
+    found = await asyncio.gather(*[_walk_dns(dn, depth - 1) for dn in dns],
+                                 return_exceptions=True)
+    for result in found:
+        if isinstance(result, Exception) and not isinstance(result, kvstore.KeyDoesNotExist):
+            raise result
+    return [dn for result in found if isinstance(result, list) for dn in result]
+
+
+class Proxy(object):
+    """Base class for asynchronous Proxy objects
+
+    Reads are coroutines: await proxy.get('status') or await proxy.status.
+    Writes use await proxy.set(name, value) or, to write several
+    attributes in one transaction, await proxy.update(values).
+    """
+
+    __serializable__ = ()
+    __readonly__ = ('dn', 'name')
+    __children__ = ()
+
+    def __init__(self, endpoint, snapshot=None):
+        super(Proxy, self).__setattr__('_endpoint', endpoint.rstrip('/'))
+        super(Proxy, self).__setattr__('_snapshot', snapshot)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._getattr(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Use await proxy.set({!r}, value)'.format(name))
+
+    async def _getattr(self, name):
+        try:
+            return await self._read('{0}/{1}'.format(self._endpoint, name))
+        except kvstore.KeyDoesNotExist as e:
+            raise KeyDoesNotExist(str(e))
+
+    async def _read(self, key):
+        if self._snapshot is not None:
+            return self._snapshot.get(key)
+        if await _key_layout(key) == LAYOUT_DOCUMENT:
+            dockey, field = registry._document_key(key)
+            try:
+                document = registry._load_document(await _kv.get(dockey))
+            except kvstore.KeyDoesNotExist:
+                document = {}
+            if field not in document:
+                raise kvstore.KeyDoesNotExist("Key " + key + " does not exist")
+            return document[field]
+        return await _kv.get(key)
+
+    async def _children(self, collection):
+        """List the DNs of the immediate children in a collection"""
+        prefix = '{}/{}/'.format(self._endpoint, collection)
+        if self._snapshot is not None:
+            keys = self._snapshot.keys(prefix, separator='/')
+        elif (await _key_layout(prefix) != LAYOUT_DOCUMENT or
+              registry._is_document_collection(prefix)):
+            keys = await _kv.keys(prefix, separator='/')
+        else:
+            try:
+                value = await _kv.get(registry._document_key(prefix)[0])
+            except kvstore.KeyDoesNotExist:
+                value = None
+            keys = registry._document_children(prefix, value)
+        return sorted(set(k.rstrip('/') for k in keys if k.rstrip('/') != prefix.rstrip('/')))
+
+    def _child(self, cls, endpoint):
+        return cls(endpoint, snapshot=self._snapshot)
+
+    @property
+    def dn(self):
+        return self._endpoint
+
+    @property
+    def name(self):
+        return registry.parse_last_field(self._endpoint)
+
+    async def load(self):
+        """Serve the reads from a snapshot of the subtree of this proxy"""
+        try:
+            data = await _recurse_subtree(self._endpoint)
+        except kvstore.KeyDoesNotExist as e:
+            raise KeyDoesNotExist(str(e))
+        super(Proxy, self).__setattr__(
+            '_snapshot', registry.Snapshot(self._endpoint, data=data))
+
+    async def refresh(self):
+        """Retrieve again the snapshot used by this proxy (if any)"""
+        if self._snapshot is not None:
+            dn = self._snapshot.dn
+            self._snapshot._load(await _recurse_subtree(dn))
+
+    async def get(self, name, default=None):
+        try:
+            return await self._read('{0}/{1}'.format(self._endpoint, name))
+        except kvstore.KeyDoesNotExist:
+            return default
+
+    async def set(self, name, value):
+        await self.update({name: value})
+
+    async def update(self, values):
+        """Write several attributes using bulk transactions"""
+        for name in values:
+            if name in self.__class__.__readonly__:
+                raise ReadOnlyAttributeError(name)
+        operations = []
+        for name, value in values.items():
+            operations.extend(await self._set_operations(name, value))
+        await _apply_layout(operations)
+        if self._snapshot is not None:
+            for name, value in values.items():
+                self._snapshot.set('{0}/{1}'.format(self._endpoint, name), value)
+
+    async def _set_operations(self, name, value):
+        return [('set', '{0}/{1}'.format(self._endpoint, name), value)]
+
+    async def to_dict(self, depth=0, fields=True):
+        """Serialize the object as a dict, see registry.Proxy.to_dict"""
+        proxy = self
+        # With depth 0 only the fields are read, see registry.Proxy.to_dict
+        if self._snapshot is None and depth > 0:
+            try:
+                data = await _recurse_subtree(self._endpoint)
+            except kvstore.KeyDoesNotExist:
+                data = {}
+            proxy = self._child(self.__class__, self._endpoint)
+            super(Proxy, proxy).__setattr__(
+                '_snapshot', registry.Snapshot(self._endpoint, data=data))
+        return await proxy._serialize(depth, fields)
+
+    async def _serialize(self, depth, fields=True):
+        if fields is True:
+            fields = self.__class__.__serializable__
+        data = dict(dn=self.dn, name=self.name)
+        for k in fields:
+            data[k] = await self.get(k)
+        if depth > 0:
+            for collection in self.__class__.__children__:
+                try:
+                    children = sorted(await getattr(self, collection)())
+                except kvstore.KeyDoesNotExist:
+                    children = []
+                data[collection] = [await c._serialize(depth - 1) for c in children]
+        return data
+
+    def __str__(self):
+        return str(self._endpoint)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self._endpoint)
+
+    def __eq__(self, other):
+        return self._endpoint == other._endpoint
+
+    def __hash__(self):
+        return hash(self._endpoint)
+
+    def __lt__(self, other):
+        return self._endpoint < other._endpoint
+
+
+class Service(Proxy):
+    """Represents a service"""
+    __serializable__ = registry.Service.__serializable__
+    __readonly__ = registry.Service.__readonly__
+
+    async def nodes(self):
+        clusterdn = registry._parse_cluster_dn(self._endpoint)
+        return [self._child(Node, '{}/nodes/{}'.format(clusterdn, registry.parse_last_field(e)))
+                for e in await self._children('nodes')]
+
+
+class Cluster(Proxy):
+    """Represents a cluster instance"""
+    __serializable__ = registry.Cluster.__serializable__
+    __readonly__ = registry.Cluster.__readonly__
+    __children__ = registry.Cluster.__children__
+
+    async def nodes(self):
+        return [self._child(Node, e) for e in await self._children('nodes')]
+
+    async def services(self):
+        return [self._child(Service, e) for e in await self._children('services')]
+
+
+class Product(Proxy):
+    """Represents a Product"""
+    __serializable__ = registry.Product.__serializable__
+    __readonly__ = registry.Product.__readonly__
+
+    async def _read(self, key):
+        try:
+            return await super(Product, self)._read(key)
+        except kvstore.KeyDoesNotExist:
+            if registry.parse_last_field(key) not in registry.BLOB_FIELDS:
+                raise
+            if self._snapshot is not None:
+                return registry._read_blob(key, self._snapshot.recurse)
+            subtree = await _kv.recurse(key + '.blob/')
+            return registry._read_blob(key, lambda prefix: subtree)
+
+    @property
+    def name(self):
+        return registry.parse_next_to_last_field(self._endpoint)
+
+
+class Disk(Proxy):
+    """Represents a disk"""
+    __serializable__ = registry.Disk.__serializable__
+    __readonly__ = registry.Disk.__readonly__
+
+
+class Network(Proxy):
+    """Represents a network address"""
+    __serializable__ = registry.Network.__serializable__
+    __readonly__ = registry.Network.__readonly__
+
+
+class Node(Proxy):
+    """Represents a node"""
+    __serializable__ = registry.Node.__serializable__
+    __readonly__ = registry.Node.__readonly__
+    __children__ = registry.Node.__children__
+
+    async def services(self):
+        clusterdn = registry._parse_cluster_dn(self._endpoint)
+        return [self._child(Service, '{}/services/{}'.format(clusterdn, registry.parse_last_field(e)))
+                for e in await self._children('services')]
+
+    async def disks(self):
+        return [self._child(Disk, e) for e in await self._children('disks')]
+
+    async def networks(self):
+        return sorted(self._child(Network, e) for e in await self._children('networks'))
+
+    async def tags(self):
+        return [x.strip() for x in (await self._getattr('tags')).split(',')]
+
+    @property
+    def cluster(self):
+        """Contains the cluster instance to which this node belongs to"""
+        clusterdn = registry.extract_clusterdn_from_nodedn(self._endpoint)
+        return self._child(Cluster, clusterdn)
+
+    async def _set_operations(self, name, value):
+        if name not in ('host', 'status'):
+            return await super(Node, self)._set_operations(name, value)
+        # Keep the secondary index updated in the same transaction
+        old = await self.get(name)
+        return registry._indexed_set_operations(self._endpoint, name, old, value)
+
+
+def _encode(value):
+    """Convert a value to the bytes stored in the k/v store"""
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+def _decode(value):
+    """Convert a base64 value returned by consul in the stored string"""
+    # Empty values are returned as None
+    if not value:
+        return ''
+    return base64.b64decode(value).decode('utf-8')
+
+
+def _operation(method, url):
+    """Name of the metrics of a request, see registry.enable_metrics"""
+    return 'kv_txn' if url.endswith('/v1/txn') else 'kv_' + method.lower()
+
+
+def _check_status(status, key):
+    """Raise the kvstore exception that corresponds to a read status"""
+    if status == 404:
+        raise kvstore.KeyDoesNotExist("Key " + key.lstrip('/') + " does not exist")
+    if status != 200:
+        raise kvstore.KVStoreError('GET returned {}'.format(status))
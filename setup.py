@@ -11,8 +11,9 @@ setup(
     license='MIT',
     description='Python Resource Allocation API',
     long_description=open('README.rst').read(),
-    py_modules=['registry'],
+    py_modules=['registry', 'registry_aio'],
     install_requires=['kvstore', 'requests', 'jinja2', 'PyYAML', 'futures'],
+    extras_require={'aio': ['aiohttp'], 'stream': ['ijson']},
     test_suite='tests',
     classifiers=[
         'License :: OSI Approved :: MIT License',
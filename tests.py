@@ -1,7 +1,19 @@
 """Tests for the generic service discovery API"""
+import base64
+import hashlib
+import io
+import json
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from collections import OrderedDict
 
+import benchmarks
 import kvstore
+import requests
 import registry
 
 MASTER0 = {
@@ -96,6 +108,54 @@ REGISTRY = {PREFIX: { USER: { PRODUCT: { VERSION: {
 }}}}}}
 
 
+TEMPLATE = """{% set comma = joiner(",") %}
+{
+"status": "pending",
+"nodes": {
+    "master0": {"status": "pending", "cpu": 1, "services": ["master"],
+                "tags": ["master", "yarn"]}
+    {% for n in range(opts['slaves.number']) %}
+    ,"slave{{ n }}": {"status": "pending", "cpu": {{ opts['slaves.cpu'] }},
+                      "services": ["slave"], "clusterid": "{{ clusterid }}"}
+    {% endfor %}
+},
+"services": {
+    "master": {"status": "pending", "nodes": ["master0"]},
+    "slave": {"status": "pending", "nodes": [
+        {% for n in range(opts['slaves.number']) %}{{ comma() }}"slave{{ n }}"{% endfor %}
+    ]}
+}
+}"""
+
+TEMPLATE_YAML = """status: pending
+nodes:
+  master0:
+    status: pending
+    cpu: 1
+    services: [master]
+    tags: [master, yarn]
+{% for n in range(opts['slaves.number']) %}
+  slave{{ n }}:
+    status: pending
+    cpu: {{ opts['slaves.cpu'] }}
+    services: [slave]
+    clusterid: "{{ clusterid }}"
+{% endfor %}
+services:
+  master: {status: pending, nodes: [master0]}
+  slave:
+    status: pending
+    nodes: [{% for n in range(opts['slaves.number']) %}slave{{ n }}, {% endfor %}]
+"""
+
+OPTIONS = json.dumps({
+    'required': {'slaves.number': 2},
+    'optional': {'slaves.cpu': 2},
+    'advanced': {},
+    'descriptions': {},
+})
+
+
 class KVMock(object):
     """Mock KV store for testing"""
     def __init__(self, data):
@@ -106,7 +166,10 @@ class KVMock(object):
         fields = key.split('/')
         value = self._data
         for f in fields:
-            value = value[f]
+            try:
+                value = value[f]
+            except KeyError:
+                raise kvstore.KeyDoesNotExist
         return value
 
     def set(self, key, value):
@@ -136,14 +199,154 @@ class KVMock(object):
         return result
 
     def delete(self, key, recursive=False):
-        if not recursive:
-            raise NotImplementedError
         key = key.strip('/')
         fields = key.split('/')
         prop = self._data
-        for f in fields[:-1]:
-            prop = prop[f]
-        del prop[fields[-1]]
+        try:
+            for f in fields[:-1]:
+                prop = prop[f]
+            if not recursive and isinstance(prop[fields[-1]], dict):
+                raise NotImplementedError
+            del prop[fields[-1]]
+        except KeyError:
+            pass
+
+
+class KVTxnMock(KVMock):
+    """Mock KV store with transactions support"""
+    def __init__(self, data):
+        super(KVTxnMock, self).__init__(data)
+        self.transactions = []
+
+    def txn(self, operations):
+        self.transactions.append(operations)
+        for op in operations:
+            self.set(op[1], op[2])
+
+
+class FlatKVMock(object):
+    """Mock KV store keeping the keys in a flat dict like consul does"""
+    def __init__(self, data):
+        self._data = {}
+        registry._populate(self._data, using=data[PREFIX], prefix=PREFIX)
+        self._indexes = {k: 1 for k in self._data}
+        self._last_index = 1
+        self.requests = 0
+        self.transactions = []
+
+    def get(self, key):
+        self.requests += 1
+        try:
+            return self._data[key.strip('/')]
+        except KeyError:
+            raise kvstore.KeyDoesNotExist
+
+    def get_indexed(self, key):
+        return self.get(key), self._indexes[key.strip('/')]
+
+    def index(self, key, recursive=False):
+        self.requests += 1
+        if recursive:
+            return max(i for k, i in self._indexes.items() if k.startswith(key.lstrip('/')))
+        return self._indexes.get(key.strip('/'))
+
+    def cas(self, key, value, index):
+        self.requests += 1
+        if self._indexes.get(key.strip('/'), 0) != index:
+            return False
+        self._last_index += 1
+        self._data[key.strip('/')] = value
+        self._indexes[key.strip('/')] = self._last_index
+        return True
+
+    def recurse_indexed(self, key):
+        subtree = self.recurse(key)
+        return subtree, max(self._indexes[k] for k in subtree)
+
+    def set(self, key, value):
+        self.requests += 1
+        self._last_index += 1
+        self._data[key.strip('/')] = value
+        self._indexes[key.strip('/')] = self._last_index
+
+    def recurse(self, key):
+        # Plain prefix match, as consul does
+        self.requests += 1
+        key = key.lstrip('/')
+        result = {k: v for k, v in self._data.items() if k.startswith(key)}
+        if not result:
+            raise kvstore.KeyDoesNotExist
+        return result
+
+    def txn(self, operations):
+        self.requests += 1
+        self.transactions.append(operations)
+        for op in operations:
+            if op[0] == 'cas' and self._indexes.get(op[1].strip('/'), 0) != op[3]:
+                raise registry.TransactionError('index is stale')
+            if op[0] == 'get' and op[1].strip('/') not in self._data:
+                raise registry.TransactionError('key does not exist')
+        results = []
+        for op in operations:
+            key = op[1].strip('/')
+            if op[0] in ('set', 'cas'):
+                self._last_index += 1
+                self._data[key] = op[2]
+                self._indexes[key] = self._last_index
+            elif op[0] == 'get':
+                value = base64.b64encode(registry._encode(self._data[key])).decode('ascii')
+                results.append({'KV': {'Key': key, 'Value': value}})
+            else:
+                for k in list(self._data):
+                    if k == key or (op[0] == 'delete-tree' and
+                                    k.startswith(op[1].lstrip('/'))):
+                        del self._data[k]
+        return results
+
+    def keys(self, key, separator=None):
+        self.requests += 1
+        key = key.lstrip('/')
+        keys = set()
+        for k in self._data:
+            if k.startswith(key):
+                position = k.find(separator, len(key)) if separator else -1
+                keys.add(k if position < 0 else k[:position + 1])
+        if not keys:
+            raise kvstore.KeyDoesNotExist
+        return sorted(keys)
+
+    def delete(self, key, recursive=False):
+        self.requests += 1
+        prefix, key = key.lstrip('/'), key.strip('/')
+        for k in list(self._data):
+            if k == key or (recursive and k.startswith(prefix)):
+                del self._data[k]
+
+
+class FakeResponse(object):
+    """Fake response of the requests library"""
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self._data = data
+        self.headers = headers or {}
+
+    def json(self):
+        return self._data
+
+    @property
+    def content(self):
+        return json.dumps(self._data).encode('utf-8') if self._data is not None else b''
+
+
+class FakeSession(object):
+    """Fake requests session that records the requests sent"""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, params=None, data=None, timeout=None):
+        self.requests.append((method, url, params, data, timeout))
+        return self.responses.pop(0)
 
 
 class RegistryNodeTestCase(unittest.TestCase):
@@ -276,6 +479,1409 @@ class RegistryClusterTestCase(unittest.TestCase):
         expected = [registry.Service('{}/cluster1/services/{}'.format(BASEDN, e)) for e in services]
         self.assertEqual(sorted(cluster.services), sorted(expected))
 
+    def test_children_keys_only_and_cached(self):
+        kv = FlatKVMock(REGISTRY)
+        kv.recurse = None
+        registry._kv = kv
+        cluster = registry.Cluster(BASEDN + '/cluster1')
+        kv.requests = 0
+        nodes = cluster.nodes
+        self.assertEqual(kv.requests, 1)
+        self.assertEqual([n.name for n in nodes], ['master0', 'slave0', 'slave1'])
+        self.assertEqual(cluster.nodes, nodes)
+        self.assertEqual(kv.requests, 1)
+        kv.set(BASEDN + '/cluster1/nodes/slave2/cpu', 2)
+        cluster.invalidate()
+        self.assertEqual(len(cluster.nodes), 4)
+        self.assertEqual([d.name for d in nodes[0].disks], ['disk1', 'disk2'])
+        self.assertEqual(registry.Node(BASEDN + '/cluster1/nodes/missing').networks, [])
+
+
+class RegistrySnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock(REGISTRY)
+
+    def test_snapshot_reads_use_one_request(self):
+        cluster = registry.get_cluster(dn=BASEDN + '/cluster1', snapshot=True)
+        hosts = [(n.name, n.host) for n in cluster.nodes]
+        disks = [d.mode for n in cluster.nodes if n.name == 'master0' for d in n.disks]
+        status = cluster.status
+        self.assertEqual(registry._kv.requests, 1)
+        self.assertEqual(sorted(hosts), [('master0', ''),
+                                         ('slave0', ''),
+                                         ('slave1', 'c13-1.local')])
+        self.assertEqual(disks, ['rw', 'rw'])
+        self.assertEqual(status, 'running')
+
+    def test_snapshot_missing_attribute(self):
+        cluster = registry.Cluster.load(BASEDN + '/cluster1')
+        self.assertIsNone(cluster.get('missing'))
+        with self.assertRaises(registry.KeyDoesNotExist):
+            cluster.missing
+
+    def test_snapshot_writes_go_through(self):
+        cluster = registry.Cluster.load(BASEDN + '/cluster1')
+        node = [n for n in cluster.nodes if n.name == 'slave0'][0]
+        node.status = 'running'
+        self.assertEqual(node.status, 'running')
+        self.assertEqual(registry._kv.get(node.dn + '/status'), 'running')
+
+    def test_snapshot_does_not_read_siblings(self):
+        registry._kv.set(BASEDN + '/cluster10/status', 'running')
+        registry._kv.set(BASEDN + '/cluster1/nodes/slave10/status', 'running')
+        cluster = registry.Cluster.load(BASEDN + '/cluster1')
+        self.assertNotIn(BASEDN + '/cluster10/status', cluster._snapshot._data)
+        recursed = []
+        recurse = registry._kv.recurse
+        registry._kv.recurse = lambda key: recursed.append(key) or recurse(key)
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        self.assertEqual(node.to_dict(depth=1)['host'], 'c13-1.local')
+        self.assertEqual(recursed, [node.dn + '/'])
+
+    def test_snapshot_refresh(self):
+        cluster = registry.Cluster.load(BASEDN + '/cluster1')
+        registry._kv.set(BASEDN + '/cluster1/status', 'stopped')
+        self.assertEqual(cluster.status, 'running')
+        cluster.refresh()
+        self.assertEqual(cluster.status, 'stopped')
+
+
+class RegistryReadCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock(REGISTRY)
+        registry.enable_cache(maxsize=2)
+        self.node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+
+    def tearDown(self):
+        registry.disable_cache()
+
+    def test_cache_hit(self):
+        self.assertEqual(self.node.host, 'c13-1.local')
+        self.assertEqual(self.node.host, 'c13-1.local')
+        self.assertEqual(registry._kv.requests, 1)
+        stats = registry.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_cache_invalidated_on_write(self):
+        self.assertEqual(self.node.host, 'c13-1.local')
+        self.node.host = 'c13-2.local'
+        self.assertEqual(self.node.host, 'c13-2.local')
+
+    def test_cache_eviction(self):
+        self.node.host
+        self.node.id
+        self.node.address
+        self.assertEqual(registry.cache_stats()['evictions'], 1)
+        self.node.host
+        self.assertEqual(registry.cache_stats()['misses'], 4)
+
+    def test_cache_prefix_ttl(self):
+        registry.enable_cache(ttls={BASEDN + '/cluster1/nodes/': 0})
+        self.node.host
+        self.node.host
+        self.assertEqual(registry.cache_stats()['misses'], 2)
+
+    def test_cache_revalidation(self):
+        registry.enable_cache(ttl=0, revalidate=True)
+        self.node.host
+        self.node.host
+        self.assertEqual(registry.cache_stats()['revalidations'], 1)
+        registry._kv.set(self.node.dn + '/host', 'c13-3.local')
+        self.assertEqual(self.node.host, 'c13-3.local')
+
+    def test_cache_disabled(self):
+        registry.disable_cache()
+        self.node.host
+        self.node.host
+        self.assertEqual(registry._kv.requests, 2)
+        self.assertIsNone(registry.cache_stats())
+
+
+class RegistryBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock(REGISTRY)
+        self.cluster = registry.Cluster(BASEDN + '/cluster1')
+
+    def test_batch_writes_in_one_transaction(self):
+        nodes = self.cluster.nodes
+        with self.cluster.batch():
+            for node in nodes:
+                node.status = 'starting'
+                node.status = 'running'
+                node.host = 'c13-9.local'
+            self.assertEqual(registry._kv.transactions, [])
+        self.assertEqual(len(registry._kv.transactions), 1)
+        keys = [op[1] for op in registry._kv.transactions[0]]
+        self.assertEqual(len(keys), len(set(keys)))
+        for node in nodes:
+            self.assertEqual(node.status, 'running')
+        self.assertEqual(registry.query_nodes(status='running'), sorted(nodes))
+        self.assertEqual(registry.query_nodes(status='starting'), [])
+
+    def test_batch_reads_see_pending_values(self):
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        with registry.batch():
+            node.host = 'c13-9.local'
+            self.assertEqual(node.host, 'c13-9.local')
+            self.assertEqual(registry._kv.get(node.dn + '/host'), 'c13-1.local')
+
+    def test_nested_batches(self):
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        with registry.batch():
+            with node.batch():
+                node.host = 'c13-9.local'
+            self.assertEqual(registry._kv.transactions, [])
+        self.assertEqual(len(registry._kv.transactions), 1)
+
+    def test_batch_discarded_on_error(self):
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        with self.assertRaises(ValueError):
+            with registry.batch():
+                node.host = 'c13-9.local'
+                raise ValueError()
+        self.assertEqual(node.host, 'c13-1.local')
+        self.assertEqual(registry._kv.transactions, [])
+
+
+class RegistrySerializationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock(REGISTRY)
+
+    def test_node_to_dict_reads_only_fields(self):
+        registry._kv.recurse = None
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        data = node.to_dict()
+        # A keys-only listing and one transaction
+        self.assertEqual(registry._kv.requests, 2)
+        self.assertEqual(data, {'dn': node.dn, 'name': 'slave1', 'cpu': '1',
+                                'mem': '2048', 'host': 'c13-1.local',
+                                'status': 'deployed'})
+
+    def test_cluster_to_dict_reads_only_fields(self):
+        registry._kv.recurse = None
+        cluster = registry.Cluster(BASEDN + '/cluster1')
+        self.assertEqual(cluster.to_dict(), {'dn': cluster.dn, 'name': 'cluster1',
+                                             'status': 'running'})
+        self.assertEqual(registry._kv.requests, 2)
+        self.assertEqual(cluster.to_dict(fields=('status', 'missing'))['missing'], None)
+
+    def test_document_to_dict_uses_one_request(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS,
+                          layout=registry.LAYOUT_DOCUMENT)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        node = registry.Node(cluster.dn + '/nodes/slave1')
+        node.host = 'c13-2'
+        registry._kv.recurse = None
+        registry._kv.requests = 0
+        self.assertEqual(node.to_dict()['host'], 'c13-2')
+        self.assertEqual(cluster.to_dict()['status'], 'pending')
+        self.assertEqual(registry._kv.requests, 2)
+
+    def test_to_dict_missing_object(self):
+        node = registry.Node(BASEDN + '/cluster1/nodes/missing')
+        self.assertEqual(node.to_dict()['status'], None)
+
+    def test_cluster_to_dict_depth(self):
+        cluster = registry.Cluster(BASEDN + '/cluster1')
+        data = cluster.to_dict(depth=2)
+        self.assertEqual(registry._kv.requests, 1)
+        self.assertEqual([n['name'] for n in data['nodes']],
+                         ['master0', 'slave0', 'slave1'])
+        self.assertEqual([d['name'] for d in data['nodes'][0]['disks']],
+                         ['disk1', 'disk2'])
+        self.assertEqual(data['nodes'][2]['disks'], [])
+        self.assertEqual(sorted(data['services'][0]), ['dn', 'name', 'status'])
+
+    def test_node_scalar_disks(self):
+        registry._kv.set(BASEDN + '/cluster1/nodes/slave1/disks', '2')
+        node = registry.Node(BASEDN + '/cluster1/nodes/slave1')
+        self.assertEqual(node.disks, [])
+        self.assertEqual(node.to_dict(depth=1)['disks'], [])
+
+    def test_query_clusters_fields(self):
+        clusters = registry.query_clusters(USER, fields=('status',))
+        self.assertEqual(registry._kv.requests, 1)
+        self.assertEqual(clusters, [{'dn': BASEDN + '/cluster1',
+                                     'name': 'cluster1', 'status': 'running'}])
+
+    def test_query_clusters_fields_not_found(self):
+        self.assertIsNone(registry.query_clusters('nobody', fields=True))
+
+
+class RegistryInstantiateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.configure_templates()
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+
+    def tearDown(self):
+        registry.configure_templates()
+        registry.PRODUCT_CHECK_INTERVAL = 30
+
+    def test_instantiate(self):
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 3})
+        self.assertEqual(cluster.dn, BASEDN + '/1')
+        self.assertEqual(len(cluster.nodes), 4)
+        self.assertEqual(registry.Node(cluster.dn + '/nodes/slave2').cpu, 2)
+
+    def test_instantiate_missing_product(self):
+        with self.assertRaises(registry.KeyDoesNotExist):
+            registry.instantiate(USER, 'missing', VERSION, {'slaves.number': 1})
+
+    def test_instantiate_invalid_options(self):
+        with self.assertRaises(registry.InvalidOptionsError):
+            registry.instantiate(USER, PRODUCT, VERSION, {})
+
+    def test_product_metadata_cached(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry._kv.requests = 0
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        # Only generate_id() (get and cas) and save() access the k/v store
+        self.assertEqual(registry._kv.requests, 3)
+
+    def test_product_metadata_revision_check(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.PRODUCT_CHECK_INTERVAL = 0
+        registry._kv.requests = 0
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        self.assertEqual(registry._kv.requests, 4)
+        options = json.loads(OPTIONS)
+        options['optional']['slaves.cpu'] = 4
+        registry._kv.set('products/{}/{}/options'.format(PRODUCT, VERSION),
+                         json.dumps(options))
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        self.assertEqual(registry.Node(cluster.dn + '/nodes/slave0').cpu, 4)
+
+    def test_product_metadata_ignores_other_versions(self):
+        registry.register(PRODUCT, VERSION + '0', 'Test product', TEMPLATE, OPTIONS)
+        info = registry._product_info('products/{}/{}'.format(PRODUCT, VERSION))
+        registry.PRODUCT_CHECK_INTERVAL = 0
+        registry.register(PRODUCT, VERSION + '0', 'Other product', TEMPLATE, OPTIONS)
+        self.assertIs(registry._product_info(info.dn), info)
+
+    def test_product_metadata_invalidated_by_deregister(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.deregister(PRODUCT, VERSION)
+        with self.assertRaises(registry.KeyDoesNotExist):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+
+    def test_templates_compiled_once(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        stats = registry._templates.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_templates_recompiled_after_register(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE + '\n', OPTIONS)
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        self.assertEqual(registry._templates.stats()['misses'], 2)
+
+    def test_templates_bytecode_cache(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            registry.configure_templates(bytecode_cache_dir=cachedir)
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+            # A new environment, like after a restart, reuses the bytecode
+            registry.configure_templates(bytecode_cache_dir=cachedir)
+
+            def compile_not_expected(*args, **kwargs):
+                raise AssertionError('template compiled again')
+            registry._jinja.compile = compile_not_expected
+            cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+            self.assertEqual(len(cluster.nodes), 2)
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_clone_cluster(self):
+        source = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 200})
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        for _ in range(8):
+            registry.generate_id(BASEDN)
+        registry.Node(BASEDN + '/1/nodes/master0').host = 'c13-1'
+        registry._kv.requests, registry._kv.transactions = 0, []
+        recursed = []
+        recurse = registry._kv.recurse
+        registry._kv.recurse = lambda key: recursed.append(key) or recurse(key)
+        clone = registry.clone_cluster(source.dn)
+        del registry._kv.recurse
+        self.assertEqual(clone.dn, BASEDN + '/11')
+        # Cluster 10 does not share the read
+        self.assertEqual(recursed, [source.dn + '/'])
+        # recurse, generate_id (get and cas) and the bulk transactions
+        self.assertEqual(registry._kv.requests, 3 + len(registry._kv.transactions))
+        written = sum(len(t) for t in registry._kv.transactions)
+        self.assertEqual(len(registry._kv.transactions), -(-written // registry.TXN_MAX_OPS))
+        self.assertEqual(len(clone.nodes), 201)
+        self.assertEqual(registry.Node(clone.dn + '/nodes/slave9').clusterid,
+                         registry.id_from(clone.dn))
+        self.assertEqual(registry.query_nodes(host='c13-1'),
+                         [registry.Node(BASEDN + '/1/nodes/master0'),
+                          registry.Node(clone.dn + '/nodes/master0')])
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_clone_cluster_user_and_id(self):
+        source = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.Node(source.dn + '/nodes/slave0').set('peer', registry.id_from(BASEDN + '/10'))
+        clone = registry.clone_cluster('user/product/1.0.0/1', user='other', id=7)
+        self.assertEqual(clone.dn, 'clusters/other/product/1.0.0/7')
+        self.assertEqual(registry.Node(clone.dn + '/nodes/slave0').clusterid,
+                         'clusters--other--product--1__0__0--7')
+        self.assertEqual(registry.Node(clone.dn + '/nodes/slave0').peer,
+                         registry.id_from(BASEDN + '/10'))
+        with self.assertRaises(registry.ClusterAlreadyExistsError):
+            registry.clone_cluster(source.dn, id=2)
+        with self.assertRaises(registry.KeyDoesNotExist):
+            registry.clone_cluster(BASEDN + '/3')
+        self.assertEqual(registry.generate_id(BASEDN), 3)
+
+
+class RegistryIdAllocationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock(REGISTRY)
+        for i in (1, 7):
+            registry._kv.set('{}/{}/status'.format(BASEDN, i), 'running')
+
+    def test_generate_id_seeds_counter(self):
+        self.assertEqual(registry.generate_id(BASEDN), 8)
+        registry._kv.requests = 0
+        self.assertEqual(registry.generate_id(BASEDN), 9)
+        # get + cas, the instances are not scanned again
+        self.assertEqual(registry._kv.requests, 2)
+        self.assertEqual(registry._kv.get('counters/' + BASEDN), 9)
+
+    def test_generate_id_new_prefix(self):
+        self.assertEqual(registry.generate_id('clusters/other/product/1.0'), 1)
+
+    def test_generate_ids_block(self):
+        self.assertEqual(registry.generate_ids(BASEDN, 3), [8, 9, 10])
+        self.assertEqual(registry.generate_id(BASEDN), 11)
+
+    def test_instantiate_reserved_ids(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        ids = registry.generate_ids(BASEDN, 3)
+        clusters = [registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}, id=i)
+                    for i in ids]
+        self.assertEqual([c.dn for c in clusters], [BASEDN + '/' + str(i) for i in ids])
+        self.assertEqual(clusters[0].status, 'pending')
+        self.assertEqual(registry.instantiate(USER, PRODUCT, VERSION,
+                                              {'slaves.number': 1}).dn, BASEDN + '/11')
+        with self.assertRaises(registry.ClusterAlreadyExistsError):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}, id=ids[0])
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}, id=20)
+        self.assertEqual(registry.generate_id(BASEDN), 21)
+
+    def test_generate_id_retries_on_conflict(self):
+        registry.generate_id(BASEDN)
+        cas = registry._kv.cas
+        calls = []
+
+        def concurrent_cas(key, value, index):
+            if not calls:
+                # Another client allocates an ID before us
+                calls.append(cas(key, value, index))
+            return cas(key, value, index)
+        registry._kv.cas = concurrent_cas
+        self.assertEqual(registry.generate_id(BASEDN), 10)
+
+    def test_generate_id_without_cas_support(self):
+        registry._kv = KVMock({PREFIX: {USER: {PRODUCT: {VERSION: {'3': {}}}}}})
+        self.assertEqual(registry.generate_id(BASEDN), 4)
+
+    def test_migrate_counters(self):
+        registry._kv.set('counters/' + BASEDN, 10)
+        last_ids = registry.migrate_counters()
+        self.assertEqual(last_ids, {BASEDN: 7})
+        # Counters are never decreased
+        self.assertEqual(registry._kv.get('counters/' + BASEDN), 10)
+
+
+class RegistryIndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        self.cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+
+    def test_query_nodes_by_attribute(self):
+        master0 = registry.Node(self.cluster.dn + '/nodes/master0')
+        slaves = [registry.Node(self.cluster.dn + '/nodes/slave{}'.format(i))
+                  for i in range(2)]
+        self.assertEqual(registry.query_nodes(tag='yarn'), [master0])
+        self.assertEqual(registry.query_nodes(service='slave'), slaves)
+        self.assertEqual(len(registry.query_nodes(status='pending')), 3)
+        self.assertEqual(registry.query_nodes(status='pending', tag='master'), [master0])
+        self.assertEqual(registry.query_nodes(host='c13-1'), [])
+
+    def test_query_nodes_uses_one_request_per_filter(self):
+        registry._kv.requests = 0
+        registry.query_nodes(status='pending', service='slave')
+        self.assertEqual(registry._kv.requests, 2)
+
+    def test_query_nodes_requires_filter(self):
+        with self.assertRaises(ValueError):
+            registry.query_nodes()
+
+    def test_index_updated_on_write(self):
+        node = registry.Node(self.cluster.dn + '/nodes/slave1')
+        node.host = 'c13-1'
+        node.status = 'failed'
+        self.assertEqual(registry.query_nodes(host='c13-1'), [node])
+        self.assertEqual(registry.query_nodes(status='failed'), [node])
+        self.assertEqual({n.cluster for n in registry.query_nodes(status='failed')},
+                         {self.cluster})
+        self.assertNotIn(node, registry.query_nodes(status='pending'))
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_index_removed_on_deinstantiate(self):
+        registry.deinstantiate(USER, PRODUCT, VERSION, self.cluster.name)
+        self.assertEqual(registry.query_nodes(status='pending'), [])
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            registry._kv.recurse(self.cluster.dn)
+
+    def test_verify_and_rebuild_indexes(self):
+        registry._kv.delete('index', recursive=True)
+        registry._kv.set('index/host/c13-1/stale', '')
+        missing, stale = registry.verify_indexes()
+        self.assertEqual(len(missing), 8)
+        self.assertEqual(stale, ['index/host/c13-1/stale'])
+        registry.rebuild_indexes()
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+
+class RegistryClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = registry.Client('http://consul:8500/v1/kv', timeout=(1, 2))
+
+    def test_get(self):
+        value = base64.b64encode(b'running').decode('ascii')
+        self.client.session = FakeSession(FakeResponse(data=[{'Value': value}]))
+        self.assertEqual(self.client.get('/a/status'), 'running')
+        request = self.client.session.requests[0]
+        self.assertEqual(request[:2], ('GET', 'http://consul:8500/v1/kv/a/status'))
+        self.assertEqual(request[4], (1, 2))
+
+    def test_get_blocking_query_without_read_timeout(self):
+        self.client.session = FakeSession()
+        self.client.watch_session = FakeSession(FakeResponse(data=[{'Value': None}]))
+        self.assertEqual(self.client.get('a', wait=True, wait_index=10), '')
+        # Sent outside the pool of connections
+        self.assertEqual(self.client.session.requests, [])
+        self.assertEqual(self.client.watch_session.requests[0][4], (1, None))
+
+    def test_index_lists_only_the_keys(self):
+        self.client.session = FakeSession(FakeResponse(data=['a/b'],
+                                                       headers={'X-Consul-Index': '7'}))
+        self.assertEqual(self.client.index('a/b'), '7')
+        self.assertEqual(self.client.session.requests[0][2], {'keys': 'true'})
+
+    def test_index_recursive(self):
+        self.client.session = FakeSession(FakeResponse(404, headers={'X-Consul-Index': '7'}))
+        self.assertEqual(self.client.index('a', recursive=True), '7')
+        self.assertEqual(self.client.session.requests[0][2], {'keys': 'true', 'recurse': 'true'})
+
+    def test_index_error(self):
+        self.client.session = FakeSession(FakeResponse(500))
+        with self.assertRaises(kvstore.KVStoreError):
+            self.client.index('a')
+
+    def test_get_missing_key(self):
+        self.client.session = FakeSession(FakeResponse(404))
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            self.client.get('a')
+
+    def test_keys(self):
+        self.client.session = FakeSession(FakeResponse(data=['a/b/', 'a/c']))
+        self.assertEqual(self.client.keys('a/', separator='/'), ['a/b/', 'a/c'])
+        self.assertEqual(self.client.session.requests[0][2],
+                         {'keys': 'true', 'separator': '/'})
+
+    def test_txn(self):
+        self.client.session = FakeSession(FakeResponse(data={'Results': []}))
+        self.client.txn([('set', 'a/b', 1), ('delete-tree', 'c')])
+        method, url, _, data, _ = self.client.session.requests[0]
+        self.assertEqual((method, url), ('PUT', 'http://consul:8500/v1/txn'))
+        self.assertEqual(json.loads(data), [
+            {'KV': {'Verb': 'set', 'Key': 'a/b', 'Value': base64.b64encode(b'1').decode('ascii')}},
+            {'KV': {'Verb': 'delete-tree', 'Key': 'c'}}])
+
+    def test_txn_not_supported(self):
+        self.client.session = FakeSession(FakeResponse(404))
+        with self.assertRaises(registry.TransactionsNotSupportedError):
+            self.client.txn([('set', 'a', 1)])
+        self.assertFalse(self.client.txn_supported)
+
+    def test_txn_rolled_back(self):
+        errors = {'Errors': [{'OpIndex': 0, 'What': 'failed'}]}
+        self.client.session = FakeSession(FakeResponse(409, errors))
+        with self.assertRaises(registry.TransactionError):
+            self.client.txn([('set', 'a', 1)])
+
+    def test_connect_pool_size(self):
+        writers = registry.WRITERS
+        registry.connect('http://consul:8500/v1/kv', pool_size=16)
+        self.assertEqual(registry.WRITERS, writers)
+        self.assertEqual(registry._kv.pool_size, 16)
+        self.assertEqual(registry.writer_stats()['workers'], 16)
+        self.assertEqual(registry.pool_stats(), {'pool_size': 16, 'connections': 0,
+                                                 'requests': 0, 'idle': 0})
+
+    def test_connect_closes_previous_client(self):
+        registry.connect('local://')
+        previous = registry._kv
+        registry.connect('http://consul:8500/v1/kv')
+        self.assertTrue(previous._closed)
+        closed = []
+        registry._kv.session.close = lambda: closed.append('session')
+        registry._kv.watch_session.close = lambda: closed.append('watch_session')
+        registry.close()
+        self.assertEqual(closed, ['session', 'watch_session'])
+
+
+class RegistryConsulServerTestCase(unittest.TestCase):
+    """Use the real client against the consul stand-in of the benchmarks"""
+
+    def setUp(self):
+        self.server = benchmarks.ConsulServer().start()
+        registry.connect(self.server.endpoint)
+
+    def tearDown(self):
+        registry.close()
+        self.server.stop()
+
+    def test_instantiate_and_query(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        self.assertEqual(registry.query_clusters(USER), [cluster])
+        self.assertEqual(len(cluster.nodes), 3)
+        self.assertEqual(cluster.to_dict(depth=1)['status'], 'pending')
+        self.assertEqual(registry.query_nodes(tag='yarn'),
+                         [registry.Node(cluster.dn + '/nodes/master0')])
+        registry.deinstantiate(USER, PRODUCT, VERSION, 1)
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_blocking_queries_do_not_exhaust_pool(self):
+        registry.connect(self.server.endpoint, pool_size=2)
+        registry._kv.set('a/b', 'x')
+        index = registry._kv.index('a', recursive=True)
+        watchers = [threading.Thread(target=registry._kv.recurse_indexed,
+                                     args=('a/',), kwargs={'wait': True, 'wait_index': index,
+                                                           'timeout': '2s'})
+                    for _ in range(3)]
+        for watcher in watchers:
+            watcher.start()
+        time.sleep(0.2)
+        start = time.time()
+        self.assertEqual(registry._kv.get('a/b'), 'x')
+        self.assertLess(time.time() - start, 1)
+        registry._kv.set('a/b', 'y')
+        for watcher in watchers:
+            watcher.join()
+
+    def test_blocking_query_waits_for_its_subtree(self):
+        registry._kv.set('a/b', 'x')
+        index = registry._kv.index('a/', recursive=True)
+        elapsed = []
+        for change in (lambda: registry._kv.set('c', 'z'),
+                       lambda: registry._kv.delete('a/b')):
+            timer = threading.Timer(0.1, change)
+            timer.start()
+            start = time.time()
+            try:
+                registry._kv.recurse_indexed('a/', wait=True, wait_index=index, timeout='1s')
+            except kvstore.KeyDoesNotExist:
+                pass
+            elapsed.append(time.time() - start)
+            timer.join()
+        # Only the delete below a/ releases the query before the timeout
+        self.assertGreaterEqual(elapsed[0], 1)
+        self.assertLess(elapsed[1], 0.9)
+
+    def test_cache_revalidation_with_prefix_siblings(self):
+        registry._kv.set('a/b', 'x')
+        registry._kv.set('a/bc', 'y')
+        registry.enable_cache(ttl=0, revalidate=True)
+        try:
+            for _ in range(3):
+                self.assertEqual(registry._cache.fetch('a/b'), 'x')
+            # The first revalidation keeps the index of a/bc, which is newer
+            self.assertEqual(registry.cache_stats()['revalidations'], 1)
+            registry._kv.set('a/b', 'z')
+            self.assertEqual(registry._cache.fetch('a/b'), 'z')
+        finally:
+            registry.disable_cache()
+
+    def test_document_layout_writes(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS,
+                          layout=registry.LAYOUT_DOCUMENT)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        node = registry.Node(cluster.dn + '/nodes/slave0')
+        node.status = 'running'
+        cluster.status = 'running'
+        registry._layouts.clear()
+        self.assertEqual(node.status, 'running')
+        self.assertEqual(cluster.status, 'running')
+        self.assertEqual(registry.query_nodes(status='running'), [node])
+
+    def test_to_dict_reads_fields_in_a_transaction(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        requests = self.server.store.requests
+        data = registry.Node(cluster.dn + '/nodes/slave1').to_dict()
+        self.assertEqual(self.server.store.requests - requests, 2)
+        self.assertEqual((data['cpu'], data['status']), ('2', 'pending'))
+        registry._kv.delete(cluster.dn + '/nodes/slave1/cpu')
+        self.assertIsNone(registry.Node(cluster.dn + '/nodes/slave1').to_dict()['cpu'])
+
+    def test_fallback_without_txn_endpoint(self):
+        class NoTxnHandler(benchmarks.ConsulHandler):
+            def _txn(self, payload):
+                self._reply(404)
+        self.server.RequestHandlerClass = NoTxnHandler
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        self.assertFalse(registry._kv.txn_supported)
+        self.assertEqual(len(cluster.nodes), 3)
+        cluster.nodes[0].status = 'running'
+        self.assertEqual(registry.query_nodes(status='running'), [cluster.nodes[0]])
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_txn_check_and_set(self):
+        registry._kv.set('a/b', 'x')
+        index = registry._kv.get_indexed('a/b')[1]
+        self.assertFalse(registry._kv.cas('a/b', 'y', 0))
+        self.assertTrue(registry._kv.cas('a/b', 'y', index))
+        with self.assertRaises(registry.TransactionError):
+            registry._kv.txn([('set', 'a/c', 'z'), ('cas', 'a/b', 'w', index)])
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            registry._kv.get('a/c')
+
+
+class RegistryLocalClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = self.tmpdir + '/registry.db'
+
+    def tearDown(self):
+        registry.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_connect_in_memory(self):
+        registry.connect('local://')
+        self.assertIsNone(registry._kv.path)
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        self.assertEqual(registry.query_clusters(USER), [cluster])
+        self.assertEqual(cluster.to_dict(depth=1)['nodes'][1]['cpu'], '2')
+        self.assertEqual(len(registry.query_nodes(service='slave')), 2)
+        registry.deinstantiate(USER, PRODUCT, VERSION, 1)
+        self.assertIsNone(registry.query_clusters(USER))
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_persistence(self):
+        registry.connect('local://' + self.path)
+        registry._kv.set('a/b', 1)
+        registry._kv.txn([('set', 'a/c/d', u'\xe1'), ('set', 'a/c/e', 'x')])
+        registry._kv.delete('a/c/e')
+        index = registry._kv.index('a', recursive=True)
+        registry.close()
+        kv = registry.LocalClient(self.path)
+        self.assertEqual(kv.recurse('a'), {'a/b': '1', 'a/c/d': registry._to_str(u'\xe1')})
+        self.assertEqual(kv.index('a', recursive=True), index)
+        kv.set('a/f', 'y')
+        self.assertGreater(kv.index('a/f'), index)
+        kv.close()
+
+    def test_listings(self):
+        kv = registry._kv = registry.LocalClient()
+        for key in ('a/b/c', 'a/b/d', 'a/e', 'ab/f'):
+            kv.set(key, key)
+        self.assertEqual(sorted(kv.recurse('a/')), ['a/b/c', 'a/b/d', 'a/e'])
+        # Prefix matching like consul
+        self.assertEqual(len(kv.recurse('a')), 4)
+        self.assertEqual(kv.keys('a/', separator='/'), ['a/b/', 'a/e'])
+        kv.delete('a/b', recursive=True)
+        self.assertEqual(kv.keys('a'), ['a/e', 'ab/f'])
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            kv.get('a/b/c')
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            kv.recurse('a/b')
+
+    def test_check_and_set(self):
+        kv = registry._kv = registry.LocalClient()
+        self.assertTrue(kv.cas('a', 1, 0))
+        self.assertFalse(kv.cas('a', 2, 0))
+        value, index = kv.get_indexed('a')
+        with self.assertRaises(registry.TransactionError):
+            kv.txn([('set', 'b', 1), ('cas', 'a', 3, index - 1)])
+        self.assertEqual(kv.keys(''), ['a'])
+        kv.txn([('set', 'b', 1), ('cas', 'a', 3, index)])
+        self.assertEqual(kv.get('a'), '3')
+
+    def test_blocking_query(self):
+        kv = registry._kv = registry.LocalClient()
+        kv.set('a/b', 'x')
+        index = kv.index('a', recursive=True)
+        timer = threading.Timer(0.05, kv.delete, ['a/b'])
+        timer.start()
+        start = time.time()
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            kv.recurse('a', wait=True, wait_index=index, timeout='5s')
+        self.assertLess(time.time() - start, 5)
+        timer.join()
+
+
+class FlakyKV(object):
+    """Wrap a k/v store client making the first reads of a subtree fail"""
+    def __init__(self, kv, failures):
+        self.kv = kv
+        self.failures = failures
+
+    def recurse_indexed(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise requests.ConnectionError('connection refused')
+        return self.kv.recurse_indexed(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.kv, name)
+
+
+class RegistryWatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry.connect('local://')
+        self.cluster = registry.Cluster(BASEDN + '/1')
+        self.node = registry.Node(BASEDN + '/1/nodes/node0')
+        registry._kv.set(self.cluster.dn + '/status', 'pending')
+        registry._kv.set(self.node.dn + '/status', 'pending')
+        self.events = []
+        self.received = threading.Event()
+
+    def tearDown(self):
+        for watcher in registry._watchers.values():
+            watcher.stop()
+        registry._watchers.clear()
+        # Wake up the blocking queries of the stopped watchers
+        registry.close()
+        for thread in threading.enumerate():
+            if thread.name.startswith('watch '):
+                thread.join(5)
+
+    def callback(self, changes):
+        self.events.append(changes)
+        self.received.set()
+
+    def test_watch_shared_subtree(self):
+        subscription = registry.watch(self.cluster.dn, self.callback)
+        subscription.watcher.wait_ready(5)
+        node_events, node_received = [], threading.Event()
+        node_subscription = registry.watch(
+            self.node.dn, lambda changes: node_events.append(changes) or node_received.set())
+        self.assertEqual(len(registry._watchers), 1)
+        self.assertIs(node_subscription.watcher, subscription.watcher)
+        registry._kv.txn([('set', self.cluster.dn + '/status', 'running'),
+                          ('delete', self.node.dn + '/status')])
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.events, [{self.cluster.dn + '/status': 'running',
+                                        self.node.dn + '/status': None}])
+        self.assertTrue(node_received.wait(5))
+        self.assertEqual(node_events, [{self.node.dn + '/status': None}])
+        node_subscription.cancel()
+        subscription.cancel()
+        self.assertEqual(registry._watchers, {})
+
+    def test_watch_ignores_sibling_ids(self):
+        other = BASEDN + '/10/status'
+        registry._kv.set(other, 'pending')
+        subscription = registry.watch(self.cluster.dn, self.callback)
+        subscription.watcher.wait_ready(5)
+        self.assertNotIn(other, subscription.watcher.data)
+        registry._kv.set(other, 'running')
+        registry._kv.set(self.cluster.dn + '/status', 'running')
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.events, [{self.cluster.dn + '/status': 'running'}])
+        subscription.cancel()
+
+    def test_wait_for(self):
+        timer = threading.Timer(0.1, lambda: setattr(self.node, 'status', 'running'))
+        timer.start()
+        self.assertTrue(self.node.wait_for('status', 'running', timeout=5))
+        self.assertTrue(self.node.wait_for('status', lambda v: v != 'pending', timeout=5))
+        self.assertFalse(self.cluster.wait_for('status', 'running', timeout=0.2))
+        self.assertEqual(registry._watchers, {})
+
+    def test_backoff(self):
+        registry._kv = FlakyKV(registry._kv, failures=3)
+        watcher = registry.Watcher(self.cluster.dn, backoff=(0.01, 0.02)).start()
+        try:
+            self.assertTrue(watcher.wait_ready(5))
+            self.assertEqual(watcher.errors, 3)
+            self.assertEqual(watcher.data[self.cluster.dn + '/status'], 'pending')
+        finally:
+            watcher.stop()
+            registry._kv = registry._kv.kv
+
+
+class RegistryMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.enable_metrics()
+
+    def tearDown(self):
+        registry.disable_metrics()
+
+    def test_disabled(self):
+        registry.disable_metrics()
+        registry._kv.set('a', 1)
+        self.assertEqual(registry.Proxy('a').get('a', 'x'), 'x')
+        self.assertIsNone(registry.stats())
+        self.assertEqual(registry.prometheus_metrics(), '')
+
+    def test_public_api_and_proxies(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        for node in cluster.nodes:
+            node.status = 'running'
+        with self.assertRaises(registry.KeyDoesNotExist):
+            cluster.missing
+        stats = registry.stats()
+        self.assertEqual(stats['instantiate']['count'], 1)
+        self.assertEqual(stats['save']['count'], 1)
+        self.assertEqual(stats['Cluster.nodes']['count'], 1)
+        self.assertEqual(stats['proxy_write']['count'], 3)
+        self.assertEqual(stats['proxy_read']['errors'], 1)
+        histogram = stats['instantiate']['buckets']
+        self.assertEqual(histogram[-1], (float('inf'), 1))
+        self.assertEqual(len(histogram), len(registry.METRICS_BUCKETS) + 1)
+
+    def test_kv_requests(self):
+        client = registry.Client('http://consul:8500/v1/kv')
+        client.session = FakeSession(FakeResponse(data=[{'Value': base64.b64encode(b'x').decode('ascii')}]),
+                                     FakeResponse(status_code=404),
+                                     FakeResponse(data=True))
+        client.get('a')
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            client.get('b')
+        client.set('a', 'abc')
+        stats = registry.stats()
+        self.assertEqual(stats['kv_get']['count'], 2)
+        self.assertEqual(stats['kv_get']['errors'], 0)
+        self.assertGreater(stats['kv_get']['received'], 0)
+        self.assertEqual(stats['kv_put']['sent'], 3)
+
+    def test_prometheus_format(self):
+        registry._metrics.observe('save', 0.003)
+        registry._metrics.observe('save', 20, error=True, sent=10)
+        text = registry.prometheus_metrics()
+        self.assertIn('registry_operation_seconds_bucket{operation="save",le="0.005"} 1', text)
+        self.assertIn('registry_operation_seconds_bucket{operation="save",le="+Inf"} 2', text)
+        self.assertIn('registry_operation_seconds_count{operation="save"} 2', text)
+        self.assertIn('registry_errors_total{operation="save"} 1', text)
+        self.assertIn('registry_sent_bytes_total{operation="save"} 10', text)
+
+
+class RegistryStreamingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        registry.register(PRODUCT, '2.0.0', 'Test product', TEMPLATE_YAML, OPTIONS,
+                          templatetype='yaml+jinja2')
+
+    def assertSameKeys(self, version):
+        info = registry._product_info('products/{}/{}'.format(PRODUCT, version))
+        opts = registry._instance_options(info, {'slaves.number': 3})
+        args = (info, opts, USER, PRODUCT, version, BASEDN + '/1')
+        self.assertEqual(dict(registry._iter_instance_kvinfo(*args)),
+                         registry._instance_kvinfo(*args))
+
+    def test_same_keys_json(self):
+        self.assertSameKeys(VERSION)
+
+    def test_same_keys_json_without_ijson(self):
+        ijson, registry.ijson = registry.ijson, None
+        try:
+            self.assertSameKeys(VERSION)
+        finally:
+            registry.ijson = ijson
+
+    def test_same_keys_yaml(self):
+        self.assertSameKeys('2.0.0')
+
+    def test_writes_overlap_with_rendering(self):
+        produced, written = [0], []
+        generator = registry._iter_instance_kvinfo
+
+        def counting(*args):
+            for pair in generator(*args):
+                produced[0] += 1
+                yield pair
+        txn = registry._kv.txn
+        registry._kv.txn = lambda ops: (written.append(produced[0]), txn(ops))
+        registry._iter_instance_kvinfo = counting
+        try:
+            cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 100},
+                                           stream=True)
+        finally:
+            registry._iter_instance_kvinfo = generator
+        self.assertEqual(len(cluster.nodes), 101)
+        # The first batches were written before the last keys were produced
+        self.assertLess(min(written), produced[0])
+
+    def test_template_error_removes_partial_cluster(self):
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        template = TEMPLATE.rstrip()[:-1] + ', "bad": [[1]]}'
+        registry.register(PRODUCT, VERSION, 'Test product', template, OPTIONS)
+        registry._kv.transactions = []
+        with self.assertRaises(registry.NestedListsNotSupportedError):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 100},
+                                 stream=True)
+        # Some keys were written before the error
+        self.assertGreater(len(registry._kv.transactions), 1)
+        self.assertEqual([c.dn for c in registry.query_clusters(USER)], [BASEDN + '/1'])
+        self.assertEqual(registry.verify_indexes(), ([], []))
+        self.assertEqual(len(registry.query_nodes(service='slave')), 1)
+
+    def test_progress_without_total(self):
+        progress = []
+        registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2}, stream=True,
+                             progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress[-1][1], None)
+        self.assertGreater(progress[-1][0], 0)
+
+    @unittest.skipIf(registry.ijson is None, 'ijson not installed')
+    def test_events_same_errors(self):
+        documents = ['{"a": {"b": 1, "c": [1, "x", 2.5]}, "d": true}', '"x"', '[1, 2]',
+                     '{"a": [1, {"b": 2}]}', '{"a": [[1]]}', '{"a": null}', 'null']
+        for document in documents:
+            expected = {}
+            try:
+                registry._populate(expected, json.loads(document), 'p')
+            except Exception as e:
+                expected = (type(e), str(e))
+            try:
+                result = dict(registry._iter_populate_events(
+                    registry.ijson.parse(io.BytesIO(document.encode('utf-8'))), 'p'))
+            except Exception as e:
+                result = (type(e), str(e))
+            self.assertEqual(result, expected)
+
+
+class RegistryPopulateTestCase(unittest.TestCase):
+    """The flattening engine must behave as the recursive reference"""
+
+    def assertSameAsReference(self, data, prefix='p'):
+        expected, result = {}, {}
+        try:
+            benchmarks.populate_reference(expected, data, prefix)
+        except Exception as e:
+            expected = (type(e), str(e), expected)
+        try:
+            registry._populate(result, data, prefix)
+        except Exception as e:
+            result = (type(e), str(e), result)
+        self.assertEqual(result, expected)
+
+    def test_cluster_document(self):
+        self.assertSameAsReference(benchmarks.cluster_document(1000), BASEDN + '/1')
+
+    def test_values_and_lists(self):
+        for data in ('x', 1, 2.5, True, [1, 'a', False], (1, 2), set(['a']), {},
+                     {1: 'a', 2.5: {'b': [None is None]}}, {'a': {'b': {'c': {'d': 1}}}}):
+            self.assertSameAsReference(data)
+
+    def test_errors(self):
+        for data in (None, [[1]], [{'a': 1}], {'a': 1, 'b': [1, [2]]},
+                     {'a': {'b': None}}, {'a': object}, {'a': {'b': 1}, 'c': [{}]}):
+            self.assertSameAsReference(data)
+
+    def test_subclasses(self):
+        self.assertSameAsReference(OrderedDict([('b', 1), ('a', OrderedDict([('c', [1])]))]))
+
+
+class RegistryQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = FlatKVMock({PREFIX: {}})
+        for dn in ('user/product/1.0.0/1', 'user/product/1.0.0/2', 'user/product/1.0.0/10',
+                   'user/product/2.0.0/1', 'user/other/1.0.0/3', 'admin/product/1.0.0/1'):
+            self.kv.set('{}/{}/status'.format(PREFIX, dn), 'running')
+            self.kv.set('{}/{}/nodes/node0/name'.format(PREFIX, dn), 'node0')
+        registry._kv = self.kv
+        self.kv.recurse = None
+
+    def dns(self, clusters):
+        return [c.dn[len(PREFIX) + 1:] for c in clusters]
+
+    def test_sorted_keys_only(self):
+        self.assertEqual(self.dns(registry.query_clusters()), [
+            'admin/product/1.0.0/1', 'user/other/1.0.0/3', 'user/product/1.0.0/1',
+            'user/product/1.0.0/2', 'user/product/1.0.0/10', 'user/product/2.0.0/1'])
+        self.assertEqual(self.dns(registry.query_clusters(USER, PRODUCT, '1.0.0', reverse=True)),
+                         ['user/product/1.0.0/10', 'user/product/1.0.0/2', 'user/product/1.0.0/1'])
+        self.assertIsNone(registry.query_clusters('nobody'))
+
+    def test_fields_without_prefix_siblings(self):
+        del self.kv.recurse
+        self.kv.set(PREFIX + '/user2/product/1.0.0/1/status', 'running')
+        self.kv.set(PREFIX + '/user/product/1.0.0/1/nodes/node10/name', 'node10')
+        clusters = registry.query_clusters(USER, fields=True)
+        self.assertEqual([c['dn'] for c in clusters], [PREFIX + '/' + dn for dn in (
+            'user/other/1.0.0/3', 'user/product/1.0.0/1', 'user/product/1.0.0/2',
+            'user/product/1.0.0/10', 'user/product/2.0.0/1')])
+        clusters = registry.query_clusters(USER, PRODUCT, '1.0.0', fields=True, depth=1)
+        self.assertEqual([n['name'] for n in clusters[0]['nodes']], ['node0', 'node10'])
+
+    def test_pagination(self):
+        page = self.dns(registry.query_clusters(USER, limit=2))
+        self.assertEqual(page, ['user/other/1.0.0/3', 'user/product/1.0.0/1'])
+        page = self.dns(registry.query_clusters(USER, limit=2, start_after=page[-1]))
+        self.assertEqual(page, ['user/product/1.0.0/2', 'user/product/1.0.0/10'])
+        page = self.dns(registry.iter_clusters(USER, start_after=PREFIX + '/' + page[-1]))
+        self.assertEqual(page, ['user/product/2.0.0/1'])
+        self.assertEqual(registry.query_clusters(USER, start_after='user/product/2.0.0/1'), [])
+        self.assertEqual(self.dns(registry.iter_clusters(start_after='admin', limit=1)),
+                         ['user/other/1.0.0/3'])
+        self.assertEqual(self.dns(registry.iter_clusters(start_after='user/product/1.0.0/2',
+                                                         reverse=True)),
+                         ['user/product/1.0.0/1', 'user/other/1.0.0/3', 'admin/product/1.0.0/1'])
+        self.assertEqual(list(registry.iter_clusters('nobody')), [])
+
+    def test_lazy_listing(self):
+        self.kv.requests = 0
+        clusters = registry.iter_clusters(limit=1)
+        self.assertEqual(self.kv.requests, 0)
+        self.assertEqual(self.dns(clusters), ['admin/product/1.0.0/1'])
+        # clusters, users, products and versions of admin only
+        self.assertEqual(self.kv.requests, 4)
+
+    def test_paginated_fields(self):
+        del self.kv.recurse
+        clusters = registry.query_clusters(USER, PRODUCT, fields=True, depth=1,
+                                           start_after='user/product/1.0.0/2')
+        self.assertEqual([c['dn'] for c in clusters],
+                         [PREFIX + '/user/product/1.0.0/10', PREFIX + '/user/product/2.0.0/1'])
+        self.assertEqual(clusters[0]['nodes'][0]['name'], 'node0')
+
+
+class RegistryExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        for n in (1, 2):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': n})
+        registry.Node(BASEDN + '/2/nodes/slave1').host = 'c13-1'
+        registry._kv.set(BASEDN + '/2/description', registry._to_str(u'cl\xfaster'))
+        self.source = registry._kv
+
+    def strings(self, data):
+        """Values as returned by a real store"""
+        return {k: registry._to_str(v) for k, v in data.items()}
+
+    def export(self, prefix, **kwargs):
+        output = io.BytesIO()
+        count = registry.export(prefix, output, **kwargs)
+        return count, output.getvalue()
+
+    def test_export_and_import(self):
+        recursed = []
+        recurse = self.source.recurse
+        self.source.recurse = lambda key: recursed.append(key) or recurse(key)
+        count, clusters = self.export(PREFIX)
+        # One read per cluster
+        self.assertEqual(recursed, [BASEDN + '/1/', BASEDN + '/2/'])
+        self.assertEqual(count, len(recurse(PREFIX)))
+        products = self.export(registry.TMPLPREFIX)[1]
+        registry.connect('local://')
+        try:
+            self.assertEqual(registry.import_(io.BytesIO(clusters), writers=2), count)
+            registry.import_(io.BytesIO(products))
+            self.assertEqual(registry._kv.recurse(PREFIX), self.strings(recurse(PREFIX)))
+            self.assertEqual(registry._kv.recurse(registry.TMPLPREFIX),
+                             self.strings(recurse(registry.TMPLPREFIX)))
+            self.assertEqual(registry.verify_indexes(), ([], []))
+            self.assertEqual(registry.query_nodes(host='c13-1'),
+                             [registry.Node(BASEDN + '/2/nodes/slave1')])
+            cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+            self.assertEqual(cluster.dn, BASEDN + '/3')
+        finally:
+            registry.close()
+
+    def test_import_updates_catalog(self):
+        products = self.export(registry.TMPLPREFIX)[1]
+        registry.connect('local://')
+        try:
+            registry.register('other', '2', 'Other product', TEMPLATE, OPTIONS)
+            registry.import_(io.BytesIO(products))
+            catalog = registry.query_products(catalog=True)
+            self.assertEqual(sorted(p['name'] for p in catalog), ['other', PRODUCT])
+        finally:
+            registry.close()
+
+    def test_import_moves_counters_forward(self):
+        clusters = self.export(PREFIX)[1]
+        products = self.export(registry.TMPLPREFIX)[1]
+        registry.connect('local://')
+        try:
+            registry.import_(io.BytesIO(products))
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+            registry.import_(io.BytesIO(clusters))
+            self.assertEqual(registry.Cluster(BASEDN + '/2').description,
+                             registry._to_str(u'cl\xfaster'))
+            cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+            self.assertEqual(cluster.dn, BASEDN + '/3')
+        finally:
+            registry.close()
+
+    def test_uncompressed_subtree(self):
+        count, data = self.export(BASEDN + '/1', compress=False)
+        lines = data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), count)
+        self.assertEqual(json.loads(lines[0]), [BASEDN + '/1/nodes/master0/cpu', '1'])
+        self.assertEqual(self.export('missing')[0], 0)
+        registry._kv = FlatKVMock({PREFIX: {}})
+        self.assertEqual(registry.import_(io.BytesIO(data), compressed=False), count)
+        self.assertEqual(registry._kv.recurse(BASEDN),
+                         self.strings(self.source.recurse(BASEDN + '/1/')))
+
+
+class RegistryLayoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS,
+                          layout=registry.LAYOUT_DOCUMENT)
+
+    def tearDown(self):
+        registry._layouts.clear()
+
+    def test_instantiate_documents(self):
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 10})
+        keys = [k for k in registry._kv.recurse(PREFIX) if k.startswith(cluster.dn + '/')]
+        # One document per node, per service and the cluster one
+        self.assertEqual(len(keys), 11 + 2 + 2)
+        registry._layouts.clear()
+        self.assertEqual(cluster.status, 'pending')
+        self.assertEqual([n.name for n in cluster.nodes][:3], ['master0', 'slave0', 'slave1'])
+        node = registry.Node(cluster.dn + '/nodes/slave2')
+        self.assertEqual(node.cpu, '2')
+        self.assertEqual([s.name for s in node.services], ['slave'])
+        self.assertEqual(len(registry.Service(cluster.dn + '/services/slave').nodes), 10)
+        self.assertEqual(registry.query_nodes(service='slave')[0], registry.Node(
+            cluster.dn + '/nodes/slave0'))
+        with self.assertRaises(registry.KeyDoesNotExist):
+            node.missing
+        data = cluster.to_dict(depth=1)
+        self.assertEqual(data['nodes'][0]['cpu'], '1')
+
+    def test_writes_update_documents(self):
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2})
+        node = registry.Node(cluster.dn + '/nodes/slave0')
+        node.status = 'running'
+        node.host = 'c13-1'
+        registry._write([('set', node.dn + '/disks/disk0/path', '/data')])
+        self.assertEqual(node.status, 'running')
+        self.assertEqual([d.name for d in node.disks], ['disk0'])
+        self.assertEqual(registry.query_nodes(host='c13-1'), [node])
+        document = json.loads(registry._kv.get(node.dn))
+        self.assertEqual(document['status'], 'running')
+        with cluster.batch():
+            for n in cluster.nodes:
+                n.status = 'failed'
+            cluster.status = 'failed'
+        self.assertEqual(registry.Node(node.dn).status, 'failed')
+        self.assertEqual(cluster.status, 'failed')
+        self.assertEqual(registry.verify_indexes(), ([], []))
+        snapshot = registry.get_cluster(dn=cluster.dn, snapshot=True)
+        self.assertEqual(snapshot.to_dict(depth=1), cluster.to_dict(depth=1))
+
+    def test_concurrent_update_is_retried(self):
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        node = registry.Node(cluster.dn + '/nodes/slave0')
+        get_indexed = registry._kv.get_indexed
+
+        def modified(key):
+            # Another client updates the document after it is read
+            value, index = get_indexed(key)
+            registry._kv.get_indexed = get_indexed
+            registry._kv.set(key, value.replace('"cpu":"2"', '"cpu":"4"'))
+            return value, index
+        registry._kv.get_indexed = modified
+        node.status = 'running'
+        self.assertEqual((node.status, node.cpu), ('running', '4'))
+
+    def test_migrate_layout(self):
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 3})
+        registry.Node(cluster.dn + '/nodes/slave0').host = 'c13-1'
+        # Values as returned by a real store
+        data = registry._kv._data
+        data.update((k, registry._to_str(v)) for k, v in data.items())
+        expected = cluster.to_dict(depth=2)
+        before = registry._kv.recurse(PREFIX)
+        self.assertEqual(registry.migrate_layout(), [cluster.dn])
+        self.assertEqual(registry.migrate_layout(), [])
+        self.assertEqual(len(registry._kv.recurse(cluster.dn + '/')), 8)
+        self.assertEqual(registry.Cluster(cluster.dn).to_dict(depth=2), expected)
+        self.assertEqual(registry.verify_indexes(), ([], []))
+        registry.migrate_layout(registry.LAYOUT_KEYS, user=USER)
+        self.assertEqual(registry._kv.recurse(PREFIX), before)
+
+    def test_deinstantiate_keeps_other_ids(self):
+        for _ in range(10):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        registry.deinstantiate(USER, PRODUCT, VERSION, 1)
+        self.assertEqual([c.name for c in registry.query_clusters(USER)],
+                         [str(i) for i in range(2, 11)])
+        self.assertEqual(registry.Cluster(BASEDN + '/10').status, 'pending')
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+
+class RegistryBlobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        self.chunk_size = registry.BLOB_CHUNK_SIZE
+        registry.BLOB_CHUNK_SIZE = 256
+        # Random comments do not compress, so the template needs several chunks
+        self.template = TEMPLATE + ''.join(
+            '{{# {} #}}\n'.format(hashlib.sha1(str(i).encode()).hexdigest())
+            for i in range(100))
+        self.dn = 'products/{}/{}'.format(PRODUCT, VERSION)
+
+    def tearDown(self):
+        registry.BLOB_CHUNK_SIZE = self.chunk_size
+
+    def keys(self):
+        return sorted(registry._kv.recurse(self.dn))
+
+    def test_large_fields_compressed(self):
+        registry.register(PRODUCT, VERSION, 'Test product', self.template, OPTIONS)
+        keys = self.keys()
+        self.assertNotIn(self.dn + '/template', keys)
+        self.assertIn(self.dn + '/options', keys)
+        chunks = [k for k in keys if re.match(r'.*/template\.blob/\d+$', k)]
+        self.assertGreater(len(chunks), 1)
+        self.assertLess(len(chunks) * registry.BLOB_CHUNK_SIZE, len(self.template))
+        product = registry.get_product(PRODUCT, VERSION)
+        self.assertEqual(product.template, self.template)
+        self.assertEqual(product.get('orchestrator'), '')
+        self.assertEqual(registry.query_products(PRODUCT, fields=('template',))[0]['template'],
+                         self.template)
+        cluster = registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+        self.assertEqual(cluster.status, 'pending')
+        # Compiled templates are found by the stored checksum
+        info = registry._products.get(self.dn)
+        self.assertEqual(info.revision, hashlib.sha256(self.template.encode()).hexdigest())
+
+    def test_register_again_removes_stale_keys(self):
+        registry.register(PRODUCT, VERSION, 'Test product', self.template, OPTIONS)
+        registry.register(PRODUCT, VERSION, 'Test product', self.template[:5000], OPTIONS)
+        chunks = [k for k in self.keys() if '.blob/' in k]
+        registry.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+        self.assertEqual([k for k in self.keys() if '.blob/' in k], [])
+        self.assertEqual(registry.get_product(PRODUCT, VERSION).template, TEMPLATE)
+        registry.register(PRODUCT, VERSION, 'Test product', self.template[:5000], OPTIONS)
+        self.assertEqual([k for k in self.keys() if '.blob/' in k], chunks)
+        self.assertNotIn(self.dn + '/template', self.keys())
+
+    def test_to_dict_large_fields(self):
+        registry.register(PRODUCT, VERSION, 'Test product', self.template, OPTIONS)
+        data = registry.get_product(PRODUCT, VERSION).to_dict(fields=('template', 'version'))
+        self.assertEqual(data['template'], self.template)
+        self.assertEqual(data['version'], VERSION)
+
+    def test_import_writes_chunks_one_at_a_time(self):
+        registry.register(PRODUCT, VERSION, 'Test product', self.template, OPTIONS)
+        output = io.BytesIO()
+        registry.export(registry.TMPLPREFIX, output)
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry.import_(io.BytesIO(output.getvalue()))
+        chunks = [k for k in self.keys() if re.match(r'.*\.blob/\d+$', k)]
+        self.assertGreater(len(chunks), 1)
+        # Only the other keys are packed in transactions
+        written = [op[1] for ops in registry._kv.transactions for op in ops]
+        self.assertEqual([k for k in written if k in chunks], [])
+        self.assertIn(self.dn + '/template.blob/chunks', written)
+        self.assertEqual(registry.get_product(PRODUCT, VERSION).template, self.template)
+
+    def test_corrupted_blob(self):
+        registry.register(PRODUCT, VERSION, 'Test product', self.template, OPTIONS)
+        registry._kv.set(self.dn + '/template.blob/00001', 'A' * registry.BLOB_CHUNK_SIZE)
+        with self.assertRaises(registry.CorruptedBlobError):
+            registry.get_product(PRODUCT, VERSION).template
+        registry._kv.delete(self.dn + '/template.blob/chunks')
+        with self.assertRaises(registry.CorruptedBlobError):
+            registry.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+
+
+class RegistryCatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry._kv = FlatKVMock({PREFIX: {}})
+        registry._products.clear()
+        for name, version in ((PRODUCT, '1'), (PRODUCT, '1.0'), ('other', '2')):
+            registry.register(name, version, 'Product ' + version, TEMPLATE, OPTIONS,
+                              logo_url='http://logo')
+
+    def test_query_products_keys_only(self):
+        kv = registry._kv
+        kv.recurse = None
+        products = registry.query_products()
+        self.assertEqual([p.dn for p in products],
+                         ['products/other/2', 'products/product/1', 'products/product/1.0'])
+        self.assertEqual(registry.query_products(PRODUCT, '1'), [registry.Product('products/product/1')])
+        self.assertIsNone(registry.query_products(PRODUCT, '2'))
+
+    def test_catalog(self):
+        kv = registry._kv
+        kv.requests = 0
+        products = registry.query_products(catalog=True)
+        self.assertEqual(kv.requests, 1)
+        self.assertEqual(products, registry.query_products(fields=True))
+        self.assertEqual(products[1], {'dn': 'products/product/1', 'name': PRODUCT,
+                                       'version': '1', 'description': 'Product 1',
+                                       'logo_url': 'http://logo'})
+        registry.deregister(PRODUCT, '1')
+        self.assertEqual([p['dn'] for p in registry.query_products(PRODUCT, catalog=True)],
+                         ['products/product/1.0'])
+        self.assertEqual(registry.get_product(PRODUCT, '1.0').description, 'Product 1.0')
+
+    def test_fields_without_prefix_siblings(self):
+        registry.register(PRODUCT + '2', '1', 'Other product', TEMPLATE, OPTIONS)
+        products = registry.query_products(PRODUCT, fields=True)
+        self.assertEqual([p['dn'] for p in products],
+                         ['products/product/1', 'products/product/1.0'])
+        self.assertEqual([p['dn'] for p in registry.query_products(PRODUCT, '1', fields=True)],
+                         ['products/product/1'])
+
+    def test_rebuild_catalog(self):
+        expected = registry.query_products(catalog=True)
+        registry._kv.delete(registry.CATALOGKEY)
+        self.assertEqual(registry.query_products(catalog=True), expected)
+        self.assertEqual(registry.rebuild_catalog(), 3)
+        self.assertEqual(json.loads(registry._kv.get(registry.CATALOGKEY))['products/other/2'],
+                         {'version': '2', 'description': 'Product 2', 'logo_url': 'http://logo'})
+
 
 class RegistryRegistrationTestCase(unittest.TestCase):
 
@@ -294,6 +1900,103 @@ class RegistryRegistrationTestCase(unittest.TestCase):
         self.assertEqual(iid, 99)
 
 
+class RegistrySaveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kvinfo = {'{}/cluster2/nodes/slave{}/status'.format(BASEDN, i): 'pending'
+                       for i in range(150)}
+        # Precreate the tree because KVMock.set is not thread-safe
+        nodes = {'slave{}'.format(i): {} for i in range(150)}
+        self.data = {PREFIX: {USER: {PRODUCT: {VERSION: {'cluster2': {'nodes': nodes}}}}}}
+
+    def test_save_uses_transactions(self):
+        registry._kv = KVTxnMock({})
+        registry.save(self.kvinfo)
+        sizes = sorted(len(t) for t in registry._kv.transactions)
+        self.assertEqual(sizes, [22, 64, 64])
+        for k, v in self.kvinfo.items():
+            self.assertEqual(registry._kv.get(k), v)
+
+    def test_save_without_transactions_support(self):
+        registry._kv = KVMock(self.data)
+        registry.save(self.kvinfo)
+        for k, v in self.kvinfo.items():
+            self.assertEqual(registry._kv.get(k), v)
+
+    def test_save_non_transactional(self):
+        registry._kv = KVTxnMock(self.data)
+        registry.save(self.kvinfo, transactional=False)
+        self.assertEqual(registry._kv.transactions, [])
+        self.assertEqual(len(registry._kv.recurse(BASEDN + '/cluster2/nodes')), 150)
+
+    def test_save_propagates_transaction_errors(self):
+        registry._kv = KVTxnMock({})
+
+        def failing_txn(operations):
+            raise registry.TransactionError('rolled back')
+        registry._kv.txn = failing_txn
+        with self.assertRaises(registry.SaveError) as cm:
+            registry.save(self.kvinfo)
+        self.assertEqual(len(cm.exception.errors), 3)
+        self.assertIsInstance(cm.exception.errors[0][1], registry.TransactionError)
+
+    def test_save_reports_all_failures(self):
+        registry._kv = KVTxnMock({})
+        txn = registry._kv.txn
+
+        def failing_txn(operations):
+            if len(operations) < registry.TXN_MAX_OPS:
+                raise registry.TransactionError('rolled back')
+            return txn(operations)
+        registry._kv.txn = failing_txn
+        with self.assertRaises(registry.SaveError) as cm:
+            registry.save(self.kvinfo)
+        # The other batches were saved
+        self.assertEqual([len(ops) for ops, e in cm.exception.errors], [22])
+        self.assertEqual(len(registry._kv.transactions), 2)
+
+    def test_save_progress(self):
+        registry._kv = KVTxnMock({})
+        progress = []
+        registry.save(self.kvinfo, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(progress[-1], (150, 150))
+
+
+class RegistryWriterPoolTestCase(unittest.TestCase):
+
+    def test_run_returns_results_in_order(self):
+        pool = registry.WriterPool(4)
+        self.assertEqual(pool.run(lambda x: x * 2, range(10)), [2 * x for x in range(10)])
+        self.assertEqual(pool.stats()['tasks'], 10)
+        pool.shutdown()
+
+    def test_concurrency_adapts_to_throughput(self):
+        pool = registry.WriterPool(8)
+        # The first measurement probes a lower concurrency
+        pool._tune(100, 8, 1.0, 0.05)
+        self.assertEqual(pool.concurrency, 6)
+        # Throughput improved: keep going in the same direction
+        pool._tune(100, 6, 0.5, 0.05)
+        self.assertEqual(pool.concurrency, 5)
+        # Throughput dropped: turn back
+        pool._tune(100, 5, 1.0, 0.05)
+        self.assertEqual(pool.concurrency, 6)
+        # Same throughput but higher latency: turn back again
+        pool._tune(100, 6, 1.0, 0.5)
+        self.assertEqual(pool.concurrency, 5)
+        # Calls that do not use all the concurrency are not used to tune it
+        pool._tune(2, 5, 1.0, 0.05)
+        self.assertEqual(pool.concurrency, 5)
+        pool.shutdown()
+
+    def test_fixed_concurrency(self):
+        pool = registry.WriterPool(8, adaptive=False)
+        pool._tune(100, 8, 1.0, 0.05)
+        self.assertEqual(pool.concurrency, 8)
+        pool.shutdown()
+
+
 class RegistryUtilsTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,239 @@
+"""Tests for the asynchronous registry API (python 3 only)"""
+import asyncio
+import unittest
+
+import benchmarks
+import kvstore
+import registry
+import registry_aio
+from tests import (PREFIX, USER, PRODUCT, VERSION, BASEDN, TEMPLATE, OPTIONS,
+                   REGISTRY, FlatKVMock)
+
+
+class AsyncKVMock(object):
+    """Expose the operations of a synchronous mock as coroutines"""
+    def __init__(self, mock):
+        self.mock = mock
+
+    def __getattr__(self, name):
+        method = getattr(self.mock, name)
+
+        async def coroutine(*args, **kwargs):
+            return method(*args, **kwargs)
+        return coroutine
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class RegistryAioTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = FlatKVMock({PREFIX: {}})
+        registry_aio._kv = AsyncKVMock(self.kv)
+        registry_aio._products.clear()
+        registry._layouts.clear()
+        run(registry_aio.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS))
+
+    def test_instantiate(self):
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 3}))
+        self.assertEqual(cluster.dn, BASEDN + '/1')
+        self.assertEqual(len(run(cluster.nodes())), 4)
+        node = registry_aio.Node(cluster.dn + '/nodes/slave2')
+        self.assertEqual(run(node.cpu), 2)
+        # Same layout as the synchronous API
+        registry._kv = self.kv
+        self.assertEqual(registry.Node(node.dn).cpu, 2)
+
+    def test_instantiate_uses_transactions(self):
+        self.kv.transactions = []
+        run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 100}))
+        self.assertTrue(all(len(t) <= registry.TXN_MAX_OPS for t in self.kv.transactions))
+        self.assertGreater(len(self.kv.transactions), 1)
+
+    def test_concurrent_instantiate_unique_ids(self):
+        async def instantiate_many():
+            return await asyncio.gather(*[
+                registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1})
+                for _ in range(5)])
+        clusters = run(instantiate_many())
+        self.assertEqual(sorted(c.name for c in clusters), ['1', '2', '3', '4', '5'])
+
+    def test_missing_attribute(self):
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        with self.assertRaises(registry.KeyDoesNotExist):
+            run(cluster.missing)
+        self.assertEqual(run(cluster.get('missing', 'default')), 'default')
+
+    def test_update_and_readonly(self):
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        run(cluster.update({'status': 'running', 'owner': USER}))
+        self.assertEqual(run(cluster.status), 'running')
+        with self.assertRaises(registry.ReadOnlyAttributeError):
+            run(cluster.set('name', 'other'))
+        with self.assertRaises(AttributeError):
+            cluster.status = 'failed'
+
+    def test_node_status_updates_index(self):
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        node = registry_aio.Node(cluster.dn + '/nodes/slave0')
+        run(node.set('status', 'running'))
+        registry._kv = self.kv
+        self.assertEqual(registry.query_nodes(status='running'), [registry.Node(node.dn)])
+
+    def test_snapshot_and_to_dict(self):
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2}))
+        snapshot = run(registry_aio.get_cluster(dn=cluster.dn, snapshot=True))
+        self.kv.requests = 0
+        services = run(snapshot.services())
+        self.assertEqual([s.name for s in services], ['master', 'slave'])
+        self.assertEqual(len(run(services[1].nodes())), 2)
+        self.assertEqual(self.kv.requests, 0)
+        data = run(cluster.to_dict(depth=1))
+        self.assertEqual(data['status'], 'pending')
+        self.assertEqual([n['name'] for n in data['nodes']], ['master0', 'slave0', 'slave1'])
+
+    def test_query_and_deinstantiate(self):
+        run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        clusters = run(registry_aio.query_clusters(USER))
+        self.assertEqual([c.name for c in clusters], ['1', '2'])
+        run(registry_aio.deinstantiate(USER, PRODUCT, VERSION, 1))
+        clusters = run(registry_aio.query_clusters(USER))
+        self.assertEqual([c.name for c in clusters], ['2'])
+        registry._kv = self.kv
+        self.assertEqual(registry.verify_indexes(), ([], []))
+        products = run(registry_aio.query_products(PRODUCT))
+        self.assertEqual([p.dn for p in products], ['products/{}/{}'.format(PRODUCT, VERSION)])
+        products = run(registry_aio.query_products(PRODUCT, catalog=True))
+        self.assertEqual(products, registry.query_products(PRODUCT, catalog=True))
+        self.assertEqual(products[0]['description'], 'Test product')
+        # Registries without catalog build it from the products
+        self.kv.delete(registry.CATALOGKEY)
+        self.assertEqual(run(registry_aio.query_products(PRODUCT, catalog=True)), products)
+        run(registry_aio.deregister(PRODUCT, VERSION))
+        self.assertEqual(run(registry_aio.query_products(catalog=True)), [])
+
+    def test_query_lists_one_level_at_a_time(self):
+        for _ in range(11):
+            run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2}))
+        listed = []
+        keys = self.kv.keys
+
+        def listing(key, separator=None):
+            listed.append((key, separator))
+            return keys(key, separator)
+        self.kv.keys = listing
+        clusters = run(registry_aio.query_clusters(USER))
+        self.assertEqual([c.name for c in clusters], [str(i) for i in range(1, 12)])
+        basedn = '{}/{}'.format(PREFIX, USER)
+        self.assertEqual(listed, [(basedn + '/', '/'), (basedn + '/' + PRODUCT + '/', '/'),
+                                  ('{}/{}/{}/'.format(basedn, PRODUCT, VERSION), '/')])
+        self.assertIsNone(run(registry_aio.query_clusters('missing')))
+        products = run(registry_aio.query_products(PRODUCT, VERSION))
+        self.assertEqual([p.dn for p in products], ['products/{}/{}'.format(PRODUCT, VERSION)])
+        self.assertIsNone(run(registry_aio.query_products(PRODUCT, 'missing')))
+
+    def test_document_layout(self):
+        run(registry_aio.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS,
+                                  layout=registry.LAYOUT_DOCUMENT))
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 2}))
+        registry._layouts.clear()
+        node = registry_aio.Node(cluster.dn + '/nodes/slave1')
+        self.assertEqual(run(node.cpu), '2')
+        self.assertEqual([s.name for s in run(node.services())], ['slave'])
+        run(node.set('status', 'running'))
+        data = run(cluster.to_dict(depth=1))
+        self.assertEqual([n['status'] for n in data['nodes']], ['pending', 'pending', 'running'])
+        # Same documents as the synchronous API
+        registry._kv = self.kv
+        self.assertEqual(registry.Node(node.dn).status, 'running')
+        self.assertEqual(registry.query_nodes(status='running'), [registry.Node(node.dn)])
+        run(registry_aio.deinstantiate(USER, PRODUCT, VERSION, 1))
+        self.assertEqual(registry.verify_indexes(), ([], []))
+
+    def test_compressed_template(self):
+        template = TEMPLATE + '{# ' + ' '.join(str(i) for i in range(5000)) + ' #}'
+        run(registry_aio.register(PRODUCT, VERSION, 'Test product', template, OPTIONS))
+        dn = 'products/{}/{}'.format(PRODUCT, VERSION)
+        self.assertIn(dn + '/template.blob/00000', self.kv.recurse(dn))
+        self.assertNotIn(dn + '/template', self.kv.recurse(dn))
+        self.assertEqual(run(registry_aio.Product(dn).template), template)
+        cluster = run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}))
+        self.assertEqual(len(run(cluster.nodes())), 2)
+        run(registry_aio.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS))
+        self.assertEqual(run(registry_aio.Product(dn).template), TEMPLATE)
+        self.assertFalse([k for k in self.kv.recurse(dn) if '.blob/' in k])
+
+    def test_generate_id_seeds_counter(self):
+        self.kv = FlatKVMock(REGISTRY)
+        registry_aio._kv = AsyncKVMock(self.kv)
+        self.kv.set('{}/7/status'.format(BASEDN), 'running')
+        self.assertEqual(run(registry_aio.generate_ids(BASEDN, 2)), [8, 9])
+        self.assertEqual(run(registry_aio.generate_id(BASEDN)), 10)
+
+    def test_instantiate_reserved_ids(self):
+        ids = run(registry_aio.generate_ids(BASEDN, 2))
+        for i in ids:
+            run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}, id=i))
+        clusters = run(registry_aio.query_clusters(USER))
+        self.assertEqual([c.name for c in clusters], [str(i) for i in ids])
+        with self.assertRaises(registry.ClusterAlreadyExistsError):
+            run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1},
+                                         id=ids[0]))
+        run(registry_aio.instantiate(USER, PRODUCT, VERSION, {'slaves.number': 1}, id=9))
+        self.assertEqual(run(registry_aio.generate_id(BASEDN)), 10)
+
+
+class RegistryAioConsulServerTestCase(unittest.TestCase):
+    """Use the asynchronous client against the consul stand-in of the benchmarks"""
+
+    def setUp(self):
+        self.server = benchmarks.ConsulServer().start()
+        registry_aio.connect(self.server.endpoint)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_closing(self, coroutine):
+        async def closing():
+            try:
+                return await coroutine
+            finally:
+                await registry_aio.close()
+        return run(closing())
+
+    def test_fallback_without_txn_endpoint(self):
+        class NoTxnHandler(benchmarks.ConsulHandler):
+            def _txn(self, payload):
+                self._reply(404)
+        self.server.RequestHandlerClass = NoTxnHandler
+
+        async def instantiate():
+            await registry_aio.register(PRODUCT, VERSION, 'Test product', TEMPLATE, OPTIONS)
+            cluster = await registry_aio.instantiate(USER, PRODUCT, VERSION,
+                                                     {'slaves.number': 2})
+            await registry_aio.Node(cluster.dn + '/nodes/slave0').set('status', 'running')
+            return [n.name for n in await cluster.nodes()]
+        self.assertEqual(self.run_closing(instantiate()), ['master0', 'slave0', 'slave1'])
+        self.assertFalse(registry_aio._kv.txn_supported)
+
+    def test_error_without_json_body(self):
+        class FailingHandler(benchmarks.ConsulHandler):
+            def do_GET(self):
+                self.send_response(500)
+                self.send_header('Content-Length', '5')
+                self.end_headers()
+                self.wfile.write(b'error')
+        self.server.RequestHandlerClass = FailingHandler
+        with self.assertRaises(kvstore.KVStoreError):
+            self.run_closing(registry_aio._kv.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()